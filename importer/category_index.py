@@ -0,0 +1,171 @@
+#!/usr/bin/python
+# -*- coding: utf-8  -*-
+"""
+Offline index of the categories existing on Commons.
+
+The index is built from a locally supplied title dump, either a list of
+category titles (one per line) or the two column (namespace, title)
+all-titles dump, plain or gzipped. It is stored as the sorted, normalised
+titles, one per line, and looked up by binary search over a memory map of
+the file so that it never needs to be read into memory.
+
+A title found in the index is known to exist. Anything else may have been
+created after the dump was made so must still be checked live.
+
+Usage:
+    python category_index.py -dump:PATH [-out:PATH] [-settings:PATH]
+
+By default the index is written to where make_KMB_info looks for it, i.e.
+the category_index file in the mappings_dir of the settings.
+"""
+import gzip
+import mmap
+import os
+import sys
+
+import importer.config as config
+
+INDEX_FILE = config.DEFAULTS['processing']['category_index']
+CATEGORY_NAMESPACE = '14'
+CATEGORY_PREFIX = 'category:'
+
+
+def normalise_title(title):
+    """
+    Normalise a category title the way MediaWiki would.
+
+    The namespace prefix is dropped, underscores are replaced by spaces and
+    the first letter is capitalised.
+
+    :param title: the category title, with or without prefix
+    :return: str
+    """
+    title = title.strip()
+    if title.lower().startswith(CATEGORY_PREFIX):
+        title = title[len(CATEGORY_PREFIX):]
+    title = title.replace('_', ' ').strip()
+    return title[:1].upper() + title[1:]
+
+
+class CategoryIndex(object):
+    """Memory mapped, sorted set of category titles."""
+
+    def __init__(self, filename):
+        """
+        Open an index built by build_index().
+
+        :param filename: path to the index file
+        """
+        self.filename = filename
+        self.file = open(filename, 'rb')
+        self.data = None
+        if os.fstat(self.file.fileno()).st_size:
+            self.data = mmap.mmap(
+                self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __contains__(self, title):
+        """Check if a category, with or without prefix, is in the index."""
+        if self.data is None:
+            return False
+        key = normalise_title(title).encode('utf-8')
+        low, high = 0, len(self.data)
+        while low < high:
+            middle = (low + high) // 2
+            start = self.data.rfind(b'\n', 0, middle) + 1
+            end = self.data.find(b'\n', start)
+            if end == -1:
+                end = len(self.data)
+            line = self.data[start:end]
+            if line == key:
+                return True
+            elif line < key:
+                low = end + 1
+            else:
+                high = start
+        return False
+
+    def close(self):
+        """Release the memory map and the file."""
+        if self.data is not None:
+            self.data.close()
+        self.file.close()
+
+
+def load_index(filename):
+    """
+    Open an index if it has been built.
+
+    :param filename: path to the index file
+    :return: CategoryIndex or None
+    """
+    if filename and os.path.exists(filename):
+        return CategoryIndex(filename)
+
+
+def read_dump(dump_file):
+    """
+    Yield the category titles in a title dump.
+
+    :param dump_file: path to the dump, plain or gzipped
+    :return: generator of titles
+    """
+    opener = gzip.open if dump_file.endswith('.gz') else open
+    with opener(dump_file, 'rt', encoding='utf-8') as f:
+        for line in f:
+            namespace, sep, title = line.rstrip('\n').partition('\t')
+            if not sep:
+                title = namespace
+            elif namespace != CATEGORY_NAMESPACE:
+                continue  # incl. the header of the all-titles dump
+            if title.strip():
+                yield normalise_title(title)
+
+
+def build_index(dump_file, index_file):
+    """
+    Build the index from a title dump.
+
+    All of the titles are sorted in memory, for a full Commons dump this
+    takes a few GB.
+
+    :param dump_file: path to the dump, plain or gzipped
+    :param index_file: path to which the index is written
+    :return: the number of indexed titles
+    """
+    titles = sorted({title.encode('utf-8') for title in read_dump(dump_file)})
+    with open(index_file, 'wb') as f:
+        f.write(b'\n'.join(titles))
+    return len(titles)
+
+
+def main(*args):
+    """Command line entry-point."""
+    usage = __doc__[__doc__.index('Usage:'):]
+    dump_file = None
+    index_file = None
+    settings_file = None
+    for arg in args or sys.argv[1:]:
+        option, sep, value = arg.partition(':')
+        if option == '-dump':
+            dump_file = value
+        elif option == '-out':
+            index_file = value
+        elif option == '-settings':
+            settings_file = value
+        else:
+            dump_file = None
+            break
+    if not dump_file:
+        print(usage)
+        return
+    if not index_file:
+        settings = config.load_settings(
+            settings_file, required=bool(settings_file))['processing']
+        index_file = os.path.join(
+            settings['mappings_dir'], settings['category_index'])
+    count = build_index(dump_file, index_file)
+    print('Indexed {0} categories in {1}.'.format(count, index_file))
+
+
+if __name__ == '__main__':
+    main()
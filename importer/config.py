@@ -0,0 +1,143 @@
+#!/usr/bin/python
+# -*- coding: utf-8  -*-
+"""
+Settings schema shared by all of the entry points of the KMB pipeline.
+
+A settings file (settings.json, see settings.example.json) need only
+contain the values which differ from DEFAULTS. It is merged into these
+section by section and any section or key not found in DEFAULTS is
+rejected, so that a misspelt setting is not silently ignored.
+
+The sections are:
+endpoints   base urls of the external services
+throttle    adaptive page size and delay of the K-samsök harvest
+harvest     harvester workers, retries and files
+massload    kmb_massload delay and files
+processing  make_KMB_info cache (mappings) location, files and work queue
+sparql      caching and chunking of the SPARQL queries behind the mappings
+pipeline    streaming harvest to make_KMB_info output, see pipeline
+upload      pipelined upload prefetch and files
+"""
+import copy
+import os
+
+import batchupload.common as common
+
+SETTINGS_FILE = 'settings.json'
+DEFAULTS = {
+    'keywords': [],
+    'api_key': None,
+    'endpoints': {
+        'ksamsok': 'http://kulturarvsdata.se/ksamsok/api',
+        'kmb_record': 'http://kulturarvsdata.se/raa/kmb/{0}',
+        'heritage': 'https://tools.wmflabs.org/heritage/api/api.php',
+        'sparql': None,  # None for the Wikidata Query Service
+        'sparql_entity': None,  # required if sparql is set
+    },
+    'throttle': {
+        'page_size': 500,  # the API does not allow larger pages
+        'min_page_size': 50,
+        'max_page_size': 500,
+        'page_step': 50,
+        'delay': 0.5,
+        'min_delay': 0.1,
+        'max_delay': 60.0,
+        'target_latency': 5.0,
+        'max_page_bytes': 20 * 1024 * 1024,
+        'max_retries': 5,  # retries of a failed request, 0 to not retry
+    },
+    'harvest': {
+        'workers': None,  # None to parse in the main process, 0 per core
+        'columnar': False,  # post-process each page at once
+        'prescreen': False,  # reject non-free records before parsing
+        'rejects_file': 'kmb_rejects.log',  # id, license, copyright
+        'data_file': 'kmb_data.json',
+        'index_file': 'kmb_keywords.json',
+        'log_file': 'kmb_massloading.log',
+        'stats_file': 'kmb_harvest_stats.json',
+    },
+    'massload': {
+        'delay': 0.5,
+        'columnar': False,  # post-process all records at once
+        'prescreen': False,  # reject non-free records before parsing
+        'rejects_file': 'kmb_rejects.log',  # id, license, copyright
+        'list_file': 'kmb_hitlist.json',
+        'data_file': 'kmb_data.json',
+        'log_file': 'kmb_massloading.log',
+        'stats_file': 'kmb_massload_stats.json',
+    },
+    'processing': {
+        'mappings_dir': 'mappings',
+        'category_index': 'commons_categories.idx',  # in mappings_dir
+        'item_cache': 'item_cache',  # output per item, None to not cache
+        'category_cache_size': 100000,  # None for an unbounded cache
+        'schedule': True,  # group items by place and tags, see scheduling
+        'problem_file': 'kmb_problems.json',  # items which failed
+        'checkpoint_file': 'kmb_checkpoint.json',  # None to not checkpoint
+        'checkpoint_interval': 500,  # items processed between checkpoints
+        'max_failures_in_a_row': 50,  # before aborting, None to never abort
+        'queue_dir': 'work_queue',  # see work_queue
+        'shard_size': 500,  # maximum records per work unit
+        'claim_timeout': 6 * 60 * 60,  # seconds before a claim is stale
+        'log_file': 'kmb_processing_september.log',
+        'stats_file': 'kmb_processing_stats.json',
+    },
+    'sparql': {
+        'cache_dir': 'sparql_cache',  # None to never cache
+        'ttl': 24 * 60 * 60,  # maximum age of a cached lookup, in seconds
+        'chunk_size': 20000,  # results per request, None for one request
+        'workers': 4,  # requests made concurrently
+    },
+    'pipeline': {
+        'source': 'harvest',  # or 'massload'
+        'queue_size': 1000,  # records waiting to be processed
+        'stream_file': 'kmb_output.jsonl',  # each output as it is ready
+        'output_file': 'kmb_output.json',
+        'stats_file': 'kmb_pipeline_stats.json',
+    },
+    'upload': {
+        'prefetch': 5,
+        'download_dir': None,  # None for a new temporary directory
+        'log_file': 'kmb_uploading.log',
+    },
+}
+
+
+def merge_settings(custom, defaults=None):
+    """
+    Merge custom settings into the defaults.
+
+    :param custom: dict of settings, e.g. as loaded from a settings file
+    :param defaults: the settings to merge into (defaults to DEFAULTS)
+    :return: dict
+    :raises ValueError: if custom contains an unknown section or key
+    """
+    merged = copy.deepcopy(DEFAULTS if defaults is None else defaults)
+    for section, value in custom.items():
+        if section not in merged:
+            raise ValueError('Unknown settings section: {0}'.format(section))
+        if not isinstance(merged[section], dict):
+            merged[section] = value
+            continue
+        unknown = set(value) - set(merged[section])
+        if unknown:
+            raise ValueError('Unknown settings in {0}: {1}'.format(
+                section, ', '.join(sorted(unknown))))
+        merged[section].update(value)
+    return merged
+
+
+def load_settings(filename=None, required=False):
+    """
+    Load settings from file, on top of the defaults.
+
+    :param filename: the settings file (defaults to SETTINGS_FILE)
+    :param required: whether to fail if the file does not exist, otherwise
+        the defaults are used
+    :return: dict
+    """
+    filename = filename or SETTINGS_FILE
+    custom = {}
+    if required or os.path.exists(filename):
+        custom = common.open_and_read_file(filename, as_json=True)
+    return merge_settings(custom)
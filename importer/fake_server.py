@@ -0,0 +1,373 @@
+#!/usr/bin/python
+# -*- coding: utf-8  -*-
+"""
+Local stand-in for the web services used by the pipeline.
+
+Allows the pipeline to be run, and benchmarked, on a machine without
+network access. The following are served:
+
+/ksamsok/api       K-samsök search pages. The records are copies of those in
+                   a template file (by default tests/data/test_katt.xml),
+                   each given a unique id, up to a configurable total.
+/kmb/<id>          a single K-samsök record, as fetched by kmb_massload.
+/media/<file>      a dummy source image of a configurable size.
+/heritage/api.php  heritage API search results.
+/sparql            SPARQL results, with one column per requested variable,
+                   honouring any LIMIT and OFFSET.
+/w/api.php         minimal MediaWiki API responses for the list=exturlusage,
+                   list=allimages and titles (page existence, every page
+                   exists) queries.
+
+Every response can be delayed, and a fraction of them replaced by an
+error, to test how the pipeline copes with a slow or flaky service.
+
+Note that pywikibot only talks to wikis for which it has a family file, to
+use the MediaWiki API stand-in a family pointing to /w/api.php is needed.
+"""
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import json
+import os
+import random
+import re
+import socketserver
+import sys
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
+
+TEMPLATE_FILE = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'tests', 'data', 'test_katt.xml')
+PORT = 8765
+ID_OFFSET = 99000000000000  # generated ids are obviously not real ones
+RECORD_PATTERN = re.compile(r'<record>.*?</record>', re.DOTALL)
+RDF_PATTERN = re.compile(r'<rdf:RDF .*?</rdf:RDF>', re.DOTALL)
+ID_PATTERN = re.compile(r'<pres:id>(\d+)</pres:id>')
+SELECT_PATTERN = re.compile(r'SELECT\s+(.*?)\s+WHERE', re.DOTALL)
+LIMIT_PATTERN = re.compile(r'\bLIMIT\s+(\d+)', re.I)
+OFFSET_PATTERN = re.compile(r'\bOFFSET\s+(\d+)', re.I)
+SOURCE_IMAGE_PREFIX = 'http://kmb.raa.se/cocoon/bild/raa-image/'
+ENTITY_URL = 'http://www.wikidata.org/entity/'
+
+SEARCH_PAGE = (
+    '<?xml version="1.0" encoding="UTF-8"?>\n'
+    '<result>\n<version>1.0</version>\n<totalHits>{total}</totalHits>\n'
+    '<records>\n{records}\n</records>\n</result>\n')
+
+
+class FakeServiceConfig(object):
+    """The behaviour of the fake services."""
+
+    def __init__(self, template_file=None, total_hits=1000, latency=0.0,
+                 jitter=0.0, error_rate=0.0, error_status=503,
+                 retry_after=None, media_size=100 * 1024, rows=100,
+                 distinct_values=None, language=None, seed=None):
+        """
+        Initialise the configuration.
+
+        :param template_file: K-samsök search result from which the
+            records are taken (defaults to TEMPLATE_FILE)
+        :param total_hits: the number of records returned by any search
+        :param latency: seconds by which every response is delayed
+        :param jitter: maximum number of seconds randomly added to the
+            latency
+        :param error_rate: fraction of the requests answered by an error
+        :param error_status: the http status of the injected errors
+        :param retry_after: the Retry-After header, in seconds, to send
+            along with the injected errors
+        :param media_size: size of the dummy source images, in bytes
+        :param rows: the number of rows in any SPARQL or heritage result
+        :param distinct_values: the number of distinct values in the value
+            column of any SPARQL result, repeating these (defaults to rows)
+        :param language: language tag of the other SPARQL literals, if any
+        :param seed: random seed, for reproducible error injection
+        """
+        template_file = template_file or TEMPLATE_FILE
+        with open(template_file, encoding='utf-8') as f:
+            self.templates = RECORD_PATTERN.findall(f.read())
+        self.total_hits = total_hits
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.retry_after = retry_after
+        self.media_size = media_size
+        self.rows = rows
+        self.distinct_values = distinct_values or rows
+        self.language = language
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def draw(self):
+        """Return a random number in [0, 1)."""
+        with self.lock:
+            return self.random.random()
+
+    def make_record(self, number, base_url):
+        """
+        Produce the record with the given (0-based) number.
+
+        :param number: the number of the record
+        :param base_url: base url of the server, used for the source images
+        :return: str
+        """
+        template = self.templates[number % len(self.templates)]
+        template_id = ID_PATTERN.search(template).group(1)
+        record = template.replace(template_id, make_id(number))
+        return record.replace(
+            SOURCE_IMAGE_PREFIX, '{0}/media/'.format(base_url))
+
+
+def make_id(number):
+    """Return the fake KMB id of the record with the given number."""
+    return str(ID_OFFSET + number)
+
+
+class FakeServiceHandler(BaseHTTPRequestHandler):
+    """Request handler dispatching on the path of the request."""
+
+    def log_message(self, format, *args):
+        """Keep quiet, benchmarks output enough as it is."""
+
+    def do_GET(self):
+        """Answer a request, after any configured delay or error."""
+        config = self.server.config
+        delay = config.latency + config.jitter * config.draw()
+        if delay:
+            time.sleep(delay)
+        if config.error_rate and config.draw() < config.error_rate:
+            headers = {}
+            if config.retry_after is not None:
+                headers['Retry-After'] = str(config.retry_after)
+            return self.respond(
+                'Injected error', 'text/plain', config.error_status, headers)
+
+        url = urlparse(self.path)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        routes = (
+            ('/ksamsok/api', self.ksamsok_search),
+            ('/kmb/', self.kmb_record),
+            ('/media/', self.media),
+            ('/heritage/api.php', self.heritage),
+            ('/sparql', self.sparql),
+            ('/w/api.php', self.mediawiki),
+        )
+        for prefix, handler in routes:
+            if url.path.startswith(prefix):
+                return handler(url.path[len(prefix):], query)
+        self.respond('Not found', 'text/plain', 404)
+
+    def respond(self, body, content_type, status=200, headers=None):
+        """Send a response."""
+        if not isinstance(body, bytes):
+            body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def respond_json(self, data):
+        """Send a json response."""
+        self.respond(json.dumps(data), 'application/json')
+
+    def ksamsok_search(self, path, query):
+        """Serve a page of search results."""
+        config = self.server.config
+        start = int(query.get('startRecord', 1)) - 1
+        end = min(start + int(query.get('hitsPerPage', 500)),
+                  config.total_hits)
+        records = [config.make_record(i, self.server.base_url)
+                   for i in range(start, end)]
+        self.respond(
+            SEARCH_PAGE.format(
+                total=config.total_hits, records='\n'.join(records)),
+            'application/xml')
+
+    def kmb_record(self, path, query):
+        """Serve a single record, as found at its permanent url."""
+        if not path.isdigit() or int(path) < ID_OFFSET:
+            return self.respond('Not found', 'text/plain', 404)
+        record = self.server.config.make_record(
+            int(path) - ID_OFFSET, self.server.base_url)
+        self.respond(
+            '<?xml version="1.0" encoding="UTF-8"?>\n{0}\n'.format(
+                RDF_PATTERN.search(record).group(0)),
+            'application/rdf+xml')
+
+    def media(self, path, query):
+        """Serve a dummy image, its content depending on the path."""
+        seed = path.encode('utf-8')
+        size = self.server.config.media_size
+        body = (seed * (size // max(len(seed), 1) + 1))[:size]
+        self.respond(body, 'image/jpeg')
+
+    def heritage(self, path, query):
+        """Serve heritage search results, continuing until rows run out."""
+        config = self.server.config
+        start = int(query.get('srcontinue', 0))
+        end = min(start + int(query.get('limit', 100)), config.rows)
+        data = {'monuments': [
+            {'id': str(i), 'wd_item': 'Q{0}'.format(i),
+             'commonscat': 'Heritage site {0}'.format(i)}
+            for i in range(start, end)]}
+        if end < config.rows:
+            data['continue'] = {'srcontinue': str(end)}
+        self.respond_json(data)
+
+    def sparql(self, path, query):
+        """Serve SPARQL results for the variables in the SELECT clause."""
+        sparql = query.get('query', '')
+        select = SELECT_PATTERN.search(sparql)
+        labels = select.group(1).replace('?', '').split() if select else []
+        limit = LIMIT_PATTERN.search(sparql)
+        offset = OFFSET_PATTERN.search(sparql)
+        start = int(offset.group(1)) if offset else 0
+        config = self.server.config
+        end = config.rows
+        if limit:
+            end = min(end, start + int(limit.group(1)))
+        bindings = []
+        for i in range(start, end):
+            row = {}
+            for label in labels:
+                if label == 'item':
+                    row[label] = {
+                        'type': 'uri',
+                        'value': '{0}Q{1}'.format(ENTITY_URL, i + 1)}
+                elif label == 'value':
+                    row[label] = {
+                        'type': 'literal',
+                        'value': str(i % config.distinct_values + 1)}
+                else:
+                    row[label] = {
+                        'type': 'literal',
+                        'value': '{0}{1}'.format(label, i + 1)}
+                    if config.language:
+                        row[label]['xml:lang'] = config.language
+            bindings.append(row)
+        self.respond(
+            json.dumps({'head': {'vars': labels},
+                        'results': {'bindings': bindings}}),
+            'application/sparql-results+json')
+
+    def mediawiki(self, path, query):
+        """Serve the few MediaWiki API queries used by the pipeline."""
+        result = {'batchcomplete': '', 'query': {}}
+        if query.get('list') == 'exturlusage':
+            url = query.get('euquery', '')
+            result['query']['exturlusage'] = [
+                {'ns': 6, 'title': 'File:Fake {0}.jpg'.format(i),
+                 'url': '{0}://{1}{2}'.format(
+                     query.get('euprotocol', 'http'), url, make_id(i))}
+                for i in range(self.server.config.rows)]
+        elif query.get('list') == 'allimages':
+            result['query']['allimages'] = []
+        elif query.get('titles'):
+            result['query']['pages'] = {
+                str(i + 1): {'pageid': i + 1, 'ns': 14, 'title': title}
+                for i, title in enumerate(query['titles'].split('|'))}
+        self.respond_json(result)
+
+
+class FakeServer(socketserver.ThreadingMixIn, HTTPServer):
+    """Threaded http server holding the fake service configuration."""
+
+    daemon_threads = True
+
+    def __init__(self, config, port=None, host='127.0.0.1'):
+        """
+        Bind the server.
+
+        :param config: the FakeServiceConfig to serve
+        :param port: the port to listen on, 0 for any free port
+            (defaults to PORT)
+        :param host: the interface to listen on
+        """
+        super(FakeServer, self).__init__(
+            (host, PORT if port is None else port), FakeServiceHandler)
+        self.config = config
+        self.base_url = 'http://{0}:{1}'.format(*self.server_address[:2])
+
+    def endpoints(self):
+        """
+        Return the base urls at which the services are available.
+
+        :return: dict, in the shape of the endpoints section of settings.json
+        """
+        return {
+            'ksamsok': '{0}/ksamsok/api'.format(self.base_url),
+            'kmb_record': '{0}/kmb/{{0}}'.format(self.base_url),
+            'heritage': '{0}/heritage/api.php'.format(self.base_url),
+            'sparql': '{0}/sparql'.format(self.base_url),
+            'sparql_entity': ENTITY_URL,
+        }
+
+    def start(self):
+        """Serve from a daemon thread, call shutdown() to stop."""
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+
+def main(*args):
+    """Command line entry-point."""
+    usage = (
+        'Usage:'
+        '\tpython fake_server.py -port:INT -template:PATH -total_hits:INT '
+        '-latency:FLOAT -jitter:FLOAT -error_rate:FLOAT -error_status:INT '
+        '-retry_after:INT -media_size:INT -rows:INT -distinct_values:INT '
+        '-language:STR -seed:INT\n'
+        '\t-port:INT the port to listen on (defaults to {port})\n'
+        '\t-template:PATH K-samsök search result to take the records from\n'
+        '\t-total_hits:INT the number of records returned by any search\n'
+        '\t-latency:FLOAT seconds by which every response is delayed\n'
+        '\t-jitter:FLOAT maximum number of seconds randomly added to the '
+        'latency\n'
+        '\t-error_rate:FLOAT fraction of the requests answered by an error\n'
+        '\t-error_status:INT the http status of the injected errors\n'
+        '\t-retry_after:INT the Retry-After header of the injected errors\n'
+        '\t-media_size:INT size of the dummy source images, in bytes\n'
+        '\t-rows:INT the number of rows in SPARQL and heritage results\n'
+        '\t-distinct_values:INT the number of distinct values in the value '
+        'column of SPARQL results\n'
+        '\t-language:STR language tag of the other SPARQL literals\n'
+        '\t-seed:INT random seed for reproducible error injection\n'
+    ).format(port=PORT)
+    types = {
+        'template': str, 'total_hits': int, 'latency': float,
+        'jitter': float, 'error_rate': float, 'error_status': int,
+        'retry_after': int, 'media_size': int, 'rows': int,
+        'distinct_values': int, 'language': str, 'seed': int}
+    options = {}
+    port = None
+    for arg in args or sys.argv[1:]:
+        option, sep, value = arg.partition(':')
+        name = option[1:]
+        if name == 'port':
+            port = int(value)
+        elif name in types:
+            options['template_file' if name == 'template' else name] = (
+                types[name](value))
+        else:
+            print(usage)
+            return
+
+    server = FakeServer(FakeServiceConfig(**options), port)
+    print('Serving on {0}, endpoints for settings.json:'.format(
+        server.base_url))
+    print(json.dumps({'endpoints': server.endpoints()}, indent=4))
+    print('MediaWiki API (needs a pywikibot family): {0}/w/api.php'.format(
+        server.base_url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
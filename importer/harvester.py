@@ -6,25 +6,251 @@ Download and process KMB data for one or more keywords.
 Download xml metadata about KMB images, and preprocess it as json files.
 
 Requires a settings.json file containing an API key and a list of keywords.
-Generates one json file per keyword.
+Generates a single json file with the records for all keywords, each parsed
+only once, along with an index of which records matched which keyword.
+
+With -delta only records changed since the last harvest of a keyword are
+requested and merged into the existing data. With -delta:compare all
+records are requested but only those whose change date differs from the
+stored one are parsed.
+
+With -parallel the downloaded pages are handed to a pool of worker
+processes, one per core unless -workers is given, which do the parsing. The
+main process then only does the fetching and merging of results.
 """
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+import os
+import re
 import requests
+import sys
 from xml.dom.minidom import parse, parseString
 import time
 
 import batchupload.common as common
-from importer.kmb_massload import parser
+import importer.config as config
+import importer.profiling as profiling
+from importer.instrumentation import STATS
+from importer.record_parser import (
+    cache_counters, parser, postprocess_columns, prescreen_license,
+    resolve_fields)
+
+SETTINGS = config.SETTINGS_FILE
+KSAMSOK_API = config.DEFAULTS['endpoints']['ksamsok']
+THROTTLE = config.DEFAULTS['throttle']['delay']  # initial delay, in seconds
+HITS_LIMIT = config.DEFAULTS['throttle']['page_size']  # initial page size
+MAX_RETRIES = config.DEFAULTS['throttle']['max_retries']
+LOGFILE = config.DEFAULTS['harvest']['log_file']
+STATS_FILE = config.DEFAULTS['harvest']['stats_file']
+OUTPUT_FILE = config.DEFAULTS['harvest']['data_file']
+KEYWORD_INDEX_FILE = config.DEFAULTS['harvest']['index_file']
+TOTAL_HITS_PATTERN = re.compile(r'<totalHits>(\d+)</totalHits>')
+
+# the outcome of parse_page(), see there
+ParsedPage = namedtuple(
+    'ParsedPage',
+    ('records', 'ids', 'messages', 'duration', 'counters', 'rejects'))
+
+
+class BufferedLog(object):
+    """Stand-in for LogFile collecting messages for writing elsewhere."""
+
+    def __init__(self):
+        """Initialise an empty buffer."""
+        self.messages = []
+
+    def write(self, text):
+        """Store a message."""
+        self.messages.append(text)
+
+
+class ThrottleController(object):
+    """
+    Adapt page size and delay between requests to how the API responds.
+
+    Quick and small responses let the delay shrink and the page size grow,
+    slow or large responses shrink the page size and errors (including
+    429/5xx) double the delay and halve the page size. All values are kept
+    within the given bounds.
+    """
 
-SETTINGS = "settings.json"
-THROTTLE = 0.5
-LOGFILE = 'kmb_massloading.log'
-OUTPUT_FILE = 'kmb_data.json'
+    def __init__(self, page_size=HITS_LIMIT, min_page_size=50,
+                 max_page_size=HITS_LIMIT, page_step=50, delay=THROTTLE,
+                 min_delay=0.1, max_delay=60.0, target_latency=5.0,
+                 max_page_bytes=20 * 1024 * 1024, max_retries=MAX_RETRIES,
+                 log=None):
+        """
+        Initialise the controller.
+
+        :param page_size: initial number of hits per page
+        :param min_page_size: smallest allowed page size
+        :param max_page_size: largest allowed page size
+        :param page_step: how much to grow the page size by at a time
+        :param delay: initial delay between requests, in seconds
+        :param min_delay: smallest allowed delay
+        :param max_delay: largest allowed delay
+        :param target_latency: response time, in seconds, above which the
+            API is considered to be struggling
+        :param max_page_bytes: response size above which the page size is
+            reduced
+        :param max_retries: the number of times a failed request is
+            retried before giving up
+        :param log: log to which any changes in the settings are written
+        """
+        self.page_size = page_size
+        self.min_page_size = min_page_size
+        self.max_page_size = max_page_size
+        self.page_step = page_step
+        self.delay = delay
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.target_latency = target_latency
+        self.max_page_bytes = max_page_bytes
+        self.max_retries = max_retries
+        self.log = log
+
+    def _set(self, page_size, delay, reason):
+        """Update the settings, within bounds, and log any change."""
+        page_size = int(min(self.max_page_size,
+                            max(self.min_page_size, page_size)))
+        delay = min(self.max_delay, max(self.min_delay, delay))
+        if (page_size, delay) == (self.page_size, self.delay):
+            return
+        self.page_size = page_size
+        self.delay = delay
+        if self.log:
+            self.log.write(
+                'Throttle: page size {0:d}, delay {1:.2f}s ({2})'.format(
+                    page_size, delay, reason))
+
+    def record_success(self, latency, size):
+        """
+        Adapt to a successful response.
+
+        :param latency: the response time in seconds
+        :param size: the size of the response in bytes
+        """
+        if latency > self.target_latency:
+            self._set(self.page_size // 2, self.delay * 1.5,
+                      'slow response: {0:.1f}s'.format(latency))
+        elif size > self.max_page_bytes:
+            self._set(self.page_size // 2, self.delay,
+                      'large response: {0:d} bytes'.format(size))
+        else:
+            self._set(self.page_size + self.page_step, self.delay * 0.8,
+                      'quick response: {0:.1f}s'.format(latency))
+
+    def record_failure(self, error):
+        """
+        Adapt to a failed request.
+
+        :param error: the requests.RequestException which was raised
+        """
+        delay = max(self.delay * 2, self.min_delay)
+        response = getattr(error, 'response', None)
+        if response is not None and response.status_code == 429:
+            retry_after = response.headers.get('Retry-After', '')
+            if retry_after.isdigit():
+                delay = max(delay, int(retry_after))
+        self._set(self.page_size // 2, delay, 'error: {0}'.format(error))
+
+    def wait(self):
+        """Sleep for the current delay."""
+        time.sleep(self.delay)
+
+
+class HarvestStore(object):
+    """
+    Store of parsed records, keyed by id and shared between all keywords.
+
+    Alongside the records an index is kept of the ids matching each keyword
+    and the date of the last successful harvest of each keyword. Records
+    from earlier runs are kept but each record is re-parsed the first time
+    it is encountered during a run, unless it is known to be unchanged.
+    """
+
+    def __init__(self, data_file=None, index_file=None):
+        """
+        Load any previously stored records and keyword index.
+
+        :param data_file: the file in which records are stored
+            (defaults to OUTPUT_FILE)
+        :param index_file: the file in which the keyword index is stored
+            (defaults to KEYWORD_INDEX_FILE)
+        """
+        self.data_file = data_file or OUTPUT_FILE
+        self.index_file = index_file or KEYWORD_INDEX_FILE
+        self.records = {}
+        self.keywords = {}  # keyword: {'ids': list, 'last_harvest': date}
+        if os.path.exists(self.data_file):
+            self.records = common.open_and_read_file(
+                self.data_file, as_json=True)
+        if os.path.exists(self.index_file):
+            self.keywords = common.open_and_read_file(
+                self.index_file, as_json=True)
+        self.current = set()  # ids parsed, or found unchanged, in this run
+        self.updated = set()  # ids parsed in this run
+
+    def add(self, id_no, record):
+        """Add, or replace, a record parsed during this run."""
+        self.records[id_no] = record
+        self.current.add(id_no)
+        self.updated.add(id_no)
+
+    def remove(self, id_no):
+        """Remove a record, also from the ids of every keyword."""
+        self.records.pop(id_no, None)
+        for entry in self.keywords.values():
+            if id_no in entry.get('ids', []):
+                entry['ids'].remove(id_no)
+
+    def set_keyword_ids(self, keyword, ids):
+        """Set the ids of the records matching a keyword."""
+        self.keywords.setdefault(keyword, {})['ids'] = sorted(set(ids))
+
+    def get_keyword_ids(self, keyword):
+        """Get the ids of the records matching a keyword."""
+        return self.keywords.get(keyword, {}).get('ids', [])
+
+    def set_last_harvest(self, keyword, date):
+        """Set the date of the last successful harvest of a keyword."""
+        self.keywords.setdefault(keyword, {})['last_harvest'] = date
+
+    def get_last_harvest(self, keyword):
+        """Get the date of the last successful harvest of a keyword."""
+        return self.keywords.get(keyword, {}).get('last_harvest')
+
+    def get_change_dates(self):
+        """Get the stored change date of each record, where known."""
+        return {id_no: record['lastChanged']
+                for id_no, record in self.records.items()
+                if record.get('lastChanged')}
+
+    def get_keyword_records(self, keywords=None):
+        """
+        Get the union of the records matching the given keywords.
+
+        Keywords which were never harvested, and ids of records no longer
+        in the store, are skipped.
+
+        :param keywords: list of keywords (defaults to all in the index)
+        :return: dict of records keyed by id
+        """
+        keywords = keywords or self.keywords.keys()
+        return {id_no: self.records[id_no]
+                for keyword in keywords
+                for id_no in self.get_keyword_ids(keyword)
+                if id_no in self.records}
+
+    def save(self):
+        """Store the records and the keyword index as json."""
+        save_data(self.records, self.data_file)
+        save_data(self.keywords, self.index_file)
 
 
 def load_settings(filename=None):
-    """Load settings from file."""
-    filename = filename or SETTINGS
-    return common.open_and_read_file(filename, as_json=True)
+    """Load settings from file, on top of the defaults in config."""
+    return config.load_settings(filename or SETTINGS, required=True)
 
 
 def save_data(data, filename=None):
@@ -34,7 +260,8 @@ def save_data(data, filename=None):
     print("Saved file: {}.".format(filename))
 
 
-def create_url(keyword, hits_limit, start_record, api_key):
+def create_url(keyword, hits_limit, start_record, api_key,
+               changed_since=None, api_url=None):
     """
     Create url from which to download image metadata.
 
@@ -42,17 +269,24 @@ def create_url(keyword, hits_limit, start_record, api_key):
     :param hits_limit: how many hits per page
     :param start_record: from which item to start
     :param api_key: key to access API
+    :param changed_since: only include records changed on or after this
+        date (YYYY-MM-DD)
+    :param api_url: base url of the K-samsök API (defaults to KSAMSOK_API)
     :return: str
     """
     keyword = requests.utils.quote(keyword)
-    url_base = ("http://kulturarvsdata.se/ksamsok/api?x-api={api_key}"
+    if changed_since:
+        keyword += requests.utils.quote(
+            ' and lastChangedDate>={0}'.format(changed_since))
+    url_base = ("{api_url}?x-api={api_key}"
                 "&method=search&hitsPerPage={hits_limit}"
                 "&startRecord={start_record}"
                 "&query=serviceOrganization=RA%C3%84%20"
                 "and%20serviceName=KMB%20"
                 "and%20itemType=foto%20and%20mediaLicense=*%20"
                 "and%20text={keyword}")
-    return url_base.format(api_key=api_key,
+    return url_base.format(api_url=api_url or KSAMSOK_API,
+                           api_key=api_key,
                            hits_limit=hits_limit,
                            start_record=start_record,
                            keyword=keyword)
@@ -63,16 +297,125 @@ def split_records(dom):
     return dom.getElementsByTagName("record")
 
 
-def parse_record(dom, record_dict, log):
+def parse_record(dom, record_dict, log, fields=None, postprocess=True):
     """Parse and process the xml metadata into a dict."""
-    return parser(dom, record_dict, log)
+    return parser(dom, record_dict, log, fields, postprocess)
+
+
+def fetch_page(url):
+    """Download raw xml metadata from url."""
+    with requests.get(url) as response:
+        response.raise_for_status()
+        return response.text
+
+
+def is_transient(error):
+    """
+    Check if a failed request is worth retrying.
+
+    Connection errors, timeouts, 429 and 5xx responses may succeed on a
+    retry whereas e.g. 400, 401, 403 and 404 responses never will.
+
+    :param error: the requests.RequestException which was raised
+    :return: bool
+    """
+    response = getattr(error, 'response', None)
+    if response is None:
+        return True
+    return response.status_code == 429 or response.status_code >= 500
+
+
+def fetch_page_throttled(url, controller):
+    """
+    Download raw xml metadata from url, adapting to the API's response.
+
+    A request failing for a transient reason, see is_transient(), is
+    retried, after the controller's delay, up to controller.max_retries
+    times. Any other failure is raised at once.
+
+    :param url: the url to download
+    :param controller: the ThrottleController to report the outcome to
+    :return: str
+    :raises requests.RequestException: if the request failed for good
+    """
+    for attempt in range(controller.max_retries + 1):
+        start = time.time()
+        try:
+            source = fetch_page(url)
+        except requests.RequestException as e:
+            STATS.count('fetch.errors')
+            if not is_transient(e):
+                raise
+            controller.record_failure(e)
+            if attempt == controller.max_retries:
+                raise
+            STATS.count('fetch.retries')
+            controller.wait()
+        else:
+            latency = time.time() - start
+            STATS.add_time('fetch', latency)
+            STATS.count('fetch.bytes', len(source))
+            controller.record_success(latency, len(source))
+            return source
 
 
 def get_records_from_url(url):
     """Download xml metadata from url."""
-    with requests.get(url) as response:
-        source = response.text
-    return parseString(source)
+    return parseString(fetch_page(url))
+
+
+def parse_page(source, fields=None, skip=None, columnar=False,
+               prescreen=False):
+    """
+    Parse and process all of the records in a page of raw xml metadata.
+
+    This is the unit of work handed to the worker processes so it only
+    takes and returns picklable data. Any log messages are returned for the
+    main process to write.
+
+    :param source: the raw xml for a page of search results
+    :param fields: the fields to extract, see record_parser.resolve_fields()
+    :param skip: dict of ids which should not be parsed. If the value is a
+        change date the record is only skipped if its change date matches.
+    :param columnar: whether to post-process all of the records on the page
+        at once, see record_parser.postprocess_columns()
+    :param prescreen: whether to reject records without a free license
+        before parsing them, see record_parser.prescreen_license()
+    :return: ParsedPage of the dict of processed records keyed by id, the
+        list of all ids on the page, the list of log messages, the time
+        taken to parse the page, the counters (of cache hits) to add to
+        the run stats and the dict of (license, copyright) of the rejected
+        records keyed by id
+    """
+    start = time.time()
+    caches_before = cache_counters()
+    log = BufferedLog()
+    skip = skip or {}
+    results = {}
+    rejects = {}
+    ids = []
+    for record in split_records(parseString(source)):
+        id_no = extract_id_number(record)
+        ids.append(id_no)
+        if id_no in results:
+            continue
+        if id_no in skip and (skip[id_no] is None or
+                              skip[id_no] == extract_last_changed(record)):
+            continue
+        if prescreen:
+            rejected = prescreen_license(record)
+            if rejected:
+                rejects[id_no] = rejected
+                continue
+        processed_dict = {'ID': id_no, 'problem': []}
+        results[id_no] = parse_record(
+            record, processed_dict, log, fields, postprocess=not columnar)
+    if columnar:
+        postprocess_columns(results.values(), fields)
+    counters = {name: value - caches_before[name]
+                for name, value in cache_counters().items()}
+    return ParsedPage(
+        results, ids, log.messages, time.time() - start, counters, rejects)
 
 
 def get_records_from_file(filename):
@@ -92,6 +435,16 @@ def get_total_hits(records_blob):
     return int(hits_tag.firstChild.nodeValue)
 
 
+def get_total_hits_from_source(source):
+    """
+    Extract total number of hits from raw xml metadata, without parsing it.
+
+    :param source: the raw xml for a search result
+    :return: int
+    """
+    return int(TOTAL_HITS_PATTERN.search(source).group(1))
+
+
 def extract_id_number(record_blob):
     """
     Get ID number from unprocessed xml record.
@@ -103,45 +456,280 @@ def extract_id_number(record_blob):
     return id_tag.firstChild.nodeValue
 
 
-def get_data():
-    """Get parsed data for given keywords and store as json files."""
-    log = common.LogFile('', LOGFILE)
-    settings = load_settings()
+def extract_last_changed(record_blob):
+    """
+    Get the date of the last change from unprocessed xml record.
+
+    :param record_blob: a single xml record for a search hit
+    :return: str or None
+    """
+    date_tag = record_blob.getElementsByTagName('ns5:lastChangedDate')
+    if date_tag and date_tag[0].firstChild:
+        return date_tag[0].firstChild.nodeValue
+
+
+def get_keyword_data(keyword, api_key, log, store, executor=None,
+                     max_pending=1, fields=None, delta=None, controller=None,
+                     api_url=None, columnar=False, rejects=None):
+    """
+    Get parsed data for a single keyword and add it to the store.
+
+    Pages are fetched one at a time. If an executor is provided the parsing
+    of each page is handed to it while the next page is being fetched,
+    otherwise the page is parsed directly. Records already parsed during
+    this run, e.g. for an earlier keyword, are not parsed again.
+
+    The delta modes only work on top of an earlier harvest. With 'query'
+    only records changed since the last harvest of the keyword are
+    requested, with 'compare' all records are requested but only those
+    with a new change date are parsed.
+
+    :param keyword: keyword to search for
+    :param api_key: key to access API
+    :param log: log to write to
+    :param store: the HarvestStore to add the records to
+    :param executor: concurrent.futures.Executor to parse pages in
+    :param max_pending: the number of pages which may be waiting for, or
+        undergoing, parsing before fetching pauses
+    :param fields: the fields to extract, see record_parser.resolve_fields()
+    :param delta: None for a full harvest, else 'query' or 'compare'
+    :param controller: the ThrottleController deciding the page size and
+        delay between requests
+    :param api_url: base url of the K-samsök API, see create_url()
+    :param columnar: whether to post-process each page at once, see
+        parse_page()
+    :param rejects: log to which records without a free license are
+        written, instead of being parsed and stored. If not provided all
+        records are parsed.
+    :return: list of ids matching the keyword, excluding rejected ones
+    """
+    controller = controller or ThrottleController(log=log)
+    keyword_ids = []
+    start_at = 1
+    total_results = None
+    pending = []  # pages being parsed, in order
+    changed_since = None
+    skip = {}
+    if delta == 'query':
+        changed_since = store.get_last_harvest(keyword)
+        keyword_ids.extend(store.get_keyword_ids(keyword))
+    elif delta == 'compare':
+        skip = store.get_change_dates()
+    skip.update(dict.fromkeys(store.current))
+
+    counter = 0
+
+    def merge_page(page):
+        nonlocal counter
+        STATS.add_time('parse', page.duration)
+        STATS.count('parse.records', len(page.records))
+        STATS.count('parse.skipped', len(page.ids) - len(page.records))
+        for name, value in page.counters.items():
+            STATS.count(name, value)
+        for message in page.messages:
+            log.write(message)
+        STATS.count('parse.rejected', len(page.rejects))
+        for id_no, (license, copyright) in page.rejects.items():
+            rejects.write('{0}\t{1}\t{2}'.format(id_no, license, copyright))
+            store.remove(id_no)  # stored by an earlier harvest
+        keyword_ids.extend(
+            id_no for id_no in page.ids if id_no not in page.rejects)
+        for id_no, processed_record in page.records.items():
+            if id_no not in store.current:
+                store.add(id_no, processed_record)
+        store.current.update(page.ids)
+        if (counter + len(page.ids)) // 100 > counter // 100:
+            print("Processed {} out of {}".format(
+                counter + len(page.ids), total_results))
+        counter += len(page.ids)
+
+    while total_results is None or start_at <= total_results:
+        hits_limit = controller.page_size
+        url = create_url(
+            keyword, hits_limit, start_at, api_key, changed_since, api_url)
+        source = fetch_page_throttled(url, controller)
+        if total_results is None:
+            total_results = get_total_hits_from_source(source)
+        prescreen = rejects is not None
+        if executor:
+            pending.append(executor.submit(
+                parse_page, source, fields, skip, columnar, prescreen))
+            while len(pending) >= max_pending or (
+                    pending and pending[0].done()):
+                merge_page(pending.pop(0).result())
+        else:
+            merge_page(parse_page(source, fields, skip, columnar, prescreen))
+        start_at += hits_limit
+        controller.wait()
+
+    for future in pending:
+        merge_page(future.result())
+    if delta == 'query':
+        # the carried over ids include any record rejected in this run
+        keyword_ids = [id_no for id_no in keyword_ids
+                       if id_no in store.records]
+    return keyword_ids
+
+
+def get_data(workers=None, fields=None, delta=None, stats_interval=None,
+             settings=None, columnar=None):
+    """
+    Get parsed data for given keywords and store as json.
+
+    :param workers: number of worker processes in which to parse the
+        data, 0 for one per core. If neither this nor the workers setting
+        is provided pages are parsed in the main process.
+    :param fields: the fields to extract, see record_parser.resolve_fields().
+        Defaults to all fields.
+    :param delta: None for a full harvest, else 'query' or 'compare', see
+        get_keyword_data()
+    :param stats_interval: if provided the run stats are also written to
+        the stats file at this interval, in seconds, during the run
+    :param settings: the settings, see config (defaults to those loaded
+        from SETTINGS)
+    :param columnar: whether to post-process each page at once, see
+        parse_page() (defaults to the columnar setting)
+    """
+    settings = settings or load_settings()
+    harvest_settings = settings['harvest']
+    stats_file = harvest_settings['stats_file']
+    STATS.reset()
+    if stats_interval:
+        STATS.enable_snapshots(stats_file, stats_interval)
+    store = HarvestStore(
+        harvest_settings['data_file'], harvest_settings['index_file'])
+    try:
+        harvest(store, settings, workers, fields, delta, columnar)
+    finally:
+        STATS.dump(stats_file)
+        print("Cache hit rates: {}.".format(STATS.summary()['hit_rates']))
+        print("Run stats saved to {}.".format(stats_file))
+
+
+def harvest(store, settings, workers=None, fields=None, delta=None,
+            columnar=None):
+    """
+    Harvest the records of all keywords into a store.
+
+    The store is saved after each keyword.
+
+    :param store: the HarvestStore to add the records to
+    :param settings: the settings, see config
+    :param workers: see get_data()
+    :param fields: see get_data()
+    :param delta: see get_data()
+    :param columnar: see get_data()
+    """
+    harvest_settings = settings['harvest']
+    fields = resolve_fields(fields)
+    if fields is not None and delta:
+        fields = fields | {'lastChanged'}  # needed for the next delta
+    log = common.LogFile('', harvest_settings['log_file'])
     keywords = settings["keywords"]
     api_key = settings["api_key"]
-    for keyword in keywords:
-        print("[{}] : fetching data.".format(keyword))
-        filename = "results_{0}.json".format(keyword)
-        results = {}
-        hits_limit = 500
-        start_at = 1
-        counter = 0
-        while True:
-            url = create_url(keyword, hits_limit, start_at, api_key)
-            records = get_records_from_url(url)
-            total_results = get_total_hits(records)
-            records = split_records(records)
-            records_on_page = len(records)
-            if records_on_page == 0:
-                break
-            else:
-                for record in records:
-                    counter += 1
-                    id_no = extract_id_number(record)
-                    processed_dict = {'ID': id_no, 'problem': []}
-                    processed_record = parse_record(
-                        record, processed_dict, log)
-                    if id_no not in results:
-                        results[id_no] = processed_record
-                    if counter % 100 == 0:
-                        print("Processed {} out of {}".format(
-                            counter, total_results))
-                start_at += hits_limit
-                time.sleep(THROTTLE)
-        print("[{}] : fetched {} records to {}.".format(
-            keyword, len(results), filename))
-        save_data(results, filename)
+    api_url = settings['endpoints']['ksamsok']
+    controller = ThrottleController(log=log, **settings['throttle'])
+    rejects = None
+    if harvest_settings['prescreen']:
+        rejects = common.LogFile('', harvest_settings['rejects_file'])
+    executor = None
+    if workers is None:
+        workers = harvest_settings['workers']
+    if columnar is None:
+        columnar = harvest_settings['columnar']
+    if workers is not None:
+        workers = workers or os.cpu_count()
+        executor = ProcessPoolExecutor(max_workers=workers)
+    try:
+        for keyword in keywords:
+            print("[{}] : fetching data.".format(keyword))
+            harvest_date = time.strftime('%Y-%m-%d')
+            parsed_before = len(store.updated)
+            keyword_ids = get_keyword_data(
+                keyword, api_key, log, store, executor, 2 * (workers or 1),
+                fields, delta, controller, api_url, columnar, rejects)
+            store.set_keyword_ids(keyword, keyword_ids)
+            store.set_last_harvest(keyword, harvest_date)
+            print("[{}] : fetched {} records ({} parsed) to {}.".format(
+                keyword, len(set(keyword_ids)),
+                len(store.updated) - parsed_before, store.data_file))
+            print("[{}] : ended with page size {} and delay {:.2f}s.".format(
+                keyword, controller.page_size, controller.delay))
+            store.save()
+    finally:
+        if executor:
+            executor.shutdown()
+        if rejects is not None:
+            print(rejects.close_and_confirm())
+
+
+def main(*args):
+    """Command line entry-point."""
+    usage = (
+        'Usage:'
+        '\tpython harvester.py -parallel -workers:INT -fields:STR '
+        '-delta:STR -stats_interval:INT -profile:PATH -settings:PATH '
+        '-columnar -prescreen\n'
+        '\t-parallel parse the data in separate worker processes (one per '
+        'core)\n'
+        '\t-workers:INT the number of worker processes to use (implies '
+        '-parallel)\n'
+        '\t-fields:STR the fields to extract, either a comma separated list '
+        'or the name of a projection, e.g. "license" (defaults to all)\n'
+        '\t-delta:STR only fetch records changed since the last harvest '
+        '("query", the default) or only parse those with a new change date '
+        '("compare")\n'
+        '\t-stats_interval:INT also save the run stats every INT seconds '
+        'during the run\n'
+        '\t-profile:PATH run under the profiler, saving the stats to PATH '
+        'and reporting the hot functions per stage\n'
+        '\t-settings:PATH the settings file to use (defaults to {0})\n'
+        '\t-columnar post-process each page at once, rather than one record '
+        'at a time\n'
+        '\t-prescreen reject records without a free license before parsing '
+        'them, listing them in the rejects file\n'
+    ).format(SETTINGS)
+    workers = None
+    fields = None
+    delta = None
+    stats_interval = None
+    profile = None
+    settings_file = None
+    columnar = None
+    prescreen = False
+    for arg in args or sys.argv[1:]:
+        option, sep, value = arg.partition(':')
+        if option == '-parallel':
+            workers = workers or 0
+        elif option == '-workers':
+            workers = int(value)
+        elif option == '-fields':
+            fields = value
+        elif option == '-delta' and value in ('', 'query', 'compare'):
+            delta = value or 'query'
+        elif option == '-stats_interval':
+            stats_interval = int(value)
+        elif option == '-profile':
+            profile = value
+        elif option == '-settings':
+            settings_file = value
+        elif option == '-columnar':
+            columnar = True
+        elif option == '-prescreen':
+            prescreen = True
+        else:
+            print(usage)
+            return
+    settings = load_settings(settings_file)
+    if prescreen:
+        settings['harvest']['prescreen'] = True
+    if profile:
+        profiling.run_profiled(
+            profile, get_data, workers, fields, delta, stats_interval,
+            settings, columnar)
+    else:
+        get_data(workers, fields, delta, stats_interval, settings, columnar)
 
 
 if __name__ == "__main__":
-    get_data()
+    main()
@@ -0,0 +1,141 @@
+#!/usr/bin/python
+# -*- coding: utf-8  -*-
+"""
+Lightweight timers and counters for the stages of the KMB pipeline.
+
+All stats are collected in the module level STATS so that any stage can
+report to it without a stats object having to be passed around. At the
+end of a run the summary is dumped as json, optionally with periodic
+snapshots of it being written during the run.
+
+Worker processes have their own STATS, anything measured there needs to
+be passed back to, and recorded in, the main process.
+"""
+from contextlib import contextmanager
+from functools import wraps
+import json
+import threading
+import time
+
+
+class Stats(object):
+    """Collection of named timers and counters."""
+
+    def __init__(self):
+        """Initialise an empty collection."""
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Clear all timers and counters and restart the clock."""
+        with self.lock:
+            self.started = time.time()
+            self.counters = {}
+            self.timers = {}  # name: [calls, total time, max time]
+            self.snapshot_file = None
+            self.snapshot_interval = None
+            self.last_snapshot = self.started
+
+    def count(self, name, value=1):
+        """
+        Increase a counter.
+
+        :param name: name of the counter
+        :param value: amount to increase it by
+        """
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+        self.maybe_snapshot()
+
+    def add_time(self, name, seconds):
+        """
+        Record a single timing for a timer.
+
+        :param name: name of the timer
+        :param seconds: the time taken
+        """
+        with self.lock:
+            timer = self.timers.setdefault(name, [0, 0.0, 0.0])
+            timer[0] += 1
+            timer[1] += seconds
+            timer[2] = max(timer[2], seconds)
+        self.maybe_snapshot()
+
+    @contextmanager
+    def timer(self, name):
+        """Context manager timing the enclosed block."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.time() - start)
+
+    def timed(self, name):
+        """Decorator timing every call to a function."""
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.timer(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def summary(self):
+        """
+        Produce a machine readable summary of all timers and counters.
+
+        The hit rates of any caches, with NAME.hits and NAME.misses
+        counters, are also included.
+
+        :return: dict
+        """
+        with self.lock:
+            timers = {}
+            for name, (calls, total, longest) in self.timers.items():
+                timers[name] = {
+                    'calls': calls,
+                    'total': round(total, 6),
+                    'mean': round(total / calls, 6),
+                    'max': round(longest, 6)}
+            hit_rates = {}
+            for name, hits in self.counters.items():
+                if not name.endswith('.hits'):
+                    continue
+                name = name[:-len('.hits')]
+                lookups = hits + self.counters.get(name + '.misses', 0)
+                if lookups:
+                    hit_rates[name] = round(hits / lookups, 3)
+            return {
+                'elapsed': round(time.time() - self.started, 3),
+                'timers': timers,
+                'counters': dict(self.counters),
+                'hit_rates': hit_rates}
+
+    def dump(self, filename):
+        """Write the summary as json."""
+        with open(filename, 'w', encoding='utf-8') as f:
+            json.dump(self.summary(), f, indent=4, sort_keys=True)
+
+    def enable_snapshots(self, filename, interval):
+        """
+        Periodically write the summary during the run.
+
+        :param filename: the file to write the summary to
+        :param interval: minimum number of seconds between snapshots
+        """
+        self.snapshot_file = filename
+        self.snapshot_interval = interval
+
+    def maybe_snapshot(self):
+        """Write a snapshot if enabled and the interval has passed."""
+        if not self.snapshot_interval:
+            return
+        now = time.time()
+        if now - self.last_snapshot < self.snapshot_interval:
+            return
+        self.last_snapshot = now
+        self.dump(self.snapshot_file)
+
+
+STATS = Stats()
+timed = STATS.timed
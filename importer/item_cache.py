@@ -0,0 +1,120 @@
+#!/usr/bin/python
+# -*- coding: utf-8  -*-
+"""
+On disk cache of the make_KMB_info output of each item.
+
+An item's output (description template, filename and categories) only
+depends on its record and on the mappings it read while being processed.
+The output is therefore stored under a hash of the record, together with
+the versions of those mappings, and reused on a rerun for as long as all of
+them are unchanged. After a mapping fix only the items which read that
+mapping are recomputed.
+
+The key also includes the version of the code producing the output, see
+code_version(), so that any change to it, e.g. a category or template fix,
+invalidates all of the cached output. Live lookups on Commons, such as
+whether a guessed category exists, are not part of the key. Delete the
+cache directory to recompute everything.
+"""
+import hashlib
+import json
+import os
+
+import batchupload.common as common
+
+
+def item_key(record, *context):
+    """
+    Create the cache key of an item.
+
+    :param record: the record of the item, as loaded from the data file
+    :param context: any other json serialisable values the output depends
+        on, e.g. the batch category
+    :return: str
+    """
+    return hashlib.sha1(json.dumps(
+        [record, context], sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def file_version(filename):
+    """
+    Return the version of a file, as a hash of its contents.
+
+    :param filename: path to the file
+    :return: str or None if the file does not exist
+    """
+    if not os.path.exists(filename):
+        return None
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def code_version(*filenames):
+    """
+    Return the version of the code producing the output.
+
+    :param filenames: paths to the source files of the code
+    :return: str
+    """
+    return hashlib.sha1(json.dumps(
+        [file_version(filename) for filename in filenames]).encode(
+            'utf-8')).hexdigest()
+
+
+class ItemCache(object):
+    """Item outputs stored as one json file per item key."""
+
+    def __init__(self, cache_dir):
+        """
+        Initialise the cache.
+
+        :param cache_dir: the cache directory, created when first written to
+        """
+        self.cache_dir = cache_dir
+
+    def filename(self, key):
+        """Return the path to the file of an item key."""
+        return os.path.join(self.cache_dir, key[:2], '{0}.json'.format(key))
+
+    def get(self, key, version):
+        """
+        Return the cached output of an item, if still valid.
+
+        :param key: the item key, see item_key()
+        :param version: function returning the current version of a mapping
+            given its name, raising KeyError for an unknown mapping
+        :return: the output or None
+        """
+        filename = self.filename(key)
+        if not os.path.exists(filename):
+            return None
+        entry = common.open_and_read_file(filename, as_json=True)
+        try:
+            if any(version(name) != value
+                   for name, value in entry['mappings'].items()):
+                return None
+        except KeyError:
+            return None
+        return entry['output']
+
+    def put(self, key, versions, output):
+        """
+        Store the output of an item.
+
+        Nothing is stored if any of the versions is unknown (None).
+
+        :param key: the item key, see item_key()
+        :param versions: dict of the name and version of each mapping read
+        :param output: the json serialisable output
+        :return: bool whether the output was stored
+        """
+        if None in versions.values():
+            return False
+        filename = self.filename(key)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        common.open_and_write_file(
+            filename, {'mappings': versions, 'output': output}, as_json=True)
+        return True
@@ -0,0 +1,124 @@
+#!/usr/bin/python
+# -*- coding: utf-8  -*-
+"""
+Mappings which are only loaded, or updated, the first time they are used.
+
+Many runs never reach the parts of the processing needing some of the
+mappings, e.g. the church mapping is only used for images of churches.
+Loading lazily means such runs never pay for those mappings, and keeping
+track of what was loaded shows which mappings a run actually needed.
+
+Each mapping may also have a version, e.g. a hash of its file, so that
+anything derived from the mappings read (see LazyMappings.read) can later be
+checked against the current versions, see item_cache.
+"""
+from importer.instrumentation import STATS
+
+
+class MappingLoadError(Exception):
+    """Raised when a mapping could not be loaded, or updated."""
+
+
+class LazyMappings(dict):
+    """
+    Dict of mappings, each loaded the first time it is looked up.
+
+    Each mapping is registered together with a loader, a function taking no
+    arguments and returning the mapping, and optionally a versioner, a
+    function taking no arguments and returning the version of the mapping.
+    """
+
+    def __init__(self):
+        """Initialise without any registered mappings."""
+        super(LazyMappings, self).__init__()
+        self.loaders = {}
+        self.versioners = {}
+        self.load_first = {}  # whether to load before taking the version
+        self.versions = {}  # versions of the loaded mappings
+        self.touched = []  # names of the loaded mappings, in load order
+        self.read = set()  # names of the mappings looked up, see reset_read()
+
+    def register(self, name, loader, versioner=None, load_first=False):
+        """
+        Register a mapping, replacing any previously loaded one.
+
+        :param name: the name of the mapping
+        :param loader: function without arguments returning the mapping
+        :param versioner: function without arguments returning the version
+            of the mapping
+        :param load_first: whether the mapping must be loaded before its
+            version is taken, e.g. as loading it first updates it
+        """
+        self.loaders[name] = loader
+        self.versioners[name] = versioner
+        self.load_first[name] = load_first
+        self.pop(name, None)
+        self.versions.pop(name, None)
+        if name in self.touched:
+            self.touched.remove(name)
+
+    def __getitem__(self, name):
+        """Return a mapping, loading it if needed, and note it as read."""
+        if name in self.loaders:
+            self.read.add(name)
+        return super(LazyMappings, self).__getitem__(name)
+
+    def __missing__(self, name):
+        """
+        Load a registered mapping which has not yet been loaded.
+
+        :raises KeyError: if the mapping is not registered
+        :raises MappingLoadError: if the loader failed
+        """
+        if name not in self.loaders:
+            raise KeyError(name)
+        with STATS.timer('load_mapping.{0}'.format(name)):
+            try:
+                mapping = self.loaders[name]()
+            except Exception as e:
+                raise MappingLoadError(
+                    'Could not load the {0} mapping: {1}: {2}'.format(
+                        name, type(e).__name__, e)) from e
+        self[name] = mapping
+        self.touched.append(name)
+        return mapping
+
+    def __contains__(self, name):
+        """Check if a mapping is registered, whether loaded or not."""
+        return name in self.loaders or super(
+            LazyMappings, self).__contains__(name)
+
+    def get(self, name, default=None):
+        """Return a mapping, loading it if needed, or the default."""
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def reset_read(self):
+        """Forget which mappings have been looked up."""
+        self.read = set()
+
+    def version(self, name):
+        """
+        Return the version of a mapping.
+
+        The mapping is only loaded if it was registered with load_first.
+        Looking up the version does not count as reading the mapping.
+
+        :param name: the name of the mapping
+        :return: the version, or None if the mapping has no versioner
+        :raises KeyError: if the mapping is not registered
+        """
+        if name not in self.versions:
+            if name not in self.loaders:
+                raise KeyError(name)
+            if self.load_first[name]:
+                super(LazyMappings, self).__getitem__(name)
+            versioner = self.versioners[name]
+            self.versions[name] = versioner() if versioner else None
+        return self.versions[name]
+
+    def untouched(self):
+        """Return the names of the registered mappings never loaded."""
+        return sorted(set(self.loaders) - set(self.touched))
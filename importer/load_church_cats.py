@@ -5,18 +5,37 @@ Maintenance script for creating a church categories per municipality mapping.
 
 This takes too long to run to be worth doing on the fly as part of
 KMBInfo.load_mappings().
+
+The mapping is written to the mappings directory given in the processing
+section of the settings, see config.
+
+Usage:
+    python load_church_cats.py [-settings:PATH]
 """
 from __future__ import unicode_literals
 import os
+import sys
 import pywikibot as pwb
 import batchupload.common as common
-MAPPINGS_DIR = 'mappings'
 
+import importer.config as config
 
-def main():
+
+def main(*args):
     """Request church categories and output to json."""
+    usage = __doc__[__doc__.index('Usage:'):]
+    settings_file = None
+    for arg in args or sys.argv[1:]:
+        option, sep, value = arg.partition(':')
+        if option == '-settings':
+            settings_file = value
+        else:
+            print(usage)
+            return
+    settings = config.load_settings(
+        settings_file, required=bool(settings_file))['processing']
     church_cats = get_all_church_cats()
-    church_file = os.path.join(MAPPINGS_DIR, 'churches.json')
+    church_file = os.path.join(settings['mappings_dir'], 'churches.json')
     common.open_and_write_file(
         church_file, church_cats, as_json=True)
 
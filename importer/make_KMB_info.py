@@ -6,38 +6,130 @@ Construct Kulturmiljöbild-image templates and categories for KMB data.
 Transforms the partially processed data from kmb_massload into a
 BatchUploadTools compliant json file.
 """
-from collections import OrderedDict
+from collections import OrderedDict, namedtuple
+import copy
+from functools import partial
 import os.path
 import requests
+import sys
+import traceback
 
 import pywikibot
-from pywikibot.data import sparql
 
 import batchupload.common as common
 import batchupload.helpers as helpers
 import batchupload.listscraper as listscraper
 from batchupload.make_info import MakeBaseInfo
 
+import importer.category_index as category_index
+import importer.config as config
+import importer.item_cache as item_cache
+import importer.profiling as profiling
+import importer.record_parser as record_parser
+import importer.scheduling as scheduling
+import importer.sha1_index as sha1_index
+import importer.sparql_lookup as sparql_lookup
+from importer.instrumentation import STATS
+from importer.lazy_mappings import LazyMappings, MappingLoadError
+
 
-MAPPINGS_DIR = 'mappings'
 BATCH_CAT = 'Media contributed by RAÄ'  # stem for maintenance categories
 BATCH_DATE = '2017-09'  # branch for this particular batch upload
-LOGFILE = 'kmb_processing_september.log'
+HERITAGE_API = config.DEFAULTS['endpoints']['heritage']
+PHOTOGRAPHER_PAGE = 'Institution:Riksantikvarieämbetet/KMB/creators'
+# mapping name: file in the mappings directory
+MAPPING_FILES = {
+    'socken': 'socken.json',
+    'kommun': 'kommun.json',
+    'countries': 'countries_for_cats.json',
+    'tags': 'tags.json',
+    'primary_classes': 'primary_classes.json',
+    'photographers': 'photographers.json',
+    'kmb_files': 'kmb_files.json',
+    'commonscat': 'commonscat.json',
+    'churches': 'churches.json',
+}
+# the code producing the output of an item, see KMBInfo.make_item_output
+CODE_FILES = (
+    os.path.abspath(__file__),
+    helpers.__file__,
+    sys.modules[MakeBaseInfo.__module__].__file__,
+)
+# the value of each record field left out of a record, e.g. by a field
+# projection (see record_parser.resolve_fields), as if it was not in the xml
+RECORD_DEFAULTS = dict.fromkeys(record_parser.TAG_FIELDS, '')
+RECORD_DEFAULTS.update({
+    'latitude': None,
+    'longitude': None,
+    'avbildar': None,
+    'bbr': [],
+    'fmis': [],
+    'item_classes': [],
+    'item_keywords': [],
+    'date': '',
+    'license_text': None,
+})
+# everything derived from the place of an item, see KMBInfo.get_place_context
+PlaceContext = namedtuple('PlaceContext', (
+    'depicted_place',  # wikitext for the depicted place field
+    'wd',  # dict of the Wikidata ids of the kommun and socken
+    'meta_cat',  # maintenance proto category for the depicted place, if any
+    'place_cat',  # socken or kommun category, if any
+    'kommun_cat',  # kommun category, if any
+    'mappings',  # names of the mappings read
+))
+
+
+class ProcessingAborted(Exception):
+    """Raised when too many items in a row failed, see try_item_output."""
 
 
 class KMBInfo(MakeBaseInfo):
     """Construct file descriptions and filenames for the KMB batch upload."""
 
+    settings_file = None  # set by main(), defaults to config.SETTINGS_FILE
+
     def __init__(self, **options):
         """Initialise a make_info object."""
         batch_date = options.get('batch_label') or BATCH_DATE
         batch_cat = options.get('base_meta_cat') or BATCH_CAT
         super(KMBInfo, self).__init__(batch_cat, batch_date, **options)
+        self.settings = config.load_settings(
+            self.settings_file, required=bool(self.settings_file))
+        self.mappings_dir = self.settings['processing']['mappings_dir']
+        self.sparql_options = dict(
+            self.settings['sparql'],
+            endpoint=self.settings['endpoints']['sparql'],
+            entity_url=self.settings['endpoints']['sparql_entity'])
         self.commons = pywikibot.Site('commons', 'commons')
         self.wikidata = pywikibot.Site('wikidata', 'wikidata')
         self.category_cache = {}  # cache for category_exists()
+        if self.settings['processing']['category_cache_size']:
+            self.category_cache = scheduling.LRUCache(
+                self.settings['processing']['category_cache_size'])
+        # only available if category_index.py has been run
+        self.category_index = category_index.load_index(os.path.join(
+            self.mappings_dir, self.settings['processing']['category_index']))
         self.photographer_cache = {}
-        self.log = common.LogFile('', LOGFILE)
+        self.place_contexts = {}  # cache for get_place_context()
+        self.place_misses = set()  # (mapping, code) not found in the mappings
+        self.item_cache = None
+        if self.settings['processing']['item_cache']:
+            self.item_cache = item_cache.ItemCache(
+                self.settings['processing']['item_cache'])
+        self.item_cache_hits = 0
+        # see make_item_output()
+        self.cache_context = (
+            batch_cat, batch_date, item_cache.code_version(*CODE_FILES))
+        self.log = common.LogFile(
+            '', options.get('log_file') or
+            self.settings['processing']['log_file'])
+        self.problem_file = (options.get('problem_file') or
+                             self.settings['processing']['problem_file'])
+        self.checkpoint_file = options.get(
+            'checkpoint_file', self.settings['processing']['checkpoint_file'])
+        self.problems = {}  # items which failed, see report_problem()
+        self.failures_in_a_row = 0  # see try_item_output()
 
     def load_data(self, in_file):
         """
@@ -51,6 +143,7 @@ class KMBInfo(MakeBaseInfo):
         """
         return common.open_and_read_file(in_file, as_json=True)
 
+    @STATS.timed('process_data')
     def process_data(self, raw_data):
         """
         Take the loaded data and construct a KMBItem for each.
@@ -61,89 +154,87 @@ class KMBInfo(MakeBaseInfo):
         """
         d = {}
         for key, value in raw_data.items():
-            item = KMBItem(value, self)
-            if item.problem:
-                text = '{0} -- image was skipped because of: {1}'.format(
-                    item.ID, '\n'.join(item.problem))
-                pywikibot.output(text)
-                self.log.write(text)
-            else:
+            item = self.make_item(value)
+            if item:
                 d[key] = item
 
         self.data = d
 
-    def load_mappings(self, update_mappings):
+    def make_item(self, record):
         """
-        Update mapping files, load these and package appropriately.
+        Construct a KMBItem from a record, unless it had problems.
 
-        :param update_mappings: whether to first download the latest mappings
+        :param record: a record, as output by kmb_massload/harvester
+        :return: KMBItem or None
+        """
+        cache_key = item_cache.item_key(record, *self.cache_context)
+        item = KMBItem(record, self)
+        item.cache_key = cache_key
+        if item.problem:
+            text = '{0} -- image was skipped because of: {1}'.format(
+                item.ID, '\n'.join(item.problem))
+            pywikibot.output(text)
+            self.log.write(text)
+            return None
+        return item
+
+    def load_mappings(self, update_mappings):
         """
-        socken_file = os.path.join(MAPPINGS_DIR, 'socken.json')
-        kommun_file = os.path.join(MAPPINGS_DIR, 'kommun.json')
-        countries_file = os.path.join(MAPPINGS_DIR, 'countries_for_cats.json')
-        tags_file = os.path.join(MAPPINGS_DIR, 'tags.json')
-        primary_classes_file = os.path.join(
-            MAPPINGS_DIR, 'primary_classes.json')
-        photographer_file = os.path.join(MAPPINGS_DIR, 'photographers.json')
-        kmb_files_file = os.path.join(MAPPINGS_DIR, 'kmb_files.json')
-        commonscat_file = os.path.join(MAPPINGS_DIR, 'commonscat.json')
-        church_file = os.path.join(MAPPINGS_DIR, 'churches.json')
-        photographer_page = 'Institution:Riksantikvarieämbetet/KMB/creators'
+        Register the mappings, each is loaded the first time it is used.
 
+        :param update_mappings: whether to first download the latest version
+            of a mapping, where possible, when it is loaded
+        """
+        updaters = {}
         if update_mappings:
             query_props = {'P373': 'commonscat'}
-            self.mappings['socken'] = KMBInfo.query_to_lookup(
-                KMBInfo.build_query('P777', optional_props=query_props.keys()),
-                props=query_props)
-            self.mappings['kommun'] = KMBInfo.query_to_lookup(
-                KMBInfo.build_query('P525', optional_props=query_props.keys()),
-                props=query_props)
-            self.mappings['photographers'] = self.get_photographer_mapping(
-                photographer_page)
-            self.mappings['kmb_files'] = self.get_existing_kmb_files()
-            self.mappings['commonscat'] = {'bbr': {}, 'fmis': {}}
-            KMBInfo.get_commonscat_from_heritage(
-                'se-bbr', limit=1000,
-                data=self.mappings['commonscat']['bbr'])
-            KMBInfo.get_commonscat_from_heritage(
-                'se-fornmin', limit=1000,
-                data=self.mappings['commonscat']['fmis'])
-            self.load_wikidata_bbr_fmis_commonscat()
+            updaters = {
+                'socken': partial(
+                    KMBInfo.query_to_lookup,
+                    KMBInfo.build_query(
+                        'P777', optional_props=query_props.keys()),
+                    props=query_props, refresh=True, **self.sparql_options),
+                'kommun': partial(
+                    KMBInfo.query_to_lookup,
+                    KMBInfo.build_query(
+                        'P525', optional_props=query_props.keys()),
+                    props=query_props, refresh=True, **self.sparql_options),
+                'photographers': partial(
+                    self.get_photographer_mapping, PHOTOGRAPHER_PAGE),
+                'kmb_files': self.get_existing_kmb_files,
+                'commonscat': self.get_commonscat_mapping,
+            }
+
+        self.mappings = LazyMappings()
+        for name, filename in MAPPING_FILES.items():
+            path = os.path.join(self.mappings_dir, filename)
+            # an updated mapping is only known once it has been updated
+            self.mappings.register(
+                name,
+                partial(KMBInfo.load_mapping, path, updaters.get(name)),
+                partial(item_cache.file_version, path),
+                load_first=name in updaters)
+        # only available if sha1_index.py has been run for the batch
+        path = os.path.join(self.mappings_dir, sha1_index.INDEX_FILE)
+        self.mappings.register(
+            'sha1', partial(sha1_index.Sha1Index, path),
+            partial(item_cache.file_version, path))
 
-            # dump to mappings
-            common.open_and_write_file(
-                socken_file, self.mappings['socken'], as_json=True)
-            common.open_and_write_file(
-                kommun_file, self.mappings['kommun'], as_json=True)
-            common.open_and_write_file(
-                photographer_file, self.mappings['photographers'],
-                as_json=True)
-            common.open_and_write_file(
-                kmb_files_file, self.mappings['kmb_files'], as_json=True)
-            common.open_and_write_file(
-                commonscat_file, self.mappings['commonscat'], as_json=True)
-        else:
-            self.mappings['socken'] = common.open_and_read_file(
-                socken_file, as_json=True)
-            self.mappings['kommun'] = common.open_and_read_file(
-                kommun_file, as_json=True)
-            self.mappings['photographers'] = common.open_and_read_file(
-                photographer_file, as_json=True)
-            self.mappings['kmb_files'] = common.open_and_read_file(
-                kmb_files_file, as_json=True)
-            self.mappings['commonscat'] = common.open_and_read_file(
-                commonscat_file, as_json=True)
-
-        self.mappings['countries'] = common.open_and_read_file(
-            countries_file, as_json=True)
-        self.mappings['churches'] = common.open_and_read_file(
-            church_file, as_json=True)
-        self.mappings['tags'] = common.open_and_read_file(
-            tags_file, as_json=True)
-        self.mappings['primary_classes'] = common.open_and_read_file(
-            primary_classes_file, as_json=True)
-
-        pywikibot.output('Loaded all mappings')
+    @staticmethod
+    def load_mapping(filename, updater=None):
+        """
+        Load a single mapping file, first updating it if possible.
+
+        :param filename: path to the mapping file
+        :param updater: function without arguments returning the latest
+            version of the mapping
+        :return: the mapping
+        """
+        if updater:
+            mapping = updater()
+            common.open_and_write_file(filename, mapping, as_json=True)
+            return mapping
+        return common.open_and_read_file(filename, as_json=True)
 
     def get_photographer_mapping(self, photographer_page):
         """
@@ -178,17 +269,35 @@ class KMBInfo(MakeBaseInfo):
                 qid, photographer_props, self.photographer_cache)
         return photographers
 
-    def load_wikidata_bbr_fmis_commonscat(self):
+    def get_commonscat_mapping(self):
+        """
+        Load the commonscats of bbr/fmis entries from heritage and Wikidata.
+
+        :return: dict with the bbr and fmis mappings
+        """
+        mapped_data = {'bbr': {}, 'fmis': {}}
+        KMBInfo.get_commonscat_from_heritage(
+            'se-bbr', limit=1000, data=mapped_data['bbr'],
+            api_url=self.settings['endpoints']['heritage'])
+        KMBInfo.get_commonscat_from_heritage(
+            'se-fornmin', limit=1000, data=mapped_data['fmis'],
+            api_url=self.settings['endpoints']['heritage'])
+        self.load_wikidata_bbr_fmis_commonscat(mapped_data)
+        return mapped_data
+
+    def load_wikidata_bbr_fmis_commonscat(self, mapped_data):
         """
         Load all bbr/fmis entries in Wikidata and add any commonscats.
 
-        Overrides any mappings found in heritage.
+        Overrides any mappings found in heritage. As this is only done when
+        updating the mappings any cached lookup is ignored.
+
+        :param mapped_data: dict with the bbr and fmis mappings to add to
         """
         query_props = {'P373': 'commonscat'}
-        mapped_data = self.mappings['commonscat']
         data = KMBInfo.query_to_lookup(
             KMBInfo.build_query('P1260', optional_props=query_props.keys()),
-            props=query_props)
+            props=query_props, refresh=True, **self.sparql_options)
 
         for k, v in data.items():
             if v.get('commonscat'):
@@ -230,7 +339,9 @@ class KMBInfo(MakeBaseInfo):
     # @todo:move to BatchUploadTools?
     @staticmethod
     def query_to_lookup(query, item_label='item', value_label='value',
-                        props=None):
+                        props=None, endpoint=None, entity_url=None,
+                        cache_dir=None, ttl=None, chunk_size=None, workers=1,
+                        refresh=False):
         """
         Fetch sparql result and return it as a lookup table for wikidata id.
 
@@ -238,30 +349,76 @@ class KMBInfo(MakeBaseInfo):
         value_label:item_label pairs. If props are provided the returned dict
         becomes value_label:{'wd':item_label, other props}
 
+        If a value occurs more than once the last result is used.
+
         :param item_label: the label of the selected wikidata id
         :param value_label: the label of the selected lookup key
         :param props: dict of other properties to save from the results using
             the format label_in_sparql:key_in_output.
+        :param endpoint: the SPARQL endpoint to query (defaults to the
+            Wikidata Query Service), requires entity_url
+        :param entity_url: the url prefix of the entities in the results
+        :param cache_dir: directory in which to cache the lookup, if not
+            provided the lookup is not cached
+        :param ttl: maximum age, in seconds, of a cached lookup
+        :param chunk_size: the number of results to fetch at a time, if not
+            provided the query is not split up
+        :param workers: the number of chunks to fetch concurrently
+        :param refresh: whether to ignore any cached lookup, the new lookup
+            is still cached
         :return: dict
         """
-        wdqs = sparql.SparqlQuery()
-        result = wdqs.select(query, full_data=True)
+        key = sparql_lookup.cache_key(
+            endpoint, query, item_label, value_label, props)
+        if cache_dir and not refresh:
+            lookup = sparql_lookup.read_cache(cache_dir, key, ttl)
+            if lookup is not None:
+                STATS.count('sparql_cache.hits')
+                return lookup
+            STATS.count('sparql_cache.misses')
+
         lookup = {}
-        for entry in result:
-            if entry[value_label] in lookup:
-                raise pywikibot.Error('Non-unique value in lookup')
-            key = str(entry[value_label])
-            qid = entry[item_label].getID()
-            if not props:
-                lookup[key] = qid
-            else:
-                lookup[key] = {'wd': qid}
-                for prop, label in props.items():
-                    if entry[prop] and not entry[prop].type:
-                        entry[prop] = repr(entry[prop])
-                    lookup[key][label] = entry[prop]
+        duplicates = 0
+        with STATS.timer('sparql'):
+            wdqs = sparql_lookup.ChunkedSparql(
+                endpoint, entity_url, chunk_size, workers)
+            for entry in wdqs.select(query):
+                value = entry[value_label]['value']
+                if value in lookup:
+                    duplicates += 1
+                qid = wdqs.get_id(entry[item_label])
+                if not props:
+                    lookup[value] = qid
+                else:
+                    lookup[value] = {'wd': qid}
+                    for prop, label in props.items():
+                        lookup[value][label] = KMBInfo.binding_to_text(
+                            entry[prop])
+        if duplicates:
+            pywikibot.warning(
+                '{0} non-unique values in lookup, only the last result for '
+                'each was kept'.format(duplicates))
+
+        if cache_dir:
+            sparql_lookup.write_cache(cache_dir, key, lookup)
         return lookup
 
+    @staticmethod
+    def binding_to_text(binding):
+        """
+        Convert a raw sparql result binding to text.
+
+        Language tagged literals keep their tag, i.e. "value@lang".
+
+        :param binding: the raw binding or None
+        :return: str or None
+        """
+        if not binding:
+            return None
+        if binding.get('xml:lang'):
+            return '{0}@{1}'.format(binding['value'], binding['xml:lang'])
+        return binding['value']
+
     # @todo:move to BatchUploadTools?
     def load_wd_value(self, qid, props, cache=None):
         """
@@ -276,20 +433,23 @@ class KMBInfo(MakeBaseInfo):
         :param cache: The cache in which to store the values
         :return: dict
         """
-        if cache and qid in cache:
+        if cache is not None and qid in cache:
+            STATS.count('load_wd_value.hits')
             return cache[qid]
 
-        data = {}
-        wd_item = pywikibot.ItemPage(self.wikidata, qid)
-        wd_item.exists()  # load data
-        for pid, label in props.items():
-            value = None
-            claims = wd_item.claims.get(pid)
-            if claims:
-                value = claims[0].getTarget()
-            data[label] = value
-
-        if cache:
+        STATS.count('load_wd_value.misses')
+        with STATS.timer('load_wd_value'):
+            data = {}
+            wd_item = pywikibot.ItemPage(self.wikidata, qid)
+            wd_item.exists()  # load data
+            for pid, label in props.items():
+                value = None
+                claims = wd_item.claims.get(pid)
+                if claims:
+                    value = claims[0].getTarget()
+                data[label] = value
+
+        if cache is not None:
             cache[qid] = data
         return data
 
@@ -365,7 +525,8 @@ class KMBInfo(MakeBaseInfo):
 
     @staticmethod
     def get_commonscat_from_heritage(dataset, data=None, props=None,
-                                     limit=None, srcontinue=None):
+                                     limit=None, srcontinue=None,
+                                     api_url=None):
         """
         Get all commonscat entries in a dataset from the heritage database.
 
@@ -379,14 +540,16 @@ class KMBInfo(MakeBaseInfo):
         :param limit: the number of records to request at once
             (uses api default unless provided)
         :param srcontinue: continuation parameter to attach to the request
+        :param api_url: base url of the heritage API (defaults to
+            HERITAGE_API)
         :return: dict with found data
         """
         props = props or ('id', 'commonscat', 'wd_item')
         if data is None:
             data = {}
-        base_url = 'https://tools.wmflabs.org/heritage/api/api.php?action=search&format=json&srwithcommonscat=1'  # noqa E501
-        url = '{0}&srcountry={1}&props={2}'.format(
-            base_url, dataset, '|'.join(props))
+        url = ('{0}?action=search&format=json&srwithcommonscat=1'
+               '&srcountry={1}&props={2}').format(
+            api_url or HERITAGE_API, dataset, '|'.join(props))
 
         if limit:
             url += '&limit={0}'.format(limit)
@@ -406,10 +569,304 @@ class KMBInfo(MakeBaseInfo):
         if req_data.get('continue'):
             KMBInfo.get_commonscat_from_heritage(
                 dataset, data=data, props=props, limit=limit,
-                srcontinue=req_data['continue']['srcontinue'])
+                srcontinue=req_data['continue']['srcontinue'],
+                api_url=api_url)
 
         return data
 
+    def make_info(self):
+        """
+        Construct the output for each item, reusing any cached output.
+
+        Unless disabled the items are processed in a locality aware order,
+        see scheduling, but output in their original order.
+
+        An item which fails is left out of the output and added to the
+        problem report instead, see try_item_output(). The output is
+        checkpointed regularly, and if the run is interrupted or aborted,
+        so that a rerun resumes where it left off.
+
+        :return: dict
+        :raises MappingLoadError: if a mapping could not be loaded
+        :raises ProcessingAborted: if too many items in a row failed
+        """
+        keys = list(self.data)
+        order = keys
+        if self.settings['processing']['schedule']:
+            order = scheduling.schedule(self.data)
+            self.report_schedule(keys, order)
+
+        hits_before = self.item_cache_hits
+        output = self.load_checkpoint()
+        interval = self.settings['processing']['checkpoint_interval']
+        self.failures_in_a_row = 0
+        completed = False
+        try:
+            for count, key in enumerate(order, 1):
+                if key in output:
+                    continue
+                item_output = self.try_item_output(key, self.data[key])
+                if item_output is not None:
+                    output[key] = item_output
+                if interval and count % interval == 0:
+                    self.save_checkpoint(output)
+            completed = True
+        finally:
+            if completed:
+                self.remove_checkpoint()
+            else:
+                self.save_checkpoint(output)
+            self.save_problems()
+
+        if self.item_cache_hits > hits_before:
+            pywikibot.output(
+                'Reused the cached output of {0} items, delete {1} to '
+                'recompute them'.format(
+                    self.item_cache_hits - hits_before,
+                    self.item_cache.cache_dir))
+        if self.problems:
+            pywikibot.output('{0} items failed, see {1}'.format(
+                len(self.problems), self.problem_file))
+        return OrderedDict((key, output[key]) for key in keys if key in output)
+
+    def try_item_output(self, key, item):
+        """
+        Construct the output of an item, reporting it if this fails.
+
+        A failure to load a mapping, or too many items failing in a row,
+        means that something is wrong for every item, e.g. a service is
+        down, so the run is aborted rather than every item being reported.
+
+        :param key: the key of the item
+        :param item: the KMBItem
+        :return: the output, see make_item_output(), or None if it failed
+        :raises MappingLoadError: if a mapping could not be loaded
+        :raises ProcessingAborted: if too many items in a row failed
+        """
+        try:
+            output = self.make_item_output(item)
+        except MappingLoadError:
+            raise
+        except Exception as e:
+            self.report_problem(key, item, e)
+            self.failures_in_a_row += 1
+            limit = self.settings['processing']['max_failures_in_a_row']
+            if limit and self.failures_in_a_row >= limit:
+                raise ProcessingAborted(
+                    '{0} items in a row failed, the last with {1}: '
+                    '{2}'.format(self.failures_in_a_row,
+                                 type(e).__name__, e)) from e
+            return None
+        self.failures_in_a_row = 0
+        return output
+
+    def report_problem(self, key, item, error):
+        """
+        Add a failed item to the problem report.
+
+        :param key: the key of the item
+        :param item: the KMBItem
+        :param error: the exception raised while processing the item
+        """
+        STATS.count('make_item_output.errors')
+        self.problems[key] = {
+            'ID': item.ID,
+            'error': '{0}: {1}'.format(type(error).__name__, error)}
+        self.log.write('{0} -- failed with:\n{1}'.format(
+            item.ID, traceback.format_exc()))
+
+    def save_problems(self):
+        """Store the problem report, removing any from an earlier run."""
+        if self.problems:
+            common.open_and_write_file(
+                self.problem_file, self.problems, as_json=True)
+        elif os.path.exists(self.problem_file):
+            os.remove(self.problem_file)
+
+    def load_checkpoint(self):
+        """
+        Load the output of a previously interrupted run.
+
+        Only the output of items whose records are unchanged is kept.
+
+        :return: dict of item key and output
+        """
+        if not (self.checkpoint_file and
+                os.path.exists(self.checkpoint_file)):
+            return {}
+        checkpoint = common.open_and_read_file(
+            self.checkpoint_file, as_json=True)
+        output = {
+            key: entry['output'] for key, entry in checkpoint.items()
+            if key in self.data and
+            entry['cache_key'] == self.data[key].cache_key}
+        pywikibot.output('Resuming with {0} items from {1}'.format(
+            len(output), self.checkpoint_file))
+        return output
+
+    def save_checkpoint(self, output):
+        """
+        Store the output so far, replacing any earlier checkpoint.
+
+        :param output: dict of item key and output
+        """
+        if not self.checkpoint_file:
+            return
+        checkpoint = {
+            key: {'cache_key': self.data[key].cache_key, 'output': value}
+            for key, value in output.items()}
+        temp_file = '{0}.tmp'.format(self.checkpoint_file)
+        common.open_and_write_file(temp_file, checkpoint, as_json=True)
+        os.replace(temp_file, self.checkpoint_file)
+
+    def remove_checkpoint(self):
+        """Remove the checkpoint once all items have been processed."""
+        if self.checkpoint_file and os.path.exists(self.checkpoint_file):
+            os.remove(self.checkpoint_file)
+
+    def report_schedule(self, keys, order):
+        """
+        Output the estimated category cache hit rates of the two orders.
+
+        :param keys: the items in their original order
+        :param order: the items in processing order
+        """
+        maxsize = self.settings['processing']['category_cache_size']
+        before = scheduling.simulate_hit_rate(self.data, keys, maxsize)
+        after = scheduling.simulate_hit_rate(self.data, order, maxsize)
+        if before is not None:
+            pywikibot.output(
+                'Estimated category cache hit rate: {0:.1%} in the original '
+                'order, {1:.1%} after reordering'.format(before, after))
+
+    def make_item_output(self, item):
+        """
+        Construct the description, filename and categories of an item.
+
+        The output is reused from the item cache as long as the record of
+        the item, the code producing the output and the versions of the
+        mappings it read are unchanged. Note that any log messages from
+        processing the item are then not repeated. When updating the
+        mappings, those read by the cached item are updated before the
+        cached output can be checked.
+
+        :param item: the KMBItem
+        :return: dict
+        """
+        if self.item_cache:
+            output = self.item_cache.get(
+                item.cache_key, self.mappings.version)
+            if output is not None:
+                STATS.count('item_cache.hits')
+                self.item_cache_hits += 1
+                return output
+            STATS.count('item_cache.misses')
+
+        self.mappings.reset_read()
+        info = self.make_info_template(item)
+        content_cats = self.generate_content_cats(item)
+        output = {
+            'info': info,
+            'filename': self.generate_filename(item),
+            'cats': content_cats,
+            'meta_cats': self.generate_meta_cats(item, content_cats)}
+
+        if self.item_cache:
+            self.item_cache.put(
+                item.cache_key,
+                {name: self.mappings.version(name)
+                 for name in self.mappings.read},
+                output)
+        return output
+
+    def get_place_context(self, land, kommun, socken, lan, landskap):
+        """
+        Return the place context shared by all items with the same place.
+
+        A batch only covers a few hundred places so these are only worked
+        out once each.
+
+        :param land: the country code
+        :param kommun: the municipality code
+        :param socken: the parish code
+        :param lan: the county name
+        :param landskap: the province name
+        :return: PlaceContext
+        """
+        key = (land, kommun, socken, lan, landskap)
+        context = self.place_contexts.get(key)
+        if context is None:
+            STATS.count('place_context.misses')
+            context = self.make_place_context(*key)
+            self.place_contexts[key] = context
+        else:
+            STATS.count('place_context.hits')
+        # so that the item cache knows which mappings the item depends on
+        self.mappings.read.update(context.mappings)
+        return context
+
+    def make_place_context(self, land, kommun, socken, lan, landskap):
+        """
+        Work out the place context, see get_place_context().
+
+        If no 'land' is given the place is assumed to be in Sweden. A
+        municipality or parish missing from the mappings is reported and
+        then treated as unknown.
+
+        :return: PlaceContext
+        """
+        if land and land != 'SE':
+            return PlaceContext(
+                '{{Country|1=%s}}' % land, {},
+                'needing categorisation (not from Sweden)', None, None, ())
+
+        mappings = tuple(
+            name for name, code in (('kommun', kommun), ('socken', socken))
+            if code)
+        kommun_entry = self.lookup_place('kommun', kommun)
+        socken_entry = self.lookup_place('socken', socken)
+
+        depicted_place = '{{Country|1=SE}}'
+        wd = {}
+        meta_cat = None
+        if kommun_entry:
+            wd['kommun'] = kommun_entry['wd']
+            depicted_place += ', {{city|%s}}' % wd['kommun']
+            if socken_entry:
+                wd['socken'] = socken_entry['wd']
+                depicted_place += ', {{city|%s}}' % wd['socken']
+        elif lan:
+            depicted_place += ', {}'.format(lan)
+        elif landskap:
+            depicted_place += ', {}'.format(landskap)
+        else:
+            meta_cat = 'needing categorisation (no municipality)'
+
+        kommun_cat = kommun_entry.get('commonscat')
+        place_cat = socken_entry.get('commonscat') or kommun_cat
+        return PlaceContext(
+            depicted_place, wd, meta_cat, place_cat, kommun_cat, mappings)
+
+    def lookup_place(self, name, code):
+        """
+        Look up a municipality or parish, reporting it if missing.
+
+        :param name: the name of the mapping, i.e. 'kommun' or 'socken'
+        :param code: the municipality or parish code
+        :return: the mapping entry, empty if not found
+        """
+        if not code:
+            return {}
+        entry = self.mappings[name].get(code)
+        if entry is None:
+            if (name, code) not in self.place_misses:
+                self.place_misses.add((name, code))
+                self.log.write('{0} "{1}" is missing from the {0} '
+                               'mapping.'.format(name, code))
+            STATS.count('place_mapping.missing')
+            return {}
+        return entry
+
     # @note: this differs from the one created in RAA-tools
     def generate_filename(self, item):
         """
@@ -424,6 +881,7 @@ class KMBInfo(MakeBaseInfo):
         return helpers.format_filename(
             item.get_title_description(), 'KMB', item.ID)
 
+    @STATS.timed('make_info_template')
     def make_info_template(self, item):
         """
         Create the description template for a single KMB entry.
@@ -521,7 +979,8 @@ class KMBInfo(MakeBaseInfo):
         Ensure a given category really exists on Commons.
 
         If a cache is provided the replies are cached to reduce the number of
-        lookups.
+        lookups. Categories in the offline category index are known to exist,
+        only those not in it are looked up live.
 
         :param cat: category name (with or without "Category" prefix)
         :param cache: The cache in which to store the values
@@ -530,16 +989,63 @@ class KMBInfo(MakeBaseInfo):
         if not cat.lower().startswith('category:'):
             cat = 'Category:{0}'.format(cat)
 
-        if cache and cat in cache:
+        if cache is not None and cat in cache:
+            STATS.count('category_exists.hits')
             return cache[cat]
 
-        exists = pywikibot.Page(self.commons, cat).exists()
+        STATS.count('category_exists.misses')
+        if self.category_index is not None and cat in self.category_index:
+            STATS.count('category_index.hits')
+            exists = True
+        else:
+            STATS.count('category_index.misses')
+            with STATS.timer('category_exists'):
+                exists = pywikibot.Page(self.commons, cat).exists()
 
-        if cache:
+        if cache is not None:
             cache[cat] = exists
 
         return exists
 
+    def close(self):
+        """Release the category index, if any, once processing is done."""
+        if self.category_index is not None:
+            self.category_index.close()
+            self.category_index = None
+
+    @staticmethod
+    def pop_options(args, names):
+        """
+        Separate out KMB specific command line options.
+
+        MakeBaseInfo.main() only handles the shared options so any KMB
+        specific ones must be removed before the rest are passed on. If no
+        args are given they are taken from the command line, as pywikibot
+        would do.
+
+        :param args: the command line arguments
+        :param names: the KMB specific options, without the leading "-"
+        :return: (dict of the KMB specific options and their values, list
+            of remaining args)
+        """
+        from_command_line = not args
+        if from_command_line:
+            args = pywikibot.argvu[1:]
+
+        options = {}
+        remaining = []
+        for arg in args:
+            option, sep, value = arg.partition(':')
+            if option[1:] in names:
+                options[option[1:]] = value
+            else:
+                remaining.append(arg)
+
+        if from_command_line:
+            # stop pywikibot from finding the options again
+            pywikibot.argvu = pywikibot.argvu[:1] + remaining
+        return options, remaining
+
     @classmethod
     def main(cls, *args):
         """Command line entry-point."""
@@ -551,12 +1057,47 @@ class KMBInfo(MakeBaseInfo):
             'user_config.py file (optional)\n'
             '\t-update_mappings:BOOL if mappings should first be updated '
             'against online sources (defaults to True)\n'
+            '\t-stats_interval:INT also save the run stats every INT seconds '
+            'during the run (optional)\n'
+            '\t-profile:PATH run under the profiler, saving the stats to PATH '
+            'and reporting the hot functions per stage (optional)\n'
+            '\t-settings:PATH the settings file to use (defaults to '
+            'settings.json, if present)\n'
             '\tExample:\n'
             '\tpython make_KMB_info.py -in_file:kmb_data.json '
             '-base_name:kmb_output -update_mappings:True -dir:KMB\n'
         )
-        info = super(KMBInfo, cls).main(usage=usage, *args)
+        options, args = KMBInfo.pop_options(
+            args, ('stats_interval', 'profile', 'settings'))
+        cls.settings_file = options.get('settings')
+        stats_file = config.load_settings(
+            cls.settings_file,
+            required=bool(cls.settings_file))['processing']['stats_file']
+        STATS.reset()
+        if options.get('stats_interval'):
+            STATS.enable_snapshots(
+                stats_file, int(options.get('stats_interval')))
+
+        base_main = super(KMBInfo, cls).main
+        try:
+            if options.get('profile'):
+                info = profiling.run_profiled(
+                    options.get('profile'), base_main, usage=usage, *args)
+            else:
+                info = base_main(usage=usage, *args)
+        finally:
+            STATS.dump(stats_file)
+            pywikibot.output('Run stats saved to {0}'.format(stats_file))
+        if info and isinstance(info.mappings, LazyMappings):
+            pywikibot.output('Mappings loaded: {0}; never used: {1}'.format(
+                ', '.join(info.mappings.touched) or '-',
+                ', '.join(info.mappings.untouched()) or '-'))
+        if info and info.place_misses:
+            pywikibot.output(
+                '{0} municipalities/parishes missing from the mappings, see '
+                'the log'.format(len(info.place_misses)))
         if info:
+            info.close()
             pywikibot.output(info.log.close_and_confirm())
 
 
@@ -570,11 +1111,10 @@ class KMBItem(object):
         :param initial_data: dict of data to set up item with
         :param kmb_info: the KMBInfo instance
         """
-        # ensure all required variables are present
-        required_entries = ('latitude', 'longitude', 'avbildar')
-        for entry in required_entries:
-            if entry not in initial_data:
-                initial_data[entry] = None
+        # ensure all fields are present, also for a projected record
+        for field, default in RECORD_DEFAULTS.items():
+            if field not in initial_data:
+                initial_data[field] = copy.copy(default)
 
         for key, value in initial_data.items():
             setattr(self, key, value)
@@ -584,19 +1124,21 @@ class KMBItem(object):
         self.meta_cats = set()  # meta/maintenance proto categories
         self.kmb_info = kmb_info  # the KBMInfo instance creating this KMBItem
         self.needs_place_cat = True  # if item needs categorisation by place
+        self.cache_key = None  # set by KMBInfo.process_data()
         self.log = kmb_info.log
         self.commons = pywikibot.Site('commons', 'commons')
 
     def get_exact_match_church(self):
         """Try to find correct category for church in Sweden."""
         if self.kommun:
-            muni_cat_name = self.kmb_info.mappings['kommun'][self.kommun]['commonscat']
+            muni_cat_name = self.get_place_context().kommun_cat
             churches_municip = self.kmb_info.mappings["churches"].get(muni_cat_name)
             if churches_municip and self.namn in churches_municip:
                 exact_category_title = churches_municip[self.namn]
                 self.content_cats.add(exact_category_title)
                 return True
 
+    @STATS.timed('get_exact_cat_from_name')
     def get_exact_cat_from_name(self, cache):
         """
         Try to find a category with the same name as item.
@@ -638,10 +1180,17 @@ class KMBItem(object):
         """
         Build a gallery of Commons files that depict/link to same KMB image.
 
+        Includes both files linking to the KMB id and files found to be
+        exact duplicates through the sha1 index.
+
         :return: str
         """
         gallery = ''
-        maybe_same = self.kmb_info.mappings['kmb_files'].get(self.ID)
+        maybe_same = list(self.kmb_info.mappings['kmb_files'].get(self.ID, []))
+        for title in self.kmb_info.mappings['sha1'].get_duplicates_for_id(
+                self.ID):
+            if title not in maybe_same:
+                maybe_same.append(title)
 
         if maybe_same:
             gallery = '<gallery>\n{0}\n</gallery>'.format(
@@ -943,19 +1492,18 @@ class KMBItem(object):
         return '[{url} {link_text}]\n{template}'.format(
             url=self.source, link_text=txt, template=template)
 
-    def make_place_category(self):
-        """Add category for parish or municipality."""
-        kommun_map = self.kmb_info.mappings['kommun']
-        socken_map = self.kmb_info.mappings['socken']
-        cat = None
-
-        if not self.land or self.land == 'SE':
-            if self.socken:
-                cat = socken_map[self.socken]['commonscat']
+    def get_place_context(self):
+        """
+        Return the context shared by all items with the same place.
 
-            if not cat and self.kommun:
-                cat = kommun_map[self.kommun]['commonscat']
+        :return: PlaceContext
+        """
+        return self.kmb_info.get_place_context(
+            self.land, self.kommun, self.socken, self.lan, self.landskap)
 
+    def make_place_category(self):
+        """Add category for parish or municipality."""
+        cat = self.get_place_context().place_cat
         if cat:
             self.content_cats.add(cat)
             return True
@@ -971,32 +1519,11 @@ class KMBItem(object):
 
         :return: depicted_place as wikitext
         """
-        kommun_map = self.kmb_info.mappings['kommun']
-        socken_map = self.kmb_info.mappings['socken']
-        depicted_place = None
-        if not self.land or self.land == 'SE':
-            depicted_place = '{{Country|1=SE}}'
-
-            if self.kommun:
-                self.wd['kommun'] = kommun_map[self.kommun]['wd']
-                depicted_place += ', {{city|%s}}' % self.wd['kommun']
-
-                if self.socken:
-                    self.wd['socken'] = socken_map[self.socken]['wd']
-                    depicted_place += ', {{city|%s}}' % self.wd['socken']
-            else:
-                if self.lan:
-                    depicted_place += ', {}'.format(self.lan)
-                elif self.landskap:
-                    depicted_place += ', {}'.format(self.landskap)
-                else:
-                    self.meta_cats.add(
-                        'needing categorisation (no municipality)')
-        else:
-            depicted_place = '{{Country|1=%s}}' % self.land
-            self.meta_cats.add('needing categorisation (not from Sweden)')
-
-        return depicted_place
+        context = self.get_place_context()
+        self.wd.update(context.wd)
+        if context.meta_cat:
+            self.meta_cats.add(context.meta_cat)
+        return context.depicted_place
 
 
 if __name__ == '__main__':
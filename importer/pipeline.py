@@ -0,0 +1,283 @@
+#!/usr/bin/python
+# -*- coding: utf-8  -*-
+"""
+Streaming pipeline from harvest to make_KMB_info output.
+
+Rather than harvesting (or massloading) the whole batch to file before
+make_KMB_info starts, the records are handed over one at a time through a
+bounded queue. A producer thread harvests and parses the records while the
+main thread turns each into a KMBItem and its output. The first output is
+therefore ready within seconds and the total time is roughly that of the
+slowest stage. When the queue is full the harvest pauses (backpressure),
+the time spent waiting on either side of the queue is part of the run stats.
+
+Each output is appended to a stream file (one json object per line) as soon
+as it is ready and, once the run completes, the full output is written in
+the same format as make_KMB_info. The harvested records are stored as
+usual.
+
+Since the items are processed in the order they are harvested they are not
+reordered, see scheduling, and no checkpoints are made, but a rerun reuses
+the item cache.
+
+Usage:
+    python pipeline.py [-source:STR] [-workers:INT] [-fields:STR]
+        [-queue_size:INT] [-update_mappings] [-settings:PATH] [-profile:PATH]
+"""
+from collections import OrderedDict
+import json
+import queue
+import sys
+import threading
+import time
+
+import pywikibot
+
+import batchupload.common as common
+
+import importer.config as config
+import importer.harvester as harvester
+import importer.kmb_massload as kmb_massload
+import importer.profiling as profiling
+from importer.instrumentation import STATS
+from importer.record_parser import resolve_fields
+
+
+class PipelineAborted(Exception):
+    """Raised in the producer once the consumer has stopped."""
+
+
+class StreamingStore(harvester.HarvestStore):
+    """HarvestStore also handing each new record on to the pipeline."""
+
+    def __init__(self, emit, data_file=None, index_file=None):
+        """
+        Load any previously stored records and keyword index.
+
+        :param emit: function taking the id and record of each new record
+        :param data_file: see HarvestStore
+        :param index_file: see HarvestStore
+        """
+        super(StreamingStore, self).__init__(data_file, index_file)
+        self.emit = emit
+
+    def add(self, id_no, record):
+        """Add, or replace, a record and hand it on."""
+        super(StreamingStore, self).add(id_no, record)
+        self.emit(id_no, record)
+
+
+def harvest_source(settings, emit, workers=None, fields=None):
+    """
+    Harvest the records of all keywords, see harvester.get_data().
+
+    :param settings: the settings, see config
+    :param emit: function taking the id and record of each new record
+    :param workers: see harvester.get_data()
+    :param fields: see harvester.get_data()
+    """
+    store = StreamingStore(
+        emit, settings['harvest']['data_file'],
+        settings['harvest']['index_file'])
+    harvester.harvest(store, settings, workers, fields)
+
+
+def massload_source(settings, emit, workers=None, fields=None):
+    """
+    Load the records of the hitlist, see kmb_massload.run().
+
+    :param settings: the settings, see config
+    :param emit: function taking the id and record of each new record
+    :param workers: not used
+    :param fields: see kmb_massload.run()
+    """
+    massload_settings = settings['massload']
+    log = common.LogFile('', massload_settings['log_file'])
+    rejects = None
+    if massload_settings['prescreen']:
+        rejects = common.LogFile('', massload_settings['rejects_file'])
+    fields = resolve_fields(fields)
+    data = {}
+    try:
+        for kmb in kmb_massload.load_list(massload_settings['list_file']):
+            record = kmb_massload.kmb_wrapper(
+                kmb, log, fields, settings['endpoints']['kmb_record'],
+                rejects=rejects)
+            if record is not None:
+                data[kmb] = record
+                emit(kmb, record)
+            time.sleep(massload_settings['delay'])
+    finally:
+        kmb_massload.output_blob(data, massload_settings['data_file'])
+        if rejects is not None:
+            rejects.close_and_confirm()
+        log.close_and_confirm()
+
+
+# where the records may come from
+SOURCES = {
+    'harvest': harvest_source,
+    'massload': massload_source,
+}
+
+
+def produce(source, buffer, stop, errors, **kwargs):
+    """
+    Run a source, handing its records to the buffer.
+
+    The buffer is bounded so this blocks once enough records are waiting to
+    be processed. A final None is put in the buffer once the source is
+    done, or failed.
+
+    :param source: one of the *_source functions
+    :param buffer: the queue.Queue to which (id, record) pairs are handed
+    :param stop: threading.Event signalling that the consumer stopped
+    :param errors: list to which any exception raised by the source is added
+    :param kwargs: other arguments for the source
+    """
+    def emit(id_no, record):
+        if stop.is_set():
+            raise PipelineAborted()
+        with STATS.timer('pipeline.backpressure'):
+            buffer.put((id_no, record))
+        STATS.count('pipeline.records')
+
+    try:
+        source(emit=emit, **kwargs)
+    except PipelineAborted:
+        pass
+    except Exception as e:  # re-raised by the consumer
+        errors.append(e)
+    finally:
+        buffer.put(None)
+
+
+def consume(info, buffer, stream):
+    """
+    Construct the output of each record in the buffer, until a None.
+
+    :param info: the KMBInfo, with its mappings registered
+    :param buffer: the queue.Queue from which (id, record) pairs are taken
+    :param stream: file to which each output is written as a json line
+    :return: OrderedDict of the outputs
+    """
+    output = OrderedDict()
+    start = time.time()
+    while True:
+        with STATS.timer('pipeline.starved'):
+            entry = buffer.get()
+        if entry is None:
+            break
+        id_no, record = entry
+        item = info.make_item(dict(record))  # keep the harvested record
+        if not item:
+            continue
+        item_output = info.try_item_output(id_no, item)
+        if item_output is None:
+            continue
+        if not output:
+            pywikibot.output('First output after {0:.1f}s'.format(
+                time.time() - start))
+        output[id_no] = item_output
+        stream.write(json.dumps({id_no: item_output}, ensure_ascii=False))
+        stream.write('\n')
+        stream.flush()
+    return output
+
+
+def run(source=None, workers=None, fields=None, queue_size=None,
+        update_mappings=False, settings_file=None):
+    """
+    Run the whole pipeline.
+
+    :param source: where the records come from, one of SOURCES (defaults
+        to the source setting)
+    :param workers: see harvester.get_data()
+    :param fields: see harvester.get_data()
+    :param queue_size: the number of records which may be waiting to be
+        processed (defaults to the queue_size setting)
+    :param update_mappings: whether to first update the mappings, see
+        KMBInfo.load_mappings()
+    :param settings_file: the settings file, see config
+    """
+    # only the consumer needs pywikibot sites and BatchUploadTools' make_info
+    from importer.make_KMB_info import KMBInfo
+
+    KMBInfo.settings_file = settings_file
+    settings = config.load_settings(
+        settings_file, required=bool(settings_file))
+    pipeline_settings = settings['pipeline']
+    source = source or pipeline_settings['source']
+    if source not in SOURCES:
+        raise ValueError('Unknown source: {0}'.format(source))
+    STATS.reset()
+    info = KMBInfo()
+    info.load_mappings(update_mappings)
+
+    buffer = queue.Queue(maxsize=queue_size or pipeline_settings['queue_size'])
+    stop = threading.Event()
+    errors = []
+    producer = threading.Thread(
+        target=produce,
+        args=(SOURCES[source], buffer, stop, errors),
+        kwargs={'settings': settings, 'workers': workers, 'fields': fields},
+        daemon=True)
+    producer.start()
+    try:
+        with open(pipeline_settings['stream_file'], 'w',
+                  encoding='utf-8') as stream:
+            output = consume(info, buffer, stream)
+    finally:
+        # unblock the producer in case the processing was aborted
+        stop.set()
+        while producer.is_alive():
+            try:
+                buffer.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        producer.join()
+        info.close()
+        STATS.dump(pipeline_settings['stats_file'])
+    if errors:
+        raise errors[0]
+
+    common.open_and_write_file(
+        pipeline_settings['output_file'], output, as_json=True)
+    info.save_problems()
+    pywikibot.output(
+        'Created {0} with {1} items ({2} failed).'.format(
+            pipeline_settings['output_file'], len(output),
+            len(info.problems)))
+    pywikibot.output('Run stats saved to {0}'.format(
+        pipeline_settings['stats_file']))
+    pywikibot.output(info.log.close_and_confirm())
+
+
+def main(*args):
+    """Command line entry-point."""
+    usage = __doc__[__doc__.index('Usage:'):]
+    options = {}
+    profile = None
+    for arg in args or sys.argv[1:]:
+        option, sep, value = arg.partition(':')
+        if option in ('-workers', '-queue_size'):
+            options[option[1:]] = int(value)
+        elif option in ('-source', '-fields'):
+            options[option[1:]] = value
+        elif option == '-update_mappings':
+            options['update_mappings'] = True
+        elif option == '-settings':
+            options['settings_file'] = value
+        elif option == '-profile':
+            profile = value
+        else:
+            pywikibot.output(usage)
+            return
+    if profile:
+        profiling.run_profiled(profile, run, **options)
+    else:
+        run(**options)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+#!/usr/bin/python
+# -*- coding: utf-8  -*-
+"""
+Run an entry point under cProfile and report where the time went.
+
+The raw stats are written to file, for further analysis with pstats or
+snakeviz, and a report is produced listing the hot functions grouped by
+pipeline stage. A function belongs to the stage of the closest stage entry
+point (see STAGES) among its callers.
+
+Only the calling process is profiled, any work done in worker processes
+shows up as time spent waiting for the results.
+"""
+from collections import OrderedDict
+import cProfile
+import os
+import pstats
+
+# pipeline stages and their entry points as (file name, function name)
+STAGES = OrderedDict([
+    ('mapping load', (('make_KMB_info.py', 'load_mappings'),
+                      ('lazy_mappings.py', '__missing__'))),
+    ('item construction', (('make_KMB_info.py', 'process_data'), )),
+    ('categorisation', (('make_KMB_info.py', 'generate_content_cats'),
+                        ('make_KMB_info.py', 'generate_meta_cats'))),
+    ('template output', (('make_KMB_info.py', 'make_info_template'),
+                         ('make_KMB_info.py', 'generate_filename'))),
+    ('fetch', (('harvester.py', 'fetch_page'),
+               ('kmb_massload.py', 'kmb_wrapper'))),
+    ('parse', (('harvester.py', 'parse_page'),
+               ('record_parser.py', 'parser'))),
+])
+OTHER_STAGE = 'other'
+TOP_FUNCTIONS = 10  # number of functions to list per stage
+
+
+def run_profiled(stats_file, func, *args, **kwargs):
+    """
+    Call a function under the profiler and report on the outcome.
+
+    :param stats_file: the file to which the raw stats are written
+    :param func: the function to call, with any further args and kwargs
+    :return: whatever func returns
+    """
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(func, *args, **kwargs)
+    finally:
+        profiler.dump_stats(stats_file)
+        print(stage_report(pstats.Stats(stats_file)))
+        print('Profile stats saved to {0}.'.format(stats_file))
+
+
+def find_stage_entries(stats_dict, stages):
+    """
+    Find the profiled functions which are stage entry points.
+
+    :param stats_dict: the stats attribute of a pstats.Stats object
+    :param stages: dict of stage names and their entry points
+    :return: dict of function to stage name
+    """
+    entry_points = {}
+    for stage, entries in stages.items():
+        for entry in entries:
+            entry_points[entry] = stage
+
+    found = {}
+    for func in stats_dict:
+        filename, line, name = func
+        stage = entry_points.get((os.path.basename(filename), name))
+        if stage:
+            found[func] = stage
+    return found
+
+
+def assign_stages(stats_dict, stages=None):
+    """
+    Determine the stage of every profiled function.
+
+    The callers of each function are searched, breadth first, for the
+    closest stage entry point.
+
+    :param stats_dict: the stats attribute of a pstats.Stats object
+    :param stages: dict of stage names and their entry points (defaults
+        to STAGES)
+    :return: dict of function to stage name
+    """
+    entries = find_stage_entries(stats_dict, stages or STAGES)
+    assigned = {}
+    for func in stats_dict:
+        stage = OTHER_STAGE
+        queue = [func]
+        seen = {func}
+        while queue:
+            current = queue.pop(0)
+            if current in entries:
+                stage = entries[current]
+                break
+            for caller in stats_dict.get(current, (None, ) * 5)[4]:
+                if caller not in seen:
+                    seen.add(caller)
+                    queue.append(caller)
+        assigned[func] = stage
+    return assigned
+
+
+def stage_report(stats, stages=None, top=None):
+    """
+    Produce a report of the hot functions grouped by stage.
+
+    :param stats: pstats.Stats object
+    :param stages: dict of stage names and their entry points (defaults
+        to STAGES)
+    :param top: number of functions to list per stage (defaults to
+        TOP_FUNCTIONS)
+    :return: str
+    """
+    stages = stages or STAGES
+    top = top or TOP_FUNCTIONS
+    stats_dict = stats.stats
+    assigned = assign_stages(stats_dict, stages)
+
+    # stage totals are the cumulative times of their entry points
+    totals = OrderedDict((stage, 0.0) for stage in stages)
+    for func, stage in find_stage_entries(stats_dict, stages).items():
+        totals[stage] += stats_dict[func][3]
+
+    by_stage = OrderedDict((stage, []) for stage in stages)
+    by_stage[OTHER_STAGE] = []
+    for func, stage in assigned.items():
+        by_stage[stage].append((stats_dict[func][2], func))
+
+    lines = ['Time per stage (cumulative):']
+    for stage, total in totals.items():
+        if total:
+            lines.append('  {0:>10.3f}s  {1}'.format(total, stage))
+    lines.append('Hot functions per stage (own time):')
+    for stage, funcs in by_stage.items():
+        if not funcs:
+            continue
+        lines.append('  [{0}]'.format(stage))
+        for own_time, func in sorted(funcs, reverse=True)[:top]:
+            lines.append('  {0:>10.3f}s  {1}:{2}({3})'.format(
+                own_time, *func))
+    return '\n'.join(lines)
@@ -0,0 +1,528 @@
+#!/usr/bin/python
+# -*- coding: utf-8  -*-
+"""
+Parsing and post-processing of K-samsök records.
+
+This is the core shared by kmb_massload and the harvester. It only depends
+on the standard library so that it is quick to import, both for a pure
+harvest and for each of the harvester's worker processes, without paying
+for pywikibot and its user-config checks. Keep it that way, anything
+needing pywikibot belongs in the stages which talk to Commons.
+"""
+from collections import namedtuple
+from functools import lru_cache, partial
+import re
+
+FLIP_NAME_CACHE_SIZE = 4096  # a batch has a few hundred photographers
+LICENSE_CACHE_SIZE = 1024
+
+
+class BbrTemplate(object):
+    """Convenience class for BBR template formatting and logic."""
+
+    __slots__ = ('idno', 'bbr_type')
+    template_type = 'bbr'
+
+    def __init__(self, idno, bbr_type=None):
+        """Initialise the template with an idno and optional type."""
+        self.idno = idno
+        self.bbr_type = bbr_type
+
+    def output(self):
+        """Output the template as wikitext."""
+        if self.determine_type():
+            return '{{BBR|%s|%s}}' % (self.idno, self.bbr_type)
+        return '{{BBR|%s}}' % self.idno
+
+    # @todo: consider using the kulturarvsdata tool to resolve bbr type
+    def determine_type(self):
+        """Determine the bbr_type if not already known."""
+        if not self.bbr_type:
+            num = self.idno[:3]
+            if num == '214':
+                self.bbr_type = 'b'
+            elif num == '213':
+                self.bbr_type = 'a'
+            elif num == '212':
+                self.bbr_type = 'm'
+
+        return (self.bbr_type is not None)
+
+
+class FmisTemplate(object):
+    """Convenience class for FMIS template formatting and logic."""
+
+    __slots__ = ('idno', )
+    template_type = 'fmis'
+
+    def __init__(self, idno):
+        """Initialise the template with an idno."""
+        self.idno = idno
+
+    def output(self):
+        """Output the template as wikitext."""
+        return '{{Fornminne|%s}}' % self.idno
+
+
+# depicted url prefixes (as matched by DEPICTED_PATTERN) and their templates
+DEPICTED_TEMPLATES = {
+    'fmi': FmisTemplate,
+    'bbra': partial(BbrTemplate, bbr_type='a'),
+    'bbrb': partial(BbrTemplate, bbr_type='b'),
+    'bbrm': partial(BbrTemplate, bbr_type='m'),
+    'bbr': BbrTemplate
+}
+DEPICTED_PATTERN = re.compile(
+    r'http://kulturarvsdata\.se/raa/({0})/'.format(
+        '|'.join(DEPICTED_TEMPLATES.keys())))
+
+
+# xml tags to get, as field: (tag, attribute, prefix of attribute value)
+TAG_FIELDS = {'namn': ('ns5:itemLabel', None),            # namn
+              'beskrivning': ('pres:description', None),  # med ord
+              'byline': ('pres:byline', None),            # Okänd, Okänd -> {{unknown}}. kasta om sa "efternamn, fornamn" -> "fornamn efternamn".
+              'motiv': ('pres:motive', None),             # också namn? use only if different from itemLabel
+              'copyright': ('pres:copyright', None),      # RAÄ or Utgången upphovsrätt note that ns5:copyright can be different
+              'license': ('ns5:mediaLicense', None),      # good as comparison to the above
+              'source': ('ns5:lowresSource', None),       # source for image (hook up to download) can I check for highres?
+              'dateFrom': ('ns5:fromTime', None),
+              'dateTo': ('ns5:toTime', None),             # datum kan saknas
+              'bildbeteckning': ('pres:idLabel', None),   # bildbeteckning
+              'landskap': ('ns5:provinceName', None),
+              'lan': ('ns5:countyName', None),
+              'land': ('ns5:country', 'rdf:resource', 'http://kulturarvsdata.se/resurser/aukt/geo/country#'),
+              'kommun': ('ns6:municipality', 'rdf:resource', 'http://kulturarvsdata.se/resurser/aukt/geo/municipality#'),
+              'kommunName': ('ns5:municipalityName', None),
+              'socken': ('ns6:parish', 'rdf:resource', 'http://kulturarvsdata.se/resurser/aukt/geo/parish#'),
+              'sockenName': ('ns5:parishName', None),
+              'thumbnail': ('ns5:thumbnailSource', None),
+              'lastChanged': ('ns5:lastChangedDate', None)}
+# fields set by the parser outside of TAG_FIELDS
+DERIVED_FIELDS = ('latitude', 'longitude', 'bbr', 'fmis', 'avbildar',
+                  'item_classes', 'item_keywords', 'date', 'license_text')
+# other fields which must be included whenever a given field is
+FIELD_DEPENDENCIES = {
+    'latitude': ('longitude', ),
+    'longitude': ('latitude', ),
+    'avbildar': ('bbr', 'fmis'),
+    'bbr': ('avbildar', ),
+    'fmis': ('avbildar', ),
+    'date': ('dateFrom', 'dateTo'),
+    'license_text': ('license', 'copyright', 'byline'),
+    'kommun': ('lan', 'landskap', 'kommunName')  # see handle_gotland()
+}
+# named field selections for common downstream stages
+PROJECTIONS = {
+    'ids': (),
+    'license': ('license_text', )
+}
+
+
+def resolve_fields(fields):
+    """
+    Resolve a field projection into the full set of fields to extract.
+
+    'ID' and 'problem' are always included in the output and need not be
+    given.
+
+    :param fields: None (for all fields), the name of one of the PROJECTIONS,
+        a comma separated string of field names or an iterable of field names
+    :return: frozenset of field names or None for all fields
+    """
+    if fields is None:
+        return None
+    if isinstance(fields, str):
+        fields = PROJECTIONS.get(fields, fields.split(','))
+
+    resolved = set()
+    to_add = [field for field in fields if field]
+    while to_add:
+        field = to_add.pop()
+        if field in resolved:
+            continue
+        if field not in TAG_FIELDS and field not in DERIVED_FIELDS:
+            raise ValueError('Unknown field: {0}'.format(field))
+        resolved.add(field)
+        to_add.extend(FIELD_DEPENDENCIES.get(field, ()))
+    return frozenset(resolved)
+
+
+def extract_tag(dom, tag_info):
+    """
+    Extract the value of a single tag.
+
+    :param dom: the xml for a single record
+    :param tag_info: the tag info, see TAG_FIELDS
+    :return: the value, '' if the tag is missing or None if it is empty
+    """
+    xmlTag = dom.getElementsByTagName(tag_info[0])
+    if len(xmlTag) == 0:
+        return ''
+    if tag_info[1] is None:
+        try:
+            return xmlTag[0].childNodes[0].data.strip('"')
+        except IndexError:
+            # Means data for this field was mising
+            return None
+    return xmlTag[0].attributes[tag_info[1]].value[len(tag_info[2]):]
+
+
+def prescreen_license(dom):
+    """
+    Check if a record would be rejected for not having a free license.
+
+    Only the license and copyright tags are looked at, so this is much
+    cheaper than parsing the record, see process_license().
+
+    :param dom: the xml for a single record
+    :return: (trimmed license, trimmed copyright) if the record would be
+        rejected, else None
+    """
+    license, copyright, license_text, problem = make_license_text(
+        extract_tag(dom, TAG_FIELDS['license']) or '',
+        extract_tag(dom, TAG_FIELDS['copyright']) or '', '')
+    if license_text is None:
+        return license, copyright
+
+
+def parser(dom, A, log, fields=None, postprocess=True):
+    """
+    Parse and process the xml metadata into a dict.
+
+    This is all legacy code from RAA-tools
+
+    :param dom: the xml for a single record
+    :param A: dict to store the parsed data in, containing 'ID' and 'problem'
+    :param log: log to write to
+    :param fields: the fields to extract, see resolve_fields(). Tags for
+        any other fields are never looked up.
+    :param postprocess: whether to apply the post-processing rules, if not
+        these must later be applied using postprocess_columns()
+    """
+    fields = resolve_fields(fields)
+
+    def wanted(field):
+        return fields is None or field in fields
+
+    # also has muni, kommun etc. combine some of these (linked to sv.wiki?) into "place"
+    # if cc-by then include byline in copyright/license
+    for tag, tag_info in TAG_FIELDS.items():
+        if wanted(tag):
+            A[tag] = extract_tag(dom, tag_info)
+
+    # do coordinates separately
+    if wanted('latitude'):
+        xmlTag = dom.getElementsByTagName('georss:where')
+        if not len(xmlTag) == 0:
+            xmlTag = xmlTag[0].getElementsByTagName('gml:coordinates')[0]
+            cs = xmlTag.attributes['cs'].value
+            # dec = xmlTag.attributes['decimal'].value
+            coords = xmlTag.childNodes[0].data.split(cs)
+            if len(coords) == 2:
+                A['latitude'] = coords[1][:8]
+                A['longitude'] = coords[0][:8]
+            else:
+                A['problem'].append(
+                    'Coord was not a point: "{0}"'.format(cs))
+
+    # do ns5:visualizes separately
+    if wanted('avbildar'):
+        A['bbr'] = set()
+        A['fmis'] = set()
+        xmlTag = dom.getElementsByTagName('ns5:visualizes')
+        if not len(xmlTag) == 0:
+            A['avbildar'] = []
+            for x in xmlTag:
+                url = x.attributes['rdf:resource'].value
+                process_depicted(A, url)
+
+    # attempt at determining tags (used for catgories)
+    if wanted('item_classes'):
+        process_tags(A, dom, 'item_classes', 'ns5:itemClassName', log)
+    if wanted('item_keywords'):
+        process_tags(A, dom, 'item_keywords', 'ns5:itemKeyWord', log)
+
+    # memory seems to be an issue so kill dom
+    del dom
+
+    # convert sets to lists to allow for json storage)
+    if wanted('avbildar'):
+        A['bbr'] = list(A['bbr'])
+        A['fmis'] = list(A['fmis'])
+
+    if postprocess:
+        postprocess_record(A, fields)
+    return A
+
+
+def process_tags(entry, dom, label, xml_tag, log):
+    """
+    Process tags of a given type.
+
+    :param entry: the dict of parsed data for the image
+    :param dom: the dom being analysed
+    :param label: the label under which the processed tags should be stored
+    :param xml_tag: the xml tag name to search for
+    :param log: log to write to
+    """
+    entry[label] = []
+    elements = dom.getElementsByTagName(xml_tag)
+    for element in elements:
+        try:
+            entry[label].append(element.childNodes[0].data.strip())
+        except IndexError:
+            # Means data for this field was mising
+            log.write('{0} -- Empty "{1}"'.format(entry['ID'], xml_tag))
+
+
+def normalise_ids(entry):
+    """Normalise municipality, parish and country codes, where present."""
+    if entry.get('kommun'):
+        entry['kommun'] = '{:04d}'.format(int(entry['kommun']))  # zero pad
+    if entry.get('socken'):
+        entry['socken'] = '{:04d}'.format(int(entry['socken']))  # zero pad
+    if entry.get('land'):
+        entry['land'] = entry['land'].upper()
+
+
+def handle_gotland(entry):
+    """
+    Ensure Gotland has municipality code and not just county/province.
+
+    Relies on the fact that county/province and municipality are equivalent
+    in this one case. Which is probably also why this particular municipality
+    id is frequently left out.
+    """
+    if not entry['kommun'] and 'Gotland' in (entry['lan'], entry['landskap']):
+        entry['kommun'] = '0980'  # Gotlands kommun
+        entry['kommunName'] = 'Gotland'
+
+
+def process_depicted(entry, url):
+    """
+    Process any FMIS or BBR entries in depicted and store back in entry.
+
+    Also store bbr, fmis ids that are encountered.
+
+    Note that the url need not be for an fmi/bbr entry and there might
+    be multiple entries of different or the same type.
+    """
+    avbildar = url
+    match = DEPICTED_PATTERN.match(url)
+    if match:
+        idno = url.split('/')[-1]
+        if idno != url[match.end():].strip():
+            raise ValueError(
+                'Depicted started with "{0}" but idno has wrong '
+                'format: {1}'.format(match.group(0), url))
+        template = DEPICTED_TEMPLATES[match.group(1)](idno)
+        entry[template.template_type].add(idno)
+        avbildar = template.output()
+
+    entry['avbildar'].append(avbildar)
+
+
+def process_date(entry):
+    """Create date field from dateTo and dateFrom."""
+    # (can one exist and the other not?)
+    if entry['dateFrom'] == entry['dateTo']:
+        entry['date'] = entry['dateFrom']
+    elif (entry['dateFrom'][:4] == entry['dateTo'][:4]) and \
+            (entry['dateFrom'][5:] == '01-01') and \
+            (entry['dateTo'][5:] == '12-31'):
+        entry['date'] = entry['dateFrom'][:4]
+    else:
+        entry['date'] = '{{other date|between|%s|%s}}' % (
+            entry['dateFrom'], entry['dateTo'])
+
+
+@lru_cache(maxsize=FLIP_NAME_CACHE_SIZE)
+def flip_name(name):
+    """
+    Rearrange "Last, First" names, memoised.
+
+    Same as batchupload.helpers.flip_name(), which is not used as that
+    module imports pywikibot.
+    """
+    parts = name.split(',')
+    if len(parts) != 2:
+        return name
+    return '{0} {1}'.format(parts[1].strip(), parts[0].strip())
+
+
+def process_byline(entry):
+    """Handle unknown entries and rearrange names."""
+    if 'okänd' in entry['byline'].lower():
+        entry['byline'] = '{{unknown}}'
+    elif not entry['byline']:
+        entry['byline'] = '{{not provided}}'
+    else:
+        entry['byline'] = flip_name(entry['byline'])
+
+
+def process_license(entry):
+    """
+    Identify the license, as wikitext, and store as new property.
+
+    Must be called after process_byline().
+    """
+    (entry['license'], entry['copyright'], entry['license_text'],
+     problem) = make_license_text(
+        entry['license'], entry['copyright'], entry['byline'])
+    if problem:
+        entry['problem'].append(problem)
+
+
+@lru_cache(maxsize=LICENSE_CACHE_SIZE)
+def make_license_text(license, copyright, byline):
+    """
+    Identify the license, as wikitext.
+
+    Possible licenses are listed in
+    http://kulturarvsdata.se/resurser/license/license.owl
+
+    Don't include name/byline if unknown.
+
+    :param license: the raw license url
+    :param copyright: the raw copyright holder
+    :param byline: the processed byline
+    :return: (trimmed license, trimmed copyright, license text or None,
+        problem or None)
+    """
+    copyright = copyright.strip()
+    template = None
+    credit = None
+    license_text = None
+    problem = None
+
+    if license:
+        trim = 'http://kulturarvsdata.se/resurser/License#'
+        license = license.strip()[len(trim):]
+
+    # determine template
+    if (license == 'pdmark') or (copyright == 'Utgången upphovsrätt'):
+        template = 'PD-Sweden-photo'
+    elif license == 'by':
+        template = 'CC-BY-2.5'
+    elif license == 'by-sa':
+        template = 'CC-BY-SA-2.5'
+    elif license == 'cc0':
+        template = 'CC0'
+
+    # determine byline if possible
+    if template in ('CC-BY-2.5', 'CC-BY-SA-2.5'):
+        credit = []
+        if byline not in ('{{unknown}}', '{{not provided}}'):
+            credit.append(byline)
+
+        if copyright == 'RAÄ':
+            credit.append('Riksantikvarieämbetet')
+        elif copyright:
+            credit.append(copyright)
+
+    if template:
+        if credit:
+            license_text = '{{%s|%s}}' % (template, ' / '.join(credit))
+        else:
+            license_text = '{{%s}}' % template
+    else:
+        problem = (
+            "It looks like the license isn't free. "
+            'Copyright="{0}", License="{1}".'.format(copyright, license))
+    return license, copyright, license_text, problem
+
+
+def cache_counters():
+    """
+    Return the hits and misses of the memoised functions.
+
+    Each process has its own caches so the counters of worker processes
+    must be passed back to the main process.
+
+    :return: dict of counter name and value, see instrumentation.Stats
+    """
+    counters = {}
+    for func in (flip_name, make_license_text):
+        info = func.cache_info()
+        counters[func.__name__ + '.hits'] = info.hits
+        counters[func.__name__ + '.misses'] = info.misses
+    return counters
+
+
+# a post-processing rule, see POSTPROCESS_RULES
+PostprocessRule = namedtuple(
+    'PostprocessRule', ('field', 'func', 'inputs', 'outputs', 'optional'))
+# the post-processing of a parsed record, in the order in which it is done.
+# Each rule is only applied if its field is wanted (None for always), the
+# outcome of func may only depend on the inputs and the outputs are the
+# fields it sets. Unless optional a rule needs all of its inputs.
+POSTPROCESS_RULES = (
+    PostprocessRule('date', process_date, ('dateFrom', 'dateTo'),
+                    ('date', ), False),
+    PostprocessRule('byline', process_byline, ('byline', ), ('byline', ),
+                    False),
+    PostprocessRule('license_text', process_license,
+                    ('license', 'copyright', 'byline'),
+                    ('license', 'copyright', 'license_text'), False),
+    PostprocessRule(None, normalise_ids, ('kommun', 'socken', 'land'),
+                    ('kommun', 'socken', 'land'), True),
+    PostprocessRule('kommun', handle_gotland,
+                    ('kommun', 'lan', 'landskap', 'kommunName'),
+                    ('kommun', 'kommunName'), False),
+)
+MISSING = object()  # marks an absent field in postprocess_columns()
+
+
+def postprocess_record(entry, fields=None):
+    """
+    Apply the post-processing rules to a single parsed record.
+
+    :param entry: the record, parsed with postprocess=False
+    :param fields: the fields which were extracted, see resolve_fields()
+    """
+    for rule in POSTPROCESS_RULES:
+        if fields is None or rule.field is None or rule.field in fields:
+            rule.func(entry)
+
+
+def postprocess_columns(records, fields=None):
+    """
+    Apply the post-processing rules column by column to many records.
+
+    Gives the same outcome as postprocess_record() on each record but each
+    rule is only evaluated once per distinct combination of its inputs. As
+    a batch only has a few hundred photographers and places, and a handful
+    of licenses, this is a small fraction of the number of records.
+
+    :param records: the records, parsed with postprocess=False
+    :param fields: the fields which were extracted, see resolve_fields()
+    """
+    fields = resolve_fields(fields)
+    records = list(records)
+    for rule in POSTPROCESS_RULES:
+        if not (fields is None or rule.field is None or
+                rule.field in fields):
+            continue
+        keys = [tuple(record.get(field, MISSING) for field in rule.inputs)
+                for record in records]
+
+        outcomes = {}
+        for key in set(keys):
+            if MISSING in key and not rule.optional:
+                continue
+            entry = {field: value for field, value in zip(rule.inputs, key)
+                     if value is not MISSING}
+            entry['problem'] = []
+            rule.func(entry)
+            outcomes[key] = (
+                tuple(entry.get(field, MISSING) for field in rule.outputs),
+                entry['problem'])
+
+        for record, key in zip(records, keys):
+            if key not in outcomes:
+                continue
+            values, problems = outcomes[key]
+            for field, value in zip(rule.outputs, values):
+                if value is not MISSING:
+                    record[field] = value
+            record['problem'].extend(problems)
@@ -0,0 +1,111 @@
+#!/usr/bin/python
+# -*- coding: utf-8  -*-
+"""
+Locality aware ordering of the items processed by make_KMB_info.
+
+Which categories an item looks up mainly depends on its municipality and
+county combined with its tags, and on its name. Processing the items of a
+municipality, and within it those sharing tags, one after the other means a
+category is looked up shortly after the last time it was looked up. A
+bounded cache of the category lookups then hits almost as often as an
+unbounded one would, also for batches far too large to keep every lookup
+in memory.
+
+The effect of the ordering on a cache of a given size is estimated by
+replaying the locality keys of the items through an LRU cache.
+"""
+from collections import OrderedDict
+
+
+class LRUCache(OrderedDict):
+    """Dict holding at most maxsize entries, evicting the least recent."""
+
+    def __init__(self, maxsize):
+        """
+        Initialise an empty cache.
+
+        :param maxsize: the maximum number of entries
+        """
+        super(LRUCache, self).__init__()
+        self.maxsize = maxsize
+
+    def __getitem__(self, key):
+        """Return an entry, marking it as the most recently used."""
+        value = super(LRUCache, self).__getitem__(key)
+        self.move_to_end(key)
+        return value
+
+    def __setitem__(self, key, value):
+        """Add an entry, evicting the least recently used if full."""
+        super(LRUCache, self).__setitem__(key, value)
+        self.move_to_end(key)
+        if len(self) > self.maxsize:
+            self.popitem(last=False)
+
+
+def schedule_key(item):
+    """
+    Return the key by which items are ordered.
+
+    :param item: a KMBItem, or anything with the same attributes
+    :return: tuple
+    """
+    tags = getattr(item, 'item_classes', None) or []
+    return (
+        getattr(item, 'land', None) or 'SE',
+        getattr(item, 'lan', None) or '',
+        getattr(item, 'kommunName', None) or '',
+        tags[0] if tags else '',
+        getattr(item, 'namn', None) or '')
+
+
+def locality_keys(item):
+    """
+    Return the keys which the category lookups of an item depend on.
+
+    :param item: a KMBItem, or anything with the same attributes
+    :return: list
+    """
+    place = (getattr(item, 'kommunName', None), getattr(item, 'lan', None))
+    tags = ((getattr(item, 'item_classes', None) or []) +
+            (getattr(item, 'item_keywords', None) or []))
+    keys = [place]
+    keys.extend((place, tag) for tag in tags)
+    keys.append(getattr(item, 'namn', None))
+    return keys
+
+
+def schedule(items):
+    """
+    Order the items to keep those sharing locality keys together.
+
+    The sort is stable so items with the same key keep their order.
+
+    :param items: dict of KMBItems
+    :return: list of the keys of items, in processing order
+    """
+    return sorted(items, key=lambda key: schedule_key(items[key]))
+
+
+def simulate_hit_rate(items, order, maxsize):
+    """
+    Estimate the hit rate of a bounded cache for a processing order.
+
+    :param items: dict of KMBItems
+    :param order: the keys of items, in processing order
+    :param maxsize: the size of the cache, None for an unbounded one
+    :return: float or None if there are no lookups
+    """
+    cache = LRUCache(maxsize) if maxsize else {}
+    hits = misses = 0
+    for key in order:
+        for locality_key in locality_keys(items[key]):
+            if locality_key in cache:
+                cache[locality_key]  # mark as used
+                hits += 1
+            else:
+                cache[locality_key] = True
+                misses += 1
+    if not hits + misses:
+        return None
+    return hits / (hits + misses)
@@ -0,0 +1,170 @@
+#!/usr/bin/python
+# -*- coding: utf-8  -*-
+"""
+Maintenance script for creating a content hash index of KMB source images.
+
+Downloads the source image of every record in a kmb_massload/harvester
+output file, stores its SHA-1 and checks these against the SHA-1s of files
+already on Commons. Records with an exact duplicate on Commons are then
+flagged by KMBInfo and skipped by the pipelined uploader.
+
+This takes too long to run to be worth doing on the fly as part of
+KMBInfo.load_mappings().
+"""
+import hashlib
+import os
+
+import requests
+import pywikibot
+
+import batchupload.common as common
+
+import importer.config as config
+
+MAPPINGS_DIR = config.DEFAULTS['processing']['mappings_dir']
+INDEX_FILE = 'kmb_sha1.json'
+CHUNK_SIZE = 64 * 1024  # bytes read at a time when downloading
+SAVE_EVERY = 100  # how often to store the index while hashing
+
+
+class Sha1Index(object):
+    """Local index of source image SHA-1s and their duplicates on Commons."""
+
+    def __init__(self, filename=None):
+        """
+        Load the index, or start a new one if the file does not exist.
+
+        :param filename: path to the index file (defaults to
+            mappings/kmb_sha1.json)
+        """
+        self.filename = filename or os.path.join(MAPPINGS_DIR, INDEX_FILE)
+        data = {}
+        if os.path.exists(self.filename):
+            data = common.open_and_read_file(self.filename, as_json=True)
+        self.sources = data.get('sources', {})  # kmb id: sha1
+        self.commons = data.get('commons', {})  # sha1: list of file titles
+
+    def save(self):
+        """Store the index as json, creating its directory if needed."""
+        directory = os.path.dirname(self.filename)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        common.open_and_write_file(
+            self.filename,
+            {'sources': self.sources, 'commons': self.commons},
+            as_json=True)
+
+    def get_commons_duplicates(self, sha1):
+        """
+        Return the Commons files with the given SHA-1.
+
+        :param sha1: sha1 hexdigest
+        :return: list of file titles or None if the hash was never checked
+        """
+        return self.commons.get(sha1)
+
+    def add_commons_file(self, sha1, title):
+        """
+        Record a file known to be on Commons, e.g. one just uploaded.
+
+        :param sha1: sha1 hexdigest of the file
+        :param title: the file title, including the "File:" prefix
+        """
+        titles = self.commons.setdefault(sha1, [])
+        if title not in titles:
+            titles.append(title)
+
+    def get_duplicates_for_id(self, kmb_id):
+        """
+        Return the Commons files identical to the source image of an id.
+
+        :param kmb_id: the KMB id
+        :return: list of file titles
+        """
+        return self.commons.get(self.sources.get(kmb_id)) or []
+
+    def check_commons(self, site, sha1s=None):
+        """
+        Look up which of the hashes already exist on Commons.
+
+        Hashes which have previously been checked are not looked up again.
+        The API only accepts one hash per request so a large index is best
+        checked once, in bulk, ahead of the upload.
+
+        :param site: the pywikibot.Site to check against
+        :param sha1s: the hashes to check (defaults to all source hashes)
+        """
+        sha1s = set(sha1s or self.sources.values())
+        for sha1 in sha1s - set(self.commons.keys()):
+            self.commons[sha1] = [
+                page.title() for page in site.allimages(sha1=sha1)]
+
+
+def hash_url(url):
+    """
+    Download a file and compute its SHA-1, without storing the file.
+
+    :param url: the url to download
+    :return: sha1 hexdigest
+    """
+    sha1 = hashlib.sha1()
+    with requests.get(url, stream=True) as response:
+        response.raise_for_status()
+        for chunk in response.iter_content(CHUNK_SIZE):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def hash_sources(data, index):
+    """
+    Hash the source image of every record not already in the index.
+
+    :param data: dict of records, as output by kmb_massload/harvester
+    :param index: the Sha1Index to add the hashes to
+    """
+    counter = 0
+    for kmb_id, record in data.items():
+        if kmb_id in index.sources or not record.get('source'):
+            continue
+        try:
+            index.sources[kmb_id] = hash_url(record['source'])
+        except requests.RequestException as e:
+            pywikibot.warning('{0} -- could not hash source: {1}'.format(
+                kmb_id, e))
+            continue
+        counter += 1
+        if counter % SAVE_EVERY == 0:
+            index.save()
+            pywikibot.output('{0} sources hashed'.format(counter))
+
+
+def main(*args):
+    """Hash all sources in the input file and check them against Commons."""
+    in_file = None
+    settings_file = None
+    for arg in pywikibot.handle_args(args):
+        option, sep, value = arg.partition(':')
+        if option == '-in_file':
+            in_file = value
+        elif option == '-settings':
+            settings_file = value
+
+    settings = config.load_settings(
+        settings_file, required=bool(settings_file))
+    in_file = in_file or settings['harvest']['data_file']
+    data = common.open_and_read_file(in_file, as_json=True)
+    index = Sha1Index(os.path.join(
+        settings['processing']['mappings_dir'], INDEX_FILE))
+    hash_sources(data, index)
+    index.save()
+    index.check_commons(pywikibot.Site('commons', 'commons'))
+    index.save()
+
+    duplicates = [kmb_id for kmb_id in data
+                  if index.get_duplicates_for_id(kmb_id)]
+    pywikibot.output('{0} of {1} records have an exact duplicate on '
+                     'Commons'.format(len(duplicates), len(data)))
+
+
+if __name__ == '__main__':
+    main()
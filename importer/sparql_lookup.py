@@ -0,0 +1,166 @@
+#!/usr/bin/python
+# -*- coding: utf-8  -*-
+"""
+Chunked and cached execution of the SPARQL queries behind the mappings.
+
+Large queries, such as all K-samsök uris on Wikidata, risk timing out when
+run in one go. Here they are instead split into pages, using LIMIT/OFFSET
+over a total ordering of the results, which are fetched concurrently and
+handed on page by page as raw result bindings, without building any
+pywikibot objects.
+
+The lookups made from the results are cached on disk, keyed by a hash of
+the query, for a limited time.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+import os
+import re
+import time
+
+import pywikibot
+from pywikibot.data import sparql
+
+import batchupload.common as common
+
+SELECT_PATTERN = re.compile(r'SELECT\s+(.*?)\s+WHERE', re.DOTALL | re.I)
+
+
+def cache_key(*parts):
+    """
+    Create a cache key from the json serialisable parts of a request.
+
+    :return: str
+    """
+    return hashlib.sha1(
+        json.dumps(parts, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def read_cache(cache_dir, key, ttl=None):
+    """
+    Return a cached result, unless missing or older than the ttl.
+
+    :param cache_dir: the cache directory
+    :param key: the cache key, see cache_key()
+    :param ttl: maximum age of the result, in seconds (None for no limit)
+    :return: the cached result or None
+    """
+    filename = os.path.join(cache_dir, '{0}.json'.format(key))
+    if not os.path.exists(filename):
+        return None
+    if ttl is not None and time.time() - os.path.getmtime(filename) > ttl:
+        return None
+    return common.open_and_read_file(filename, as_json=True)
+
+
+def write_cache(cache_dir, key, result):
+    """
+    Store a result in the cache.
+
+    :param cache_dir: the cache directory
+    :param key: the cache key, see cache_key()
+    :param result: the json serialisable result
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    common.open_and_write_file(
+        os.path.join(cache_dir, '{0}.json'.format(key)), result, as_json=True)
+
+
+def page_query(query, limit, offset):
+    """
+    Restrict a query to a single page of results.
+
+    The results are ordered by all of the selected variables so that the
+    pages neither overlap nor miss any results.
+
+    :param query: a SELECT query without any solution modifiers
+    :param limit: the page size
+    :param offset: the number of results before the page
+    :return: str
+    """
+    variables = SELECT_PATTERN.search(query).group(1)
+    return '{0} ORDER BY {1} LIMIT {2:d} OFFSET {3:d}'.format(
+        query, variables, limit, offset)
+
+
+class ChunkedSparql(object):
+    """SPARQL endpoint queried one page of results at a time."""
+
+    def __init__(self, endpoint=None, entity_url=None, chunk_size=None,
+                 workers=1):
+        """
+        Initialise the endpoint.
+
+        :param endpoint: the SPARQL endpoint (defaults to the Wikidata
+            Query Service), requires entity_url
+        :param entity_url: the url prefix of the entities in the results
+        :param chunk_size: the number of results per page, if not provided
+            the query is not split up
+        :param workers: the number of pages to fetch concurrently
+        """
+        wdqs = sparql.SparqlQuery(endpoint=endpoint, entity_url=entity_url)
+        self.endpoint = wdqs.endpoint
+        self.entity_url = wdqs.entity_url
+        self.chunk_size = chunk_size
+        self.workers = max(workers or 1, 1)
+
+    def get_id(self, binding):
+        """
+        Return the id of the entity in a uri binding.
+
+        :param binding: the raw result binding
+        :return: str or None
+        """
+        if binding and binding['value'].startswith(self.entity_url):
+            return binding['value'][len(self.entity_url):]
+
+    def fetch(self, query):
+        """
+        Run a single query.
+
+        A new SparqlQuery is used per query since these are not thread safe.
+
+        :param query: the query
+        :return: list of dicts of variable and raw binding (or None)
+        """
+        wdqs = sparql.SparqlQuery(
+            endpoint=self.endpoint, entity_url=self.entity_url)
+        data = wdqs.query(query)
+        if not data or 'results' not in data:
+            raise pywikibot.Error('SPARQL query failed: {0}'.format(query))
+        variables = data['head']['vars']
+        return [{var: row.get(var) for var in variables}
+                for row in data['results']['bindings']]
+
+    def select(self, query):
+        """
+        Yield the results of a query, one page at a time.
+
+        The pages are yielded in order, even though they are fetched
+        concurrently, until a page which is not full is found.
+
+        :param query: a SELECT query without any solution modifiers
+        :return: generator of dicts of variable and raw binding (or None)
+        """
+        if not self.chunk_size:
+            yield from self.fetch(query)
+            return
+
+        offset = 0
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while True:
+                pages = [
+                    executor.submit(
+                        self.fetch,
+                        page_query(query, self.chunk_size,
+                                   offset + i * self.chunk_size))
+                    for i in range(self.workers)]
+                offset += self.workers * self.chunk_size
+                for page in pages:
+                    rows = page.result()
+                    yield from rows
+                    if len(rows) < self.chunk_size:
+                        for pending in pages:
+                            pending.cancel()
+                        return
@@ -1,11 +1,277 @@
 #!/usr/bin/python
 # -*- coding: utf-8  -*-
-"""Tool for uploading a single or multiple files from disc or url."""
+"""
+Tool for uploading a single or multiple files from disc or url.
+
+For KMB batches, where every file is fetched from a url, a pipelined mode
+is also available. In this mode a prefetch stage downloads, hashes and
+duplicate checks the next few images while the current one is uploading,
+so that the download from kmb.raa.se and the upload to Commons overlap.
+"""
+import hashlib
+import os
+import queue
+import shutil
+import sys
+import tempfile
+import threading
+
+import requests
+import pywikibot
+
+import batchupload.common as common
 import batchupload.uploader as uploader
 
+import importer.config as config
+import importer.sha1_index as sha1_index
+
+CHUNK_SIZE = 64 * 1024  # bytes read at a time when downloading
+
+
+class PrefetchedFile(object):
+    """A downloaded file waiting for upload, or the reason it is not."""
+
+    def __init__(self, url, data):
+        """
+        Initialise a prefetched file.
+
+        :param url: the url from which the file was fetched
+        :param data: the BatchUploadTools info entry for the file
+        """
+        self.url = url
+        self.data = data
+        self.path = None
+        self.sha1 = None
+        self.duplicates = []  # files with identical content
+        self.error = None
+
+    def cleanup(self):
+        """Remove the local copy of the file, if any."""
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def download_file(url, target_dir):
+    """
+    Download a file to a local directory, hashing it on the way.
+
+    :param url: the url to download
+    :param target_dir: the directory in which to store the file
+    :return: (path to local file, sha1 hexdigest)
+    """
+    sha1 = hashlib.sha1()
+    handle, path = tempfile.mkstemp(
+        suffix=os.path.splitext(url)[1], dir=target_dir)
+    with os.fdopen(handle, 'wb') as f, \
+            requests.get(url, stream=True) as response:
+        response.raise_for_status()
+        for chunk in response.iter_content(CHUNK_SIZE):
+            sha1.update(chunk)
+            f.write(chunk)
+    return path, sha1.hexdigest()
+
+
+def find_duplicates(sha1, seen, target_site, index):
+    """
+    Find files with the same content as a downloaded file.
+
+    Checks both files earlier in the batch and files already on the target
+    site. The sha1 index is consulted before the target site, and any new
+    lookups are added to it.
+
+    :param sha1: the sha1 hexdigest of the file
+    :param seen: dict of sha1 to url for files earlier in the batch
+    :param target_site: the pywikibot.Site to which files are uploaded
+    :param index: the sha1_index.Sha1Index of known Commons hashes
+    :return: list of urls/page titles for the duplicates
+    """
+    if sha1 in seen:
+        return [seen[sha1]]
+    if index.get_commons_duplicates(sha1) is None:
+        index.check_commons(target_site, [sha1])
+    return index.get_commons_duplicates(sha1)
+
+
+def prefetch_files(info_datas, buffer, target_dir, target_site, index,
+                   stop):
+    """
+    Download, hash and duplicate check files, handing them to a buffer.
+
+    The buffer is bounded so this blocks once enough files are ready for
+    upload. A final None is put in the buffer once all files are handled.
+
+    :param info_datas: the BatchUploadTools info data, keyed by url
+    :param buffer: the queue.Queue to which PrefetchedFiles are handed
+    :param target_dir: the directory in which to store downloaded files
+    :param target_site: the pywikibot.Site to which files are uploaded
+    :param index: the sha1_index.Sha1Index of known Commons hashes
+    :param stop: threading.Event signalling that the upload was aborted
+    """
+    seen = {}
+    try:
+        for url, data in info_datas.items():
+            if stop.is_set():
+                break
+            prefetched = PrefetchedFile(url, data)
+            try:
+                prefetched.path, prefetched.sha1 = download_file(
+                    url, target_dir)
+                prefetched.duplicates = find_duplicates(
+                    prefetched.sha1, seen, target_site, index)
+            except Exception as e:  # report it and move on to the next file
+                prefetched.error = '{0}: {1}'.format(type(e).__name__, e)
+            else:
+                seen.setdefault(prefetched.sha1, url)
+            buffer.put(prefetched)
+    finally:
+        buffer.put(None)
+
+
+def up_all_pipelined(info_path, prefetch=None, cutoff=None, test=False,
+                     target_site=None, settings=None):
+    """
+    Upload all files in a BatchUploadTools info file using a prefetch stage.
+
+    :param info_path: path to the info file (output from make_KMB_info)
+    :param prefetch: the number of files to download ahead of the upload
+        (defaults to the prefetch setting)
+    :param cutoff: the number of files to upload (defaults to all)
+    :param test: whether to only download and check files, without
+        uploading them
+    :param target_site: the pywikibot.Site to upload to (defaults to
+        Commons)
+    :param settings: the settings, see config (defaults to those loaded
+        from any settings file)
+    """
+    settings = settings or config.load_settings()
+    upload_settings = settings['upload']
+    prefetch = prefetch or upload_settings['prefetch']
+    target_site = target_site or pywikibot.Site('commons', 'commons')
+    log = common.LogFile('', upload_settings['log_file'])
+    info_datas = common.open_and_read_file(info_path, as_json=True)
+    if cutoff:
+        info_datas = dict(list(info_datas.items())[:cutoff])
+
+    index = sha1_index.Sha1Index(os.path.join(
+        settings['processing']['mappings_dir'], sha1_index.INDEX_FILE))
+    target_dir = tempfile.mkdtemp(
+        prefix='kmb_upload_', dir=upload_settings['download_dir'])
+    buffer = queue.Queue(maxsize=prefetch)
+    stop = threading.Event()
+    prefetcher = threading.Thread(
+        target=prefetch_files,
+        args=(info_datas, buffer, target_dir, target_site, index, stop),
+        daemon=True)
+    prefetcher.start()
+
+    counter = {'uploaded': 0, 'tested': 0, 'duplicate': 0, 'error': 0}
+    try:
+        for prefetched in iter(buffer.get, None):
+            try:
+                result = upload_prefetched(
+                    prefetched, target_site, test, index)
+            finally:
+                prefetched.cleanup()
+            counter[result[0]] += 1
+            log.write('{0} -- {1}'.format(prefetched.url, result[1]))
+    finally:
+        # unblock the prefetcher in case the upload was aborted
+        stop.set()
+        while prefetcher.is_alive():
+            try:
+                buffer.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        prefetcher.join()
+        shutil.rmtree(target_dir, ignore_errors=True)
+        index.save()
+
+    if test:
+        pywikibot.output(
+            'Tested {tested:d} files, skipped {duplicate:d} duplicates '
+            'and {error:d} failed files.'.format(**counter))
+    else:
+        pywikibot.output(
+            'Uploaded {uploaded:d} files, skipped {duplicate:d} duplicates '
+            'and {error:d} failed files.'.format(**counter))
+    pywikibot.output(log.close_and_confirm())
+
+
+def upload_prefetched(prefetched, target_site, test=False, index=None):
+    """
+    Upload a single prefetched file unless it is a duplicate or failed.
+
+    A failed upload is reported, rather than raised, so that the rest of
+    the batch is still uploaded.
+
+    :param prefetched: the PrefetchedFile to upload
+    :param target_site: the pywikibot.Site to upload to
+    :param test: whether to skip the actual upload
+    :param index: the sha1_index.Sha1Index to which an uploaded file is
+        added, if any
+    :return: (outcome, message) where outcome is one of 'uploaded',
+        'tested', 'duplicate' or 'error'
+    """
+    if prefetched.error:
+        return 'error', 'download failed: {0}'.format(prefetched.error)
+    if prefetched.duplicates:
+        return 'duplicate', 'skipped as duplicate of: {0}'.format(
+            ', '.join(prefetched.duplicates))
+
+    filename = prefetched.data['filename'] + os.path.splitext(
+        prefetched.url)[1]
+    if test:
+        return 'tested', 'test mode, would upload as {0}'.format(filename)
+
+    text = uploader.make_info_page(prefetched.data)
+    try:
+        result = uploader.upload_single_file(
+            filename, prefetched.path, text, target_site,
+            upload_if_badprefix=True)
+    except Exception as e:  # report it and move on to the next file
+        return 'error', 'upload failed: {0}: {1}'.format(
+            type(e).__name__, e)
+    if result.get('error'):
+        return 'error', result.get('error')
+    if index is not None:
+        index.add_commons_file(
+            prefetched.sha1, 'File:{0}'.format(filename))
+    return 'uploaded', result.get('log') or filename
+
 
 def main(*arguments):
-    uploader.main(*arguments)
+    """
+    Command line entry-point.
+
+    Unless -pipelined is given all arguments are passed on to the
+    BatchUploadTools uploader.
+
+    Usage (pipelined):
+        python uploader.py -pipelined -in_path:PATH [-prefetch:INT]
+            [-cutoff:INT] [-test] [-settings:PATH]
+    """
+    if '-pipelined' not in (arguments or sys.argv[1:]):
+        uploader.main(*arguments)
+        return
+
+    options = {}
+    for arg in pywikibot.handle_args(arguments):
+        option, sep, value = arg.partition(':')
+        if option == '-in_path':
+            options['info_path'] = value
+        elif option == '-prefetch':
+            options['prefetch'] = int(value)
+        elif option == '-cutoff':
+            options['cutoff'] = int(value)
+        elif option == '-test':
+            options['test'] = True
+        elif option == '-settings':
+            options['settings'] = config.load_settings(value, required=True)
+
+    if not options.get('info_path'):
+        pywikibot.output('A path to the info file must be given (-in_path).')
+        return
+    up_all_pipelined(**options)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,338 @@
+#!/usr/bin/python
+# -*- coding: utf-8  -*-
+"""
+File based work queue for processing a KMB batch in shards.
+
+The records of a kmb_massload/harvester output file are split into work
+units, keeping the records of each municipality together so that a worker
+gets the most out of its category existence cache. Any number of workers,
+on one machine or on several sharing the queue directory, then claim units,
+process them with make_KMB_info and store the output per unit. Finally the
+outputs are merged into a single make_KMB_info output file.
+
+The queue directory holds a directory per state:
+todo     units waiting to be claimed
+claimed  units being processed, prefixed by the name of the worker
+done     the make_KMB_info output of each finished unit
+along with the keys of the records in their input order, so that the merged
+output is in the same order as that of a single make_KMB_info run.
+
+A unit is claimed by moving it from todo to claimed, which is atomic on a
+local or shared (e.g. NFS) filesystem, so that no two workers ever get the
+same unit. A unit claimed by a worker which then died can be put back with
+-release.
+
+Since the workers only read the mappings, update them (make_KMB_info with
+-update_mappings:True) before starting the workers.
+
+Usage:
+    python work_queue.py -split -in_file:PATH [-queue:DIR] [-shard_size:INT]
+    python work_queue.py -work [-queue:DIR] [-worker:STR]
+    python work_queue.py -release [-queue:DIR] [-timeout:INT]
+    python work_queue.py -merge -out_file:PATH [-queue:DIR] [-force]
+
+Each mode also takes [-settings:PATH], the queue directory, shard size and
+claim timeout defaulting to those in its processing section.
+"""
+from collections import OrderedDict
+import os
+import socket
+import sys
+import time
+
+import batchupload.common as common
+
+import importer.config as config
+
+SHARD_SIZE = config.DEFAULTS['processing']['shard_size']
+CLAIM_TIMEOUT = config.DEFAULTS['processing']['claim_timeout']
+STATES = ('todo', 'claimed', 'done')
+UNIT_NAME = 'unit-{0:05d}.json'
+ORDER_FILE = 'order.json'  # the keys of the records, in input order
+WORKER_SEPARATOR = '--'  # between the worker and unit names when claimed
+
+
+def shard_key(record):
+    """
+    Return the key by which records are kept together.
+
+    :param record: a parsed record
+    :return: str
+    """
+    return record.get('kommun') or record.get('lan') or ''
+
+
+def make_units(data, shard_size=None):
+    """
+    Partition the records into work units.
+
+    Records sharing a shard key are kept in the same unit, unless there are
+    more of them than fit in one.
+
+    :param data: dict of records, as output by kmb_massload/harvester
+    :param shard_size: the maximum number of records in a unit
+    :return: list of dicts of records
+    """
+    shard_size = shard_size or SHARD_SIZE
+    groups = {}
+    for key, record in data.items():
+        groups.setdefault(shard_key(record), []).append(key)
+
+    units = []
+    unit = []
+    for shard in sorted(groups):
+        keys = groups[shard]
+        if unit and len(unit) + len(keys) > shard_size:
+            units.append(unit)
+            unit = []
+        for start in range(0, len(keys), shard_size):
+            chunk = keys[start:start + shard_size]
+            if len(unit) + len(chunk) > shard_size:
+                units.append(unit)
+                unit = []
+            unit.extend(chunk)
+    if unit:
+        units.append(unit)
+    return [{key: data[key] for key in unit} for unit in units]
+
+
+def state_dir(queue_dir, state):
+    """Return the directory of units in the given state, creating it."""
+    path = os.path.join(queue_dir, state)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def list_units(queue_dir, state):
+    """
+    List the units in the given state.
+
+    :param queue_dir: the queue directory
+    :param state: one of STATES
+    :return: sorted list of file names
+    """
+    return sorted(
+        name for name in os.listdir(state_dir(queue_dir, state))
+        if name.endswith('.json'))
+
+
+def split(data, queue_dir, shard_size=None):
+    """
+    Split the records into work units and add them to the queue.
+
+    :param data: dict of records, as output by kmb_massload/harvester
+    :param queue_dir: the queue directory, must not contain any units
+    :param shard_size: the maximum number of records in a unit
+    :return: the number of units
+    :raises ValueError: if the queue already contains units
+    """
+    if any(list_units(queue_dir, state) for state in STATES):
+        raise ValueError('The queue in {0} is not empty.'.format(queue_dir))
+    todo_dir = state_dir(queue_dir, 'todo')
+    write_atomic(os.path.join(queue_dir, ORDER_FILE), list(data))
+    units = make_units(data, shard_size)
+    for i, unit in enumerate(units):
+        write_atomic(os.path.join(todo_dir, UNIT_NAME.format(i)), unit)
+    return len(units)
+
+
+def write_atomic(filename, data):
+    """Write json data so that it never is seen half written."""
+    temp_file = '{0}.tmp'.format(filename)
+    common.open_and_write_file(temp_file, data, as_json=True)
+    os.replace(temp_file, filename)
+
+
+def claim(queue_dir, worker):
+    """
+    Claim the next unit in the queue.
+
+    :param queue_dir: the queue directory
+    :param worker: name of the claiming worker
+    :return: (unit name, path to the claimed unit) or None if the queue is
+        empty
+    """
+    todo_dir = state_dir(queue_dir, 'todo')
+    claimed_dir = state_dir(queue_dir, 'claimed')
+    for name in list_units(queue_dir, 'todo'):
+        claimed = os.path.join(
+            claimed_dir, '{0}{1}{2}'.format(worker, WORKER_SEPARATOR, name))
+        try:
+            os.rename(os.path.join(todo_dir, name), claimed)
+        except FileNotFoundError:
+            continue  # claimed by another worker
+        os.utime(claimed)  # note the time of the claim
+        return name, claimed
+    return None
+
+
+def complete(queue_dir, name, claimed, output):
+    """
+    Store the output of a claimed unit and remove it from the queue.
+
+    :param queue_dir: the queue directory
+    :param name: the unit name
+    :param claimed: path to the claimed unit
+    :param output: the make_KMB_info output for the unit
+    """
+    write_atomic(os.path.join(state_dir(queue_dir, 'done'), name), output)
+    try:
+        os.remove(claimed)
+    except FileNotFoundError:
+        pass  # released meanwhile, redoing it is harmless
+
+
+def release(queue_dir, timeout=None):
+    """
+    Put units claimed longer ago than the timeout back in the queue.
+
+    :param queue_dir: the queue directory
+    :param timeout: the maximum age of a claim, in seconds
+    :return: list of the released unit names
+    """
+    timeout = CLAIM_TIMEOUT if timeout is None else timeout
+    claimed_dir = state_dir(queue_dir, 'claimed')
+    todo_dir = state_dir(queue_dir, 'todo')
+    released = []
+    for claimed in list_units(queue_dir, 'claimed'):
+        path = os.path.join(claimed_dir, claimed)
+        try:
+            if time.time() - os.path.getmtime(path) <= timeout:
+                continue
+            name = claimed.rpartition(WORKER_SEPARATOR)[2]
+            os.rename(path, os.path.join(todo_dir, name))
+        except FileNotFoundError:
+            continue  # completed meanwhile
+        released.append(name)
+    return released
+
+
+def merge(queue_dir, force=False):
+    """
+    Merge the output of all of the units.
+
+    The output is in the input order of the records given to split().
+
+    :param queue_dir: the queue directory
+    :param force: whether to merge even if some units are not done
+    :return: OrderedDict
+    :raises ValueError: if some units are not done, unless forced
+    """
+    pending = (list_units(queue_dir, 'todo') +
+               list_units(queue_dir, 'claimed'))
+    if pending and not force:
+        raise ValueError('{0} units are not yet done.'.format(len(pending)))
+    done_dir = state_dir(queue_dir, 'done')
+    merged = {}
+    for name in list_units(queue_dir, 'done'):
+        merged.update(common.open_and_read_file(
+            os.path.join(done_dir, name), as_json=True))
+
+    order = []
+    order_file = os.path.join(queue_dir, ORDER_FILE)
+    if os.path.exists(order_file):
+        order = common.open_and_read_file(order_file, as_json=True)
+    ordered = OrderedDict(
+        (key, merged.pop(key)) for key in order if key in merged)
+    ordered.update(sorted(merged.items()))  # not in the order, if any
+    return ordered
+
+
+def work(queue_dir, worker=None, settings_file=None, settings=None):
+    """
+    Process units until the queue is empty.
+
+    A single KMBInfo is used for all of the units so that the mappings are
+    loaded, and categories looked up, only once per worker.
+
+    :param queue_dir: the queue directory
+    :param worker: name of the worker (defaults to host and process id)
+    :param settings_file: the settings file, see config
+    :param settings: the settings loaded from settings_file, if already
+        loaded
+    :return: the number of processed units
+    """
+    from importer.make_KMB_info import KMBInfo  # needs pywikibot
+
+    worker = worker or '{0}.{1}'.format(socket.gethostname(), os.getpid())
+    KMBInfo.settings_file = settings_file
+    settings = (settings or config.load_settings(
+        settings_file, required=bool(settings_file)))['processing']
+    # each unit is in effect a checkpoint, so none is needed
+    info = KMBInfo(
+        log_file='{0}.{1}'.format(settings['log_file'], worker),
+        problem_file='{0}.{1}'.format(settings['problem_file'], worker),
+        checkpoint_file=None)
+    info.load_mappings(update_mappings=False)
+    count = 0
+    while True:
+        claimed = claim(queue_dir, worker)
+        if not claimed:
+            break
+        name, path = claimed
+        print('[{0}] : processing {1}.'.format(worker, name))
+        info.process_data(common.open_and_read_file(path, as_json=True))
+        complete(queue_dir, name, path, info.make_info())
+        count += 1
+    info.close()
+    print('[{0}] : processed {1} units.'.format(worker, count))
+    print(info.log.close_and_confirm())
+    return count
+
+
+def main(*args):
+    """Command line entry-point."""
+    usage = __doc__[__doc__.index('Usage:'):]
+    mode = None
+    options = {}
+    for arg in args or sys.argv[1:]:
+        option, sep, value = arg.partition(':')
+        if option in ('-split', '-work', '-release', '-merge'):
+            mode = option[1:]
+        elif option == '-queue':
+            options['queue_dir'] = value
+        elif option in ('-in_file', '-out_file', '-worker'):
+            options[option[1:]] = value
+        elif option == '-settings':
+            options['settings_file'] = value
+        elif option in ('-shard_size', '-timeout'):
+            options[option[1:]] = int(value)
+        elif option == '-force':
+            options['force'] = True
+        else:
+            mode = None
+            break
+
+    if not mode:
+        print(usage)
+        return
+
+    settings_file = options.get('settings_file')
+    settings = config.load_settings(
+        settings_file, required=bool(settings_file))
+    queue_dir = options.get(
+        'queue_dir', settings['processing']['queue_dir'])
+    if mode == 'split' and options.get('in_file'):
+        data = common.open_and_read_file(options['in_file'], as_json=True)
+        count = split(data, queue_dir, options.get(
+            'shard_size', settings['processing']['shard_size']))
+        print('Split {0} records into {1} units in {2}.'.format(
+            len(data), count, queue_dir))
+    elif mode == 'work':
+        work(queue_dir, options.get('worker'), settings_file, settings)
+    elif mode == 'release':
+        released = release(queue_dir, options.get(
+            'timeout', settings['processing']['claim_timeout']))
+        print('Released {0} units: {1}'.format(
+            len(released), ', '.join(released) or '-'))
+    elif mode == 'merge' and options.get('out_file'):
+        data = merge(queue_dir, options.get('force', False))
+        common.open_and_write_file(options['out_file'], data, as_json=True)
+        print('Merged {0} items into {1}.'.format(
+            len(data), options['out_file']))
+    else:
+        print(usage)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+#!/usr/bin/python
+# -*- coding: utf-8  -*-
+import gzip
+import json
+import os
+import tempfile
+import unittest
+
+from importer import category_index
+
+DUMP = (
+    'page_namespace\tpage_title\n'
+    '0\tNot_a_category\n'
+    '14\tChurches_in_Sjöbo_Municipality\n'
+    '14\tCats_in_Sweden\n'
+    '14\tÖverlöv\n'
+    '14\tAbbey\n'
+)
+
+
+class TestCategoryIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.dump_file = os.path.join(self.temp_dir, 'titles.gz')
+        self.index_file = os.path.join(self.temp_dir, 'categories.idx')
+        with gzip.open(self.dump_file, 'wt', encoding='utf-8') as f:
+            f.write(DUMP)
+        self.count = category_index.build_index(
+            self.dump_file, self.index_file)
+        self.index = category_index.load_index(self.index_file)
+
+    def tearDown(self):
+        self.index.close()
+        for filename in os.listdir(self.temp_dir):
+            os.remove(os.path.join(self.temp_dir, filename))
+        os.rmdir(self.temp_dir)
+
+    def test_build_index(self):
+        self.assertEqual(self.count, 4)
+
+    def test_contains(self):
+        for title in ('Abbey', 'Cats in Sweden', 'Överlöv',
+                      'Category:Churches in Sjöbo Municipality',
+                      'category:cats_in_Sweden'):
+            self.assertIn(title, self.index)
+
+    def test_not_contains(self):
+        for title in ('Not a category', 'Aardvark', 'Cats', 'Zebra',
+                      'Cats in Sweden2'):
+            self.assertNotIn(title, self.index)
+
+    def test_contains_many(self):
+        titles = ['Title {0}'.format(i * 7) for i in range(500)]
+        dump_file = os.path.join(self.temp_dir, 'many.txt')
+        index_file = os.path.join(self.temp_dir, 'many.idx')
+        with open(dump_file, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(titles))
+        category_index.build_index(dump_file, index_file)
+        index = category_index.CategoryIndex(index_file)
+        for i in range(500 * 7):
+            self.assertEqual('Title {0}'.format(i) in index, i % 7 == 0)
+        index.close()
+
+    def test_load_missing_index(self):
+        self.assertIsNone(category_index.load_index(
+            os.path.join(self.temp_dir, 'missing.idx')))
+
+    def test_empty_index(self):
+        empty_file = os.path.join(self.temp_dir, 'empty.idx')
+        open(empty_file, 'wb').close()
+        index = category_index.CategoryIndex(empty_file)
+        self.assertNotIn('Abbey', index)
+        index.close()
+
+    def test_main_uses_settings(self):
+        mappings_dir = os.path.join(self.temp_dir, 'custom')
+        os.mkdir(mappings_dir)
+        settings_file = os.path.join(self.temp_dir, 'settings.json')
+        with open(settings_file, 'w') as f:
+            json.dump({'processing': {'mappings_dir': mappings_dir}}, f)
+        category_index.main(
+            '-dump:{0}'.format(self.dump_file),
+            '-settings:{0}'.format(settings_file))
+        index_file = os.path.join(mappings_dir, category_index.INDEX_FILE)
+        index = category_index.load_index(index_file)
+        self.assertIn('Abbey', index)
+        index.close()
+        os.remove(index_file)
+        os.rmdir(mappings_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
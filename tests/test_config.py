@@ -0,0 +1,43 @@
+#!/usr/bin/python
+# -*- coding: utf-8  -*-
+import os
+import unittest
+
+from importer import config
+
+
+class TestMergeSettings(unittest.TestCase):
+
+    def test_merge_settings_empty(self):
+        self.assertEqual(config.merge_settings({}), config.DEFAULTS)
+
+    def test_merge_settings_section(self):
+        settings = config.merge_settings(
+            {'throttle': {'delay': 2}, 'keywords': ['katt']})
+        self.assertEqual(settings['throttle']['delay'], 2)
+        self.assertEqual(
+            settings['throttle']['page_size'],
+            config.DEFAULTS['throttle']['page_size'])
+        self.assertEqual(settings['keywords'], ['katt'])
+
+    def test_merge_settings_does_not_alter_defaults(self):
+        config.merge_settings({'throttle': {'delay': 2}})
+        self.assertEqual(config.DEFAULTS['throttle']['delay'], 0.5)
+
+    def test_merge_settings_unknown_section(self):
+        with self.assertRaises(ValueError):
+            config.merge_settings({'throtle': {}})
+
+    def test_merge_settings_unknown_key(self):
+        with self.assertRaises(ValueError):
+            config.merge_settings({'throttle': {'dealy': 2}})
+
+    def test_example_settings(self):
+        example_file = os.path.join(
+            os.path.dirname(config.__file__), 'settings.example.json')
+        settings = config.load_settings(example_file, required=True)
+        self.assertEqual(settings['keywords'], ['katt', 'runsten'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+#!/usr/bin/python
+# -*- coding: utf-8  -*-
+import unittest
+
+import requests
+
+from importer import config, fake_server, harvester
+from importer.kmb_massload import kmb_wrapper
+
+
+class TestFakeServer(unittest.TestCase):
+
+    def setUp(self):
+        self.config = fake_server.FakeServiceConfig(total_hits=30, rows=5)
+        self.server = fake_server.FakeServer(self.config, port=0)
+        self.server.start()
+        self.endpoints = self.server.endpoints()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_ksamsok_search(self):
+        url = harvester.create_url(
+            'katt', 20, 21, 'test', api_url=self.endpoints['ksamsok'])
+        source = harvester.fetch_page(url)
+        page = harvester.parse_page(source, fields='ids')
+        self.assertEqual(harvester.get_total_hits_from_source(source), 30)
+        self.assertEqual(len(page.ids), 10)
+        self.assertEqual(len(set(page.ids)), 10)
+        self.assertEqual(page.ids[0], fake_server.make_id(20))
+
+    def test_kmb_record(self):
+        log = harvester.BufferedLog()
+        record = kmb_wrapper(fake_server.make_id(15), log,
+                             record_url=self.endpoints['kmb_record'])
+        self.assertEqual(record['ID'], fake_server.make_id(15))
+        self.assertEqual(record['problem'], [])
+        self.assertTrue(record['source'].startswith(self.server.base_url))
+
+    def test_heritage_continue(self):
+        url = '{0}?limit=3'.format(self.endpoints['heritage'])
+        data = requests.get(url).json()
+        self.assertEqual(len(data['monuments']), 3)
+        self.assertEqual(data['continue'], {'srcontinue': '3'})
+        data = requests.get(url + '&srcontinue=3').json()
+        self.assertEqual(len(data['monuments']), 2)
+        self.assertNotIn('continue', data)
+
+    def test_sparql(self):
+        query = 'SELECT ?item ?value ?P373 WHERE { ?item wdt:P777 ?value }'
+        data = requests.get(
+            self.endpoints['sparql'], params={'query': query}).json()
+        self.assertEqual(data['head']['vars'], ['item', 'value', 'P373'])
+        self.assertEqual(
+            data['results']['bindings'][0]['item']['value'],
+            fake_server.ENTITY_URL + 'Q1')
+
+    def test_endpoints_are_valid_settings(self):
+        settings = config.merge_settings({'endpoints': self.endpoints})
+        self.assertEqual(settings['endpoints']['sparql_entity'],
+                         fake_server.ENTITY_URL)
+
+    def test_error_injection(self):
+        self.config.error_rate = 1
+        self.config.retry_after = 2
+        response = requests.get(self.endpoints['ksamsok'])
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers['Retry-After'], '2')
+
+
+if __name__ == '__main__':
+    unittest.main()
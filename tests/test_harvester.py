@@ -1,7 +1,10 @@
 #!/usr/bin/python
 # -*- coding: utf-8  -*-
+from concurrent.futures import ProcessPoolExecutor
 import os
+import requests
 import unittest
+from unittest import mock
 
 import batchupload.common as common
 import importer.harvester as harvester
@@ -24,6 +27,17 @@ class TestUrl(unittest.TestCase):
         self.assertEqual(harvester.create_url(
             keyword, hits_limit, start_at, api_key), result)
 
+    def test_create_url_changed_since(self):
+        result = ("http://kulturarvsdata.se/ksamsok/api?x-api=test"
+                  "&method=search&hitsPerPage=50"
+                  "&startRecord=1"
+                  "&query=serviceOrganization=RA%C3%84%20"
+                  "and%20serviceName=KMB%20"
+                  "and%20itemType=foto%20and%20mediaLicense=*%20"
+                  "and%20text=katt%20and%20lastChangedDate%3E%3D2017-09-01")
+        self.assertEqual(harvester.create_url(
+            "katt", 50, 1, "test", changed_since="2017-09-01"), result)
+
 
 class TestParser(unittest.TestCase):
 
@@ -78,6 +92,7 @@ class TestParser(unittest.TestCase):
             "lan": "Stockholm",
             "land": "SE",
             "landskap": "Södermanland",
+            "lastChanged": "2005-05-10",
             "license": "by",
             "license_text": "{{CC-BY-2.5|Bengt A Lundberg / Riksantikvarieämbetet}}",
             "motiv": "Tyresö",
@@ -92,6 +107,309 @@ class TestParser(unittest.TestCase):
             harvester.parse_record(record, record_dict, self.log),
             result)
 
+    def test_parse_entry_license_projection(self):
+        records = harvester.get_records_from_file(self.cat_file)
+        record = harvester.split_records(records)[4]
+        result = {
+            "ID": "16000300035205",
+            "byline": "Bengt A Lundberg",
+            "copyright": "RAÄ",
+            "license": "by",
+            "license_text": (
+                "{{CC-BY-2.5|Bengt A Lundberg / Riksantikvarieämbetet}}"),
+            "problem": []
+        }
+        record_dict = {"ID": "16000300035205", "problem": []}
+        self.assertEqual(
+            harvester.parse_record(record, record_dict, self.log, 'license'),
+            result)
+
+    def test_get_total_hits_from_source(self):
+        with open(self.cat_file) as f:
+            source = f.read()
+        self.assertEqual(harvester.get_total_hits_from_source(source), 14)
+
+    def test_parse_page(self):
+        with open(self.cat_file) as f:
+            source = f.read()
+        page = harvester.parse_page(source)
+        results = page.records
+        self.assertEqual(len(results), 14)
+        self.assertEqual(page.ids, list(results.keys()))
+        self.assertEqual(
+            page.messages, ['16001000331944 -- Empty "ns5:itemClassName"'])
+
+        record = harvester.split_records(
+            harvester.get_records_from_file(self.cat_file))[4]
+        id_no = harvester.extract_id_number(record)
+        expected = harvester.parse_record(
+            record, {'ID': id_no, 'problem': []}, self.log)
+        self.assertEqual(results[id_no], expected)
+
+    def test_parse_page_columnar(self):
+        with open(self.cat_file) as f:
+            source = f.read()
+        expected = harvester.parse_page(source)
+        page = harvester.parse_page(source, columnar=True)
+        self.assertEqual(page.records, expected.records)
+        self.assertEqual(page.messages, expected.messages)
+
+    def test_parse_page_columnar_projection(self):
+        with open(self.cat_file) as f:
+            source = f.read()
+        self.assertEqual(
+            harvester.parse_page(source, 'license', columnar=True).records,
+            harvester.parse_page(source, 'license').records)
+
+    def test_parse_page_in_worker_process(self):
+        with open(self.cat_file) as f:
+            source = f.read()
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            future = executor.submit(harvester.parse_page, source)
+            results = future.result().records
+        self.assertEqual(results, harvester.parse_page(source).records)
+
+    def test_parse_page_skip(self):
+        with open(self.cat_file) as f:
+            source = f.read()
+        skip = dict.fromkeys(('16000300028666', '16000300035205'))
+        page = harvester.parse_page(source, skip=skip)
+        results = page.records
+        self.assertEqual(len(page.ids), 14)
+        self.assertEqual(len(results), 12)
+        self.assertFalse(set(skip.keys()) & set(results.keys()))
+
+    def test_parse_page_skip_unchanged(self):
+        with open(self.cat_file) as f:
+            source = f.read()
+        skip = {'16000300028666': '2005-05-10',  # unchanged
+                '16001000372297': '2005-05-10'}  # changed since
+        results = harvester.parse_page(source, skip=skip).records
+        self.assertEqual(len(results), 13)
+        self.assertNotIn('16000300028666', results)
+        self.assertIn('16001000372297', results)
+
+    def test_parse_page_prescreen(self):
+        with open(self.cat_file) as f:
+            source = f.read()
+        source = source.replace(
+            'License#by</ns5:mediaLicense>',
+            'License#by-nc</ns5:mediaLicense>', 1)
+        expected = harvester.parse_page(source)
+        page = harvester.parse_page(source, prescreen=True)
+        self.assertEqual(page.rejects, {'16000300028666': ('by-nc', 'RAÄ')})
+        self.assertEqual(len(page.ids), 14)
+        self.assertEqual(len(page.records), 13)
+        self.assertNotIn('16000300028666', page.records)
+        self.assertIsNone(
+            expected.records['16000300028666']['license_text'])
+        for id_no, record in page.records.items():
+            self.assertEqual(record, expected.records[id_no])
+
+    def test_delta_query_reject(self):
+        with open(self.cat_file) as f:
+            source = f.read()
+        test_dir = os.path.split(__file__)[0]
+        store = harvester.HarvestStore(
+            os.path.join(test_dir, 'no_data.json'),
+            os.path.join(test_dir, 'no_index.json'))
+        store.records = harvester.parse_page(source).records
+        store.set_keyword_ids('katt', list(store.records))
+        store.set_keyword_ids('runsten', ['16000300028666'])
+        store.set_last_harvest('katt', '2017-09-01')
+
+        # a record changed since is no longer freely licensed
+        source = source.replace(
+            'License#by</ns5:mediaLicense>',
+            'License#by-nc</ns5:mediaLicense>', 1)
+        rejects = harvester.BufferedLog()
+        with mock.patch.object(harvester, 'fetch_page_throttled',
+                               return_value=source):
+            ids = harvester.get_keyword_data(
+                'katt', 'test', self.log, store, delta='query',
+                controller=mock.Mock(page_size=500), rejects=rejects)
+        self.assertEqual(len(set(ids)), 13)
+        self.assertNotIn('16000300028666', ids)
+        self.assertEqual(rejects.messages, ['16000300028666\tby-nc\tRAÄ'])
+        store.set_keyword_ids('katt', ids)
+        self.assertEqual(len(store.get_keyword_records()), 13)
+
+    def test_parse_page_prescreen_all_free(self):
+        with open(self.cat_file) as f:
+            source = f.read()
+        page = harvester.parse_page(source, prescreen=True)
+        self.assertEqual(page.rejects, {})
+        self.assertEqual(page.records, harvester.parse_page(source).records)
+
+
+class TestThrottleController(unittest.TestCase):
+
+    def setUp(self):
+        self.log = harvester.BufferedLog()
+        self.controller = harvester.ThrottleController(
+            page_size=200, min_page_size=50, max_page_size=500,
+            page_step=50, delay=1.0, min_delay=0.1, max_delay=10.0,
+            target_latency=5.0, max_page_bytes=1000, log=self.log)
+
+    def test_quick_response(self):
+        self.controller.record_success(1.0, 500)
+        self.assertEqual(self.controller.page_size, 250)
+        self.assertAlmostEqual(self.controller.delay, 0.8)
+        self.assertEqual(len(self.log.messages), 1)
+
+    def test_slow_response(self):
+        self.controller.record_success(6.0, 500)
+        self.assertEqual(self.controller.page_size, 100)
+        self.assertAlmostEqual(self.controller.delay, 1.5)
+
+    def test_large_response(self):
+        self.controller.record_success(1.0, 2000)
+        self.assertEqual(self.controller.page_size, 100)
+        self.assertAlmostEqual(self.controller.delay, 1.0)
+
+    def test_failure(self):
+        error = requests.ConnectionError('timeout')
+        self.controller.record_failure(error)
+        self.assertEqual(self.controller.page_size, 100)
+        self.assertAlmostEqual(self.controller.delay, 2.0)
+
+    def test_failure_retry_after(self):
+        response = requests.Response()
+        response.status_code = 429
+        response.headers['Retry-After'] = '7'
+        error = requests.HTTPError('Too many requests', response=response)
+        self.controller.record_failure(error)
+        self.assertAlmostEqual(self.controller.delay, 7.0)
+
+    def test_bounds(self):
+        for i in range(10):
+            self.controller.record_failure(requests.ConnectionError())
+        self.assertEqual(self.controller.page_size, 50)
+        self.assertAlmostEqual(self.controller.delay, 10.0)
+        for i in range(50):
+            self.controller.record_success(0.1, 10)
+        self.assertEqual(self.controller.page_size, 500)
+        self.assertAlmostEqual(self.controller.delay, 0.1)
+
+    def test_unchanged_not_logged(self):
+        self.controller.page_size = 500
+        self.controller.delay = 0.1
+        self.controller.record_success(0.1, 10)
+        self.assertEqual(self.log.messages, [])
+
+
+def make_http_error(status_code):
+    response = requests.Response()
+    response.status_code = status_code
+    return requests.HTTPError(str(status_code), response=response)
+
+
+class TestFetchPageThrottled(unittest.TestCase):
+
+    def make_controller(self, max_retries):
+        return harvester.ThrottleController(
+            delay=0, min_delay=0, max_retries=max_retries)
+
+    def fetch(self, max_retries, outcomes):
+        with mock.patch.object(harvester, 'fetch_page',
+                               side_effect=outcomes) as fetch_mock:
+            try:
+                return harvester.fetch_page_throttled(
+                    'url', self.make_controller(max_retries))
+            finally:
+                self.calls = fetch_mock.call_count
+
+    def test_success(self):
+        self.assertEqual(self.fetch(0, ['source']), 'source')
+        self.assertEqual(self.calls, 1)
+
+    def test_no_retries(self):
+        with self.assertRaises(requests.HTTPError):
+            self.fetch(0, [make_http_error(503), 'source'])
+        self.assertEqual(self.calls, 1)
+
+    def test_retries(self):
+        outcomes = [requests.ConnectionError(), make_http_error(429),
+                    make_http_error(503), 'source']
+        self.assertEqual(self.fetch(3, outcomes), 'source')
+        self.assertEqual(self.calls, 4)
+
+    def test_retries_exhausted(self):
+        with self.assertRaises(requests.ConnectionError):
+            self.fetch(2, [requests.ConnectionError()] * 3 + ['source'])
+        self.assertEqual(self.calls, 3)
+
+    def test_client_error_not_retried(self):
+        for status_code in (400, 401, 403, 404):
+            with self.assertRaises(requests.HTTPError):
+                self.fetch(5, [make_http_error(status_code), 'source'])
+            self.assertEqual(self.calls, 1)
+
+
+class TestHarvestStore(unittest.TestCase):
+
+    def setUp(self):
+        test_dir = os.path.split(__file__)[0]
+        self.data_file = os.path.join(test_dir, "test_store_data.json")
+        self.index_file = os.path.join(test_dir, "test_store_index.json")
+        self.store = harvester.HarvestStore(self.data_file, self.index_file)
+
+    def tearDown(self):
+        for filename in (self.data_file, self.index_file):
+            if os.path.exists(filename):
+                os.remove(filename)
+
+    def test_get_keyword_records(self):
+        self.store.add('1', {'ID': '1'})
+        self.store.add('2', {'ID': '2'})
+        self.store.add('3', {'ID': '3'})
+        self.store.set_keyword_ids('katt', ['1', '2'])
+        self.store.set_keyword_ids('runsten', ['2', '3', '2'])
+        self.assertEqual(self.store.keywords['runsten'], {'ids': ['2', '3']})
+        self.assertEqual(
+            set(self.store.get_keyword_records(['katt']).keys()), {'1', '2'})
+        self.assertEqual(
+            set(self.store.get_keyword_records().keys()), {'1', '2', '3'})
+
+    def test_get_keyword_records_missing(self):
+        self.store.add('1', {'ID': '1'})
+        self.store.set_keyword_ids('katt', ['1', '2'])  # 2 never stored
+        self.assertEqual(
+            self.store.get_keyword_records(['katt', 'runsten']),
+            {'1': {'ID': '1'}})
+
+    def test_remove(self):
+        self.store.add('1', {'ID': '1'})
+        self.store.add('2', {'ID': '2'})
+        self.store.set_keyword_ids('katt', ['1', '2'])
+        self.store.set_keyword_ids('runsten', ['2'])
+        self.store.set_last_harvest('hus', '2017-09-01')
+        self.store.remove('2')
+        self.assertEqual(self.store.records, {'1': {'ID': '1'}})
+        self.assertEqual(self.store.get_keyword_ids('katt'), ['1'])
+        self.assertEqual(self.store.get_keyword_ids('runsten'), [])
+        self.assertEqual(
+            set(self.store.get_keyword_records()), {'1'})
+
+    def test_save_and_reload(self):
+        self.store.add('1', {'ID': '1'})
+        self.store.set_keyword_ids('katt', ['1'])
+        self.store.save()
+        reloaded = harvester.HarvestStore(self.data_file, self.index_file)
+        self.assertEqual(reloaded.records, {'1': {'ID': '1'}})
+        self.assertEqual(reloaded.keywords, {'katt': {'ids': ['1']}})
+        self.assertEqual(reloaded.current, set())
+
+    def test_last_harvest_and_change_dates(self):
+        self.store.add('1', {'ID': '1', 'lastChanged': '2005-05-10'})
+        self.store.add('2', {'ID': '2'})
+        self.store.set_keyword_ids('katt', ['1', '2'])
+        self.store.set_last_harvest('katt', '2017-09-01')
+        self.assertEqual(self.store.get_last_harvest('katt'), '2017-09-01')
+        self.assertIsNone(self.store.get_last_harvest('runsten'))
+        self.assertEqual(self.store.get_keyword_ids('katt'), ['1', '2'])
+        self.assertEqual(self.store.get_change_dates(), {'1': '2005-05-10'})
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,71 @@
+#!/usr/bin/python
+# -*- coding: utf-8  -*-
+import json
+import os
+import unittest
+
+from importer.instrumentation import Stats
+
+
+class TestStats(unittest.TestCase):
+
+    def setUp(self):
+        self.stats = Stats()
+        test_dir = os.path.split(__file__)[0]
+        self.stats_file = os.path.join(test_dir, "test_stats.json")
+
+    def tearDown(self):
+        if os.path.exists(self.stats_file):
+            os.remove(self.stats_file)
+
+    def test_count(self):
+        self.stats.count('hits')
+        self.stats.count('hits', 2)
+        self.assertEqual(self.stats.summary()['counters'], {'hits': 3})
+
+    def test_hit_rates(self):
+        self.stats.count('cache.hits', 3)
+        self.stats.count('cache.misses', 1)
+        self.stats.count('other.misses', 2)
+        self.assertEqual(
+            self.stats.summary()['hit_rates'], {'cache': 0.75})
+
+    def test_timer(self):
+        self.stats.add_time('fetch', 1.0)
+        self.stats.add_time('fetch', 3.0)
+        with self.stats.timer('parse'):
+            pass
+        timers = self.stats.summary()['timers']
+        self.assertEqual(
+            timers['fetch'],
+            {'calls': 2, 'total': 4.0, 'mean': 2.0, 'max': 3.0})
+        self.assertEqual(timers['parse']['calls'], 1)
+
+    def test_timed(self):
+        @self.stats.timed('double')
+        def double(value):
+            return 2 * value
+
+        self.assertEqual(double(2), 4)
+        self.assertEqual(self.stats.summary()['timers']['double']['calls'], 1)
+
+    def test_dump(self):
+        self.stats.count('hits')
+        self.stats.dump(self.stats_file)
+        with open(self.stats_file) as f:
+            self.assertEqual(json.load(f)['counters'], {'hits': 1})
+
+    def test_snapshot(self):
+        self.stats.enable_snapshots(self.stats_file, 0.000001)
+        self.stats.last_snapshot = 0
+        self.stats.count('hits')
+        self.assertTrue(os.path.exists(self.stats_file))
+
+    def test_reset(self):
+        self.stats.count('hits')
+        self.stats.reset()
+        self.assertEqual(self.stats.summary()['counters'], {})
+
+
+if __name__ == '__main__':
+    unittest.main()
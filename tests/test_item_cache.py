@@ -0,0 +1,87 @@
+#!/usr/bin/python
+# -*- coding: utf-8  -*-
+import os
+import shutil
+import tempfile
+import unittest
+
+from importer import item_cache
+
+OUTPUT = {'info': '{{Kulturmiljöbild-image}}', 'filename': 'Katt - KMB - 1',
+          'cats': ['Cats in Sweden'], 'meta_cats': []}
+
+
+class TestItemKey(unittest.TestCase):
+
+    def test_item_key(self):
+        record = {'ID': '1', 'namn': 'Katt'}
+        self.assertEqual(
+            item_cache.item_key(record, 'batch'),
+            item_cache.item_key({'namn': 'Katt', 'ID': '1'}, 'batch'))
+        self.assertNotEqual(
+            item_cache.item_key(record, 'batch'),
+            item_cache.item_key(record, 'other batch'))
+
+
+class TestItemCache(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.cache = item_cache.ItemCache(
+            os.path.join(self.temp_dir, 'cache'))
+        self.versions = {'tags': 'v1', 'kommun': 'v1'}
+        self.key = item_cache.item_key({'ID': '1'})
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_file_version(self):
+        filename = os.path.join(self.temp_dir, 'tags.json')
+        self.assertIsNone(item_cache.file_version(filename))
+        with open(filename, 'w') as f:
+            f.write('{}')
+        version = item_cache.file_version(filename)
+        with open(filename, 'w') as f:
+            f.write('{"a": 1}')
+        self.assertNotEqual(item_cache.file_version(filename), version)
+
+    def test_code_version(self):
+        filename = os.path.join(self.temp_dir, 'code.py')
+        with open(filename, 'w') as f:
+            f.write('x = 1')
+        version = item_cache.code_version(filename)
+        self.assertEqual(item_cache.code_version(filename), version)
+        with open(filename, 'w') as f:
+            f.write('x = 2')
+        self.assertNotEqual(item_cache.code_version(filename), version)
+
+    def test_get_missing(self):
+        self.assertIsNone(self.cache.get(self.key, self.versions.get))
+
+    def test_put_and_get(self):
+        self.assertTrue(self.cache.put(
+            self.key, {'tags': 'v1'}, OUTPUT))
+        self.assertEqual(self.cache.get(self.key, self.versions.get), OUTPUT)
+
+    def test_get_mapping_changed(self):
+        self.cache.put(self.key, {'tags': 'v1'}, OUTPUT)
+        self.versions['tags'] = 'v2'
+        self.assertIsNone(self.cache.get(self.key, self.versions.get))
+
+    def test_get_other_mapping_changed(self):
+        self.cache.put(self.key, {'tags': 'v1'}, OUTPUT)
+        self.versions['kommun'] = 'v2'
+        self.assertEqual(self.cache.get(self.key, self.versions.get), OUTPUT)
+
+    def test_get_unknown_mapping(self):
+        self.cache.put(self.key, {'churches': 'v1'}, OUTPUT)
+        self.assertIsNone(
+            self.cache.get(self.key, self.versions.__getitem__))
+
+    def test_put_unknown_version(self):
+        self.assertFalse(self.cache.put(self.key, {'tags': None}, OUTPUT))
+        self.assertIsNone(self.cache.get(self.key, self.versions.get))
+
+
+if __name__ == '__main__':
+    unittest.main()
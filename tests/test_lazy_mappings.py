@@ -0,0 +1,86 @@
+#!/usr/bin/python
+# -*- coding: utf-8  -*-
+import unittest
+
+from importer.lazy_mappings import LazyMappings, MappingLoadError
+
+
+class TestLazyMappings(unittest.TestCase):
+
+    def setUp(self):
+        self.calls = []
+        self.mappings = LazyMappings()
+        self.mappings.register('tags', self.make_loader('tags'))
+        self.mappings.register('churches', self.make_loader('churches'),
+                               lambda: 'v1')
+
+    def make_loader(self, name):
+        def loader():
+            self.calls.append(name)
+            return {'name': name}
+        return loader
+
+    def test_not_loaded_before_use(self):
+        self.assertEqual(self.calls, [])
+        self.assertIn('tags', self.mappings)
+        self.assertEqual(self.calls, [])
+
+    def test_loaded_once(self):
+        self.assertEqual(self.mappings['tags'], {'name': 'tags'})
+        self.assertEqual(self.mappings.get('tags'), {'name': 'tags'})
+        self.assertEqual(self.calls, ['tags'])
+
+    def test_touched(self):
+        self.mappings['churches']
+        self.assertEqual(self.mappings.touched, ['churches'])
+        self.assertEqual(self.mappings.untouched(), ['tags'])
+
+    def test_unregistered(self):
+        with self.assertRaises(KeyError):
+            self.mappings['unknown']
+        self.assertIsNone(self.mappings.get('unknown'))
+        self.assertNotIn('unknown', self.mappings)
+
+    def test_register_replaces_loaded(self):
+        self.mappings['tags']
+        self.mappings.register('tags', lambda: {'name': 'new'})
+        self.assertEqual(self.mappings['tags'], {'name': 'new'})
+
+    def test_read(self):
+        self.mappings['tags']
+        self.mappings.get('churches')
+        self.mappings.get('unknown')
+        self.assertEqual(self.mappings.read, {'tags', 'churches'})
+        self.mappings.reset_read()
+        self.mappings['tags']
+        self.assertEqual(self.mappings.read, {'tags'})
+
+    def test_version(self):
+        self.assertEqual(self.mappings.version('churches'), 'v1')
+        self.assertEqual(self.calls, [])
+        self.assertEqual(self.mappings.read, set())
+        self.assertIsNone(self.mappings.version('tags'))
+        with self.assertRaises(KeyError):
+            self.mappings.version('unknown')
+
+    def test_version_load_first(self):
+        self.mappings.register('churches', self.make_loader('churches'),
+                               lambda: self.calls[:], load_first=True)
+        self.assertEqual(self.mappings.version('churches'), ['churches'])
+        self.assertEqual(self.mappings.read, set())
+
+    def test_load_error(self):
+        def loader():
+            self.calls.append('broken')
+            raise IOError('service down')
+
+        self.mappings.register('broken', loader)
+        for i in range(2):
+            with self.assertRaises(MappingLoadError):
+                self.mappings['broken']
+        self.assertEqual(self.calls, ['broken', 'broken'])
+        self.assertNotIn('broken', self.mappings.touched)
+
+
+if __name__ == '__main__':
+    unittest.main()
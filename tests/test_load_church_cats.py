@@ -0,0 +1,36 @@
+#!/usr/bin/python
+# -*- coding: utf-8  -*-
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from importer import load_church_cats
+
+
+class TestMain(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_main_uses_settings(self):
+        mappings_dir = os.path.join(self.temp_dir, 'custom')
+        os.mkdir(mappings_dir)
+        settings_file = os.path.join(self.temp_dir, 'settings.json')
+        with open(settings_file, 'w') as f:
+            json.dump({'processing': {'mappings_dir': mappings_dir}}, f)
+        church_cats = {'Sjöbo': {'Sjöbo kyrka': 'Sjöbo kyrka'}}
+        with mock.patch.object(load_church_cats, 'get_all_church_cats',
+                               return_value=church_cats):
+            load_church_cats.main('-settings:{0}'.format(settings_file))
+        with open(os.path.join(mappings_dir, 'churches.json')) as f:
+            self.assertEqual(json.load(f), church_cats)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,467 @@
+#!/usr/bin/python
+# -*- coding: utf-8  -*-
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from collections import OrderedDict
+from unittest import mock
+
+import requests
+
+from importer import (
+    category_index, fake_server, item_cache, make_KMB_info, sha1_index)
+from importer.lazy_mappings import LazyMappings, MappingLoadError
+
+
+def make_record(id_no, **values):
+    """Return a minimal record, as output by kmb_massload/harvester."""
+    record = {'ID': id_no, 'problem': [], 'land': 'SE', 'kommun': None,
+              'socken': None, 'lan': None, 'landskap': None}
+    record.update(values)
+    return record
+
+
+class KMBInfoTestCase(unittest.TestCase):
+    """Test case with a KMBInfo which never contacts Commons or Wikidata."""
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.settings = {'processing': {
+            'mappings_dir': self.temp_dir,
+            'item_cache': None,
+            'log_file': os.path.join(self.temp_dir, 'processing.log'),
+            'problem_file': os.path.join(self.temp_dir, 'problems.json'),
+            'checkpoint_file': os.path.join(
+                self.temp_dir, 'checkpoint.json')}}
+        site_patcher = mock.patch('pywikibot.Site')
+        site_patcher.start()
+        self.addCleanup(site_patcher.stop)
+        self.info = self.make_info()
+
+    def tearDown(self):
+        self.info.log.close_and_confirm()
+        shutil.rmtree(self.temp_dir)
+
+    def make_info(self, **options):
+        settings_file = os.path.join(self.temp_dir, 'settings.json')
+        with open(settings_file, 'w') as f:
+            json.dump(self.settings, f)
+        make_KMB_info.KMBInfo.settings_file = settings_file
+        try:
+            info = make_KMB_info.KMBInfo(**options)
+        finally:
+            make_KMB_info.KMBInfo.settings_file = None
+        info.mappings = LazyMappings()
+        return info
+
+    def register(self, **mappings):
+        """Register in-memory mappings with the KMBInfo."""
+        for name, mapping in mappings.items():
+            self.info.mappings.register(
+                name, lambda mapping=mapping: mapping,
+                lambda mapping=mapping: json.dumps(mapping, sort_keys=True))
+
+
+class TestGetOtherVersions(KMBInfoTestCase):
+
+    def setUp(self):
+        super(TestGetOtherVersions, self).setUp()
+        index = sha1_index.Sha1Index(
+            os.path.join(self.temp_dir, sha1_index.INDEX_FILE))
+        index.sources = {'1': 'abc', '2': 'def'}
+        index.commons = {'abc': ['File:Copy.jpg', 'File:Linked.jpg'],
+                         'def': []}
+        self.register(
+            kmb_files={'1': ['File:Linked.jpg'], '3': ['File:Other.jpg']},
+            sha1=index)
+
+    def test_linked_and_duplicate(self):
+        item = make_KMB_info.KMBItem(make_record('1'), self.info)
+        self.assertEqual(
+            item.get_other_versions(),
+            '<gallery>\nFile:Linked.jpg\nFile:Copy.jpg\n</gallery>')
+        self.assertIn('with potential duplicates', item.meta_cats)
+
+    def test_linked_only(self):
+        item = make_KMB_info.KMBItem(make_record('3'), self.info)
+        self.assertEqual(
+            item.get_other_versions(),
+            '<gallery>\nFile:Other.jpg\n</gallery>')
+
+    def test_no_other_versions(self):
+        item = make_KMB_info.KMBItem(make_record('2'), self.info)
+        self.assertEqual(item.get_other_versions(), '')
+        self.assertEqual(item.meta_cats, set())
+
+
+class TestMakeItem(KMBInfoTestCase):
+
+    def test_make_item(self):
+        item = self.info.make_item(make_record('1', namn='Katt'))
+        self.assertEqual(item.namn, 'Katt')
+        # keyed on the record as given, not as completed by KMBItem
+        self.assertEqual(
+            item.cache_key,
+            item_cache.item_key(make_record('1', namn='Katt'),
+                                *self.info.cache_context))
+
+    def test_projected_record(self):
+        # as harvested with -fields:license
+        record = {'ID': '1', 'problem': [], 'license': 'pdm',
+                  'copyright': '', 'byline': 'Katt', 'license_text': '{{PD}}'}
+        item = self.info.make_item(record)
+        other = self.info.make_item({'ID': '2', 'problem': []})
+        self.assertEqual(item.license_text, '{{PD}}')
+        self.assertEqual(item.namn, '')
+        self.assertEqual(item.item_classes, [])
+        self.assertIsNot(item.item_classes, other.item_classes)
+        self.assertEqual(item.get_depicted_place(), '{{Country|1=SE}}')
+        self.assertEqual(item.get_original_description(), '')
+        self.assertEqual(item.get_wiki_description(), '')
+        self.assertIn('Katt / Kulturmiljöbild', item.get_source())
+
+    def test_make_item_with_problem(self):
+        item = self.info.make_item(
+            make_record('1', problem=['No free license']))
+        self.assertIsNone(item)
+        self.info.log.close_and_confirm()
+        with open(self.settings['processing']['log_file']) as f:
+            self.assertIn('1 -- image was skipped because of: No free '
+                          'license', f.read())
+        self.info = self.make_info()
+
+    def test_try_item_output(self):
+        item = self.info.make_item(make_record('1'))
+        with mock.patch.object(self.info, 'make_item_output',
+                               return_value={'filename': '1'}):
+            self.assertEqual(
+                self.info.try_item_output('a', item), {'filename': '1'})
+        with mock.patch.object(self.info, 'make_item_output',
+                               side_effect=ValueError('failed')):
+            self.assertIsNone(self.info.try_item_output('a', item))
+        self.assertEqual(
+            self.info.problems,
+            {'a': {'ID': '1', 'error': 'ValueError: failed'}})
+
+
+class TestMakeInfo(KMBInfoTestCase):
+
+    def setUp(self):
+        super(TestMakeInfo, self).setUp()
+        self.settings['processing'].update(
+            {'schedule': False, 'checkpoint_interval': 2,
+             'max_failures_in_a_row': 3})
+        self.info.log.close_and_confirm()
+        self.info = self.make_info()
+        self.set_data(self.info)
+        self.made = []
+
+    def set_data(self, info):
+        info.data = OrderedDict(
+            (str(i), info.make_item(make_record(str(i), namn='Katt')))
+            for i in range(1, 7))
+
+    def run_make_info(self, fail=(), error=ValueError, info=None):
+        """Run make_info() with items in fail raising the error."""
+        info = info or self.info
+
+        def make_item_output(item):
+            self.made.append(item.ID)
+            if item.ID in fail:
+                raise error('failed')
+            return {'filename': item.ID}
+
+        with mock.patch.object(info, 'make_item_output',
+                               side_effect=make_item_output):
+            return info.make_info()
+
+    def read_json(self, name):
+        with open(self.settings['processing'][name]) as f:
+            return json.load(f)
+
+    def assert_missing(self, name):
+        self.assertFalse(
+            os.path.exists(self.settings['processing'][name]))
+
+    def test_failing_item_isolated(self):
+        output = self.run_make_info(fail=('2', '5'))
+        self.assertEqual(list(output), ['1', '3', '4', '6'])
+        self.assertEqual(
+            self.read_json('problem_file'),
+            {'2': {'ID': '2', 'error': 'ValueError: failed'},
+             '5': {'ID': '5', 'error': 'ValueError: failed'}})
+        self.assert_missing('checkpoint_file')
+
+    def test_stale_problem_file_removed(self):
+        with open(self.settings['processing']['problem_file'], 'w') as f:
+            json.dump({'9': {'ID': '9', 'error': 'old'}}, f)
+        self.assertEqual(len(self.run_make_info()), 6)
+        self.assert_missing('problem_file')
+
+    def test_failures_in_a_row_abort(self):
+        with self.assertRaises(make_KMB_info.ProcessingAborted):
+            self.run_make_info(fail=('2', '3', '4', '5'))
+        self.assertEqual(self.made, ['1', '2', '3', '4'])
+        checkpoint = self.read_json('checkpoint_file')
+        self.assertEqual(list(checkpoint), ['1'])
+        self.assertEqual(len(self.read_json('problem_file')), 3)
+
+    def test_failures_not_in_a_row(self):
+        output = self.run_make_info(fail=('1', '2', '4', '5'))
+        self.assertEqual(list(output), ['3', '6'])
+
+    def test_mapping_load_error_aborts(self):
+        def loader():
+            raise requests.ConnectionError('service down')
+
+        self.info.mappings.register('kommun', loader)
+
+        def make_item_output(item):
+            self.made.append(item.ID)
+            if item.ID == '3':
+                self.info.mappings['kommun']
+            return {'filename': item.ID}
+
+        with mock.patch.object(self.info, 'make_item_output',
+                               side_effect=make_item_output):
+            with self.assertRaises(MappingLoadError):
+                self.info.make_info()
+        self.assertEqual(self.made, ['1', '2', '3'])
+        self.assertEqual(sorted(self.read_json('checkpoint_file')),
+                         ['1', '2'])
+        self.assert_missing('problem_file')
+
+    def test_resume_from_checkpoint(self):
+        with self.assertRaises(KeyboardInterrupt):
+            self.run_make_info(fail=('5', ), error=KeyboardInterrupt)
+        checkpoint = self.read_json('checkpoint_file')
+        self.assertEqual(sorted(checkpoint), ['1', '2', '3', '4'])
+
+        # a rerun, where the record of item 2 has changed
+        self.made = []
+        info = self.make_info()
+        self.set_data(info)
+        info.data['2'] = info.make_item(make_record('2', namn='Hund'))
+        output = self.run_make_info(info=info)
+        info.log.close_and_confirm()
+        self.assertEqual(self.made, ['2', '5', '6'])
+        self.assertEqual(list(output), ['1', '2', '3', '4', '5', '6'])
+        self.assert_missing('checkpoint_file')
+
+    def test_checkpoint_disabled(self):
+        info = self.make_info(checkpoint_file=None)
+        self.set_data(info)
+        with self.assertRaises(KeyboardInterrupt):
+            self.run_make_info(fail=('3', ), error=KeyboardInterrupt,
+                               info=info)
+        info.log.close_and_confirm()
+        self.assert_missing('checkpoint_file')
+
+
+class TestPlaceContext(KMBInfoTestCase):
+
+    def setUp(self):
+        super(TestPlaceContext, self).setUp()
+        self.register(
+            kommun={
+                '0980': {'wd': 'Q1', 'commonscat': 'Gotland Municipality'}},
+            socken={'1': {'wd': 'Q2', 'commonscat': 'Lärbro Parish'},
+                    '2': {'wd': 'Q3', 'commonscat': None}})
+
+    def make_item(self, **values):
+        return make_KMB_info.KMBItem(make_record('1', **values), self.info)
+
+    def test_kommun_and_socken(self):
+        item = self.make_item(kommun='0980', socken='1', lan='Gotland')
+        self.assertEqual(
+            item.get_depicted_place(),
+            '{{Country|1=SE}}, {{city|Q1}}, {{city|Q2}}')
+        self.assertEqual(item.wd, {'kommun': 'Q1', 'socken': 'Q2'})
+        self.assertEqual(item.meta_cats, set())
+        self.assertTrue(item.make_place_category())
+        self.assertEqual(item.content_cats, {'Lärbro Parish'})
+
+    def test_socken_without_category(self):
+        item = self.make_item(kommun='0980', socken='2')
+        self.assertTrue(item.make_place_category())
+        self.assertEqual(item.content_cats, {'Gotland Municipality'})
+
+    def test_no_land_is_sweden(self):
+        item = self.make_item(land='', kommun='0980')
+        self.assertEqual(
+            item.get_depicted_place(), '{{Country|1=SE}}, {{city|Q1}}')
+
+    def test_not_sweden(self):
+        item = self.make_item(land='NO', kommun='0980', lan='Gotland')
+        self.assertEqual(item.get_depicted_place(), '{{Country|1=NO}}')
+        self.assertEqual(
+            item.meta_cats, {'needing categorisation (not from Sweden)'})
+        self.assertFalse(item.make_place_category())
+        self.assertEqual(self.info.mappings.touched, [])
+
+    def test_missing_kommun_falls_back_to_lan(self):
+        for i in range(2):
+            item = self.make_item(kommun='9999', socken='1', lan='Gotland')
+            self.assertEqual(
+                item.get_depicted_place(), '{{Country|1=SE}}, Gotland')
+            self.assertEqual(item.wd, {})
+        self.assertEqual(self.info.place_misses, {('kommun', '9999')})
+        # the socken category is still used
+        self.assertTrue(item.make_place_category())
+        self.assertEqual(item.content_cats, {'Lärbro Parish'})
+
+    def test_no_kommun(self):
+        item = self.make_item(landskap='Gotland')
+        self.assertEqual(
+            item.get_depicted_place(), '{{Country|1=SE}}, Gotland')
+        item = self.make_item()
+        self.assertEqual(item.get_depicted_place(), '{{Country|1=SE}}')
+        self.assertEqual(
+            item.meta_cats, {'needing categorisation (no municipality)'})
+        self.assertFalse(item.make_place_category())
+
+    def test_context_reused(self):
+        with mock.patch.object(
+                self.info, 'make_place_context',
+                wraps=self.info.make_place_context) as make_context:
+            first = self.make_item(kommun='0980', socken='1')
+            first.get_depicted_place()
+            self.info.mappings.reset_read()
+            second = self.make_item(kommun='0980', socken='1')
+            second.get_depicted_place()
+            second.make_place_category()
+            self.make_item(kommun='0980').get_depicted_place()
+        self.assertEqual(make_context.call_count, 2)
+        self.assertEqual(second.wd, first.wd)
+        # the mappings behind a reused context still count as read
+        self.assertEqual(self.info.mappings.read, {'kommun', 'socken'})
+
+
+class TestQueryToLookup(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.config = fake_server.FakeServiceConfig(rows=6)
+        self.server = fake_server.FakeServer(self.config, port=0)
+        self.server.start()
+        self.endpoints = self.server.endpoints()
+        self.query = make_KMB_info.KMBInfo.build_query(
+            'P777', optional_props=['P373'])
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.temp_dir)
+
+    def lookup(self, **kwargs):
+        return make_KMB_info.KMBInfo.query_to_lookup(
+            self.query, endpoint=self.endpoints['sparql'],
+            entity_url=self.endpoints['sparql_entity'], **kwargs)
+
+    def test_lookup(self):
+        self.assertEqual(
+            self.lookup(chunk_size=4),
+            {str(i): 'Q{0}'.format(i) for i in range(1, 7)})
+
+    def test_lookup_props(self):
+        self.config.language = 'sv'
+        lookup = self.lookup(props={'P373': 'commonscat'})
+        self.assertEqual(lookup['2'], {'wd': 'Q2', 'commonscat': 'P3732@sv'})
+
+    def test_duplicates(self):
+        self.config.distinct_values = 4
+        with mock.patch('pywikibot.warning') as warning:
+            lookup = self.lookup()
+        self.assertEqual(lookup, {'1': 'Q5', '2': 'Q6', '3': 'Q3', '4': 'Q4'})
+        warning.assert_called_once_with(
+            '2 non-unique values in lookup, only the last result for each '
+            'was kept')
+
+    def test_cache_and_refresh(self):
+        cache_dir = os.path.join(self.temp_dir, 'cache')
+        self.assertEqual(len(self.lookup(cache_dir=cache_dir, ttl=60)), 6)
+        self.config.rows = 3
+        self.assertEqual(len(self.lookup(cache_dir=cache_dir, ttl=60)), 6)
+        self.assertEqual(
+            len(self.lookup(cache_dir=cache_dir, ttl=60, refresh=True)), 3)
+        # the refreshed lookup replaced the cached one
+        self.assertEqual(len(self.lookup(cache_dir=cache_dir, ttl=60)), 3)
+
+
+class TestLoadMappings(KMBInfoTestCase):
+
+    def test_update_ignores_sparql_cache(self):
+        self.info.load_mappings(update_mappings=True)
+        for name in ('socken', 'kommun'):
+            updater = self.info.mappings.loaders[name].args[1]
+            self.assertTrue(updater.keywords['refresh'])
+
+    def test_no_update(self):
+        self.info.load_mappings(update_mappings=False)
+        self.assertIsNone(self.info.mappings.loaders['socken'].args[1])
+
+
+class TestItemCache(KMBInfoTestCase):
+
+    def setUp(self):
+        super(TestItemCache, self).setUp()
+        self.settings['processing']['item_cache'] = os.path.join(
+            self.temp_dir, 'item_cache')
+        self.info.log.close_and_confirm()
+        self.info = self.make_info()
+        self.loaded = []
+        self.info.mappings.register(
+            'tags', lambda: self.loaded.append('tags') or {}, lambda: 'v1')
+        self.output = {'info': '', 'filename': 'Katt - KMB - 1',
+                       'cats': [], 'meta_cats': []}
+
+    def make_item(self, info):
+        return info.make_item(make_record('1', namn='Katt'))
+
+    def test_hit_does_not_load_mappings(self):
+        item = self.make_item(self.info)
+        self.info.item_cache.put(item.cache_key, {'tags': 'v1'}, self.output)
+        self.assertEqual(self.info.make_item_output(item), self.output)
+        self.assertEqual(self.info.item_cache_hits, 1)
+        self.assertEqual(self.loaded, [])
+
+    def test_code_change_invalidates(self):
+        code_file = os.path.join(self.temp_dir, 'code.py')
+        with open(code_file, 'w') as f:
+            f.write('x = 1')
+        with mock.patch.object(make_KMB_info, 'CODE_FILES', (code_file, )):
+            info = self.make_info()
+            key = self.make_item(info).cache_key
+            info.log.close_and_confirm()
+            with open(code_file, 'w') as f:
+                f.write('x = 2')
+            info = self.make_info()
+            self.assertNotEqual(self.make_item(info).cache_key, key)
+            info.log.close_and_confirm()
+        self.assertEqual(
+            self.make_item(self.info).cache_key,
+            item_cache.item_key(
+                make_record('1', namn='Katt'), *self.info.cache_context))
+
+
+class TestClose(KMBInfoTestCase):
+
+    def test_close_category_index(self):
+        dump_file = os.path.join(self.temp_dir, 'titles.txt')
+        with open(dump_file, 'w') as f:
+            f.write('Abbey\n')
+        category_index.build_index(dump_file, os.path.join(
+            self.temp_dir, category_index.INDEX_FILE))
+        info = self.make_info()
+        self.assertTrue(info.category_exists('Abbey'))
+        index = info.category_index
+        info.close()
+        self.assertIsNone(info.category_index)
+        self.assertTrue(index.file.closed)
+        info.log.close_and_confirm()
+
+
+if __name__ == '__main__':
+    unittest.main()
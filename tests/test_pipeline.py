@@ -0,0 +1,142 @@
+#!/usr/bin/python
+# -*- coding: utf-8  -*-
+import io
+import json
+import os
+import queue
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+import requests
+
+from importer import config, fake_server, make_KMB_info, pipeline
+
+
+class DummyInfo(object):
+
+    def make_item(self, record):
+        return None if record['ID'].endswith('7') else record
+
+    def try_item_output(self, key, item):
+        return {'filename': item['ID']}
+
+
+class TestPipeline(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.server = fake_server.FakeServer(
+            fake_server.FakeServiceConfig(total_hits=30), port=0)
+        self.server.start()
+        self.settings = config.merge_settings({
+            'keywords': ['katt'],
+            'api_key': 'test',
+            'endpoints': self.server.endpoints(),
+            'throttle': {'page_size': 10, 'delay': 0, 'min_delay': 0},
+            'harvest': {
+                'data_file': os.path.join(self.temp_dir, 'data.json'),
+                'index_file': os.path.join(self.temp_dir, 'index.json'),
+                'log_file': os.path.join(self.temp_dir, 'harvest.log')}})
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.temp_dir)
+
+    def start_producer(self, buffer, stop, errors):
+        producer = threading.Thread(
+            target=pipeline.produce,
+            args=(pipeline.harvest_source, buffer, stop, errors),
+            kwargs={'settings': self.settings, 'fields': 'license'})
+        producer.start()
+        return producer
+
+    def test_stream(self):
+        buffer = queue.Queue(maxsize=2)
+        errors = []
+        producer = self.start_producer(buffer, threading.Event(), errors)
+        stream = io.StringIO()
+        output = pipeline.consume(DummyInfo(), buffer, stream)
+        producer.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(output), 27)
+        lines = stream.getvalue().splitlines()
+        self.assertEqual(len(lines), 27)
+        self.assertEqual(json.loads(lines[0]), dict(list(output.items())[:1]))
+        # the harvested records are stored as usual
+        with open(self.settings['harvest']['data_file']) as f:
+            self.assertEqual(len(json.load(f)), 30)
+
+    def test_abort(self):
+        buffer = queue.Queue(maxsize=2)
+        stop = threading.Event()
+        errors = []
+        producer = self.start_producer(buffer, stop, errors)
+        buffer.get()
+        stop.set()
+        while producer.is_alive():
+            try:
+                buffer.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        producer.join()
+        self.assertEqual(errors, [])
+
+    def test_source_error(self):
+        self.settings['endpoints']['ksamsok'] = 'http://127.0.0.1:1/api'
+        self.settings['throttle']['max_retries'] = 0
+        buffer = queue.Queue()
+        errors = []
+        self.start_producer(buffer, threading.Event(), errors).join()
+        self.assertIsNone(buffer.get())
+        self.assertEqual(len(errors), 1)
+        self.assertIsInstance(errors[0], requests.ConnectionError)
+
+    def test_run(self):
+        self.settings['processing'] = {
+            'mappings_dir': self.temp_dir,
+            'item_cache': None,
+            'log_file': os.path.join(self.temp_dir, 'processing.log'),
+            'problem_file': os.path.join(self.temp_dir, 'problems.json')}
+        self.settings['pipeline'] = {
+            'stream_file': os.path.join(self.temp_dir, 'output.jsonl'),
+            'output_file': os.path.join(self.temp_dir, 'output.json'),
+            'stats_file': os.path.join(self.temp_dir, 'stats.json')}
+        settings_file = os.path.join(self.temp_dir, 'settings.json')
+        with open(settings_file, 'w') as f:
+            json.dump(self.settings, f)
+        failing = fake_server.make_id(3)
+
+        def make_item_output(info, item):
+            if item.ID == failing:
+                raise ValueError('failed')
+            return {'filename': item.ID}
+
+        with mock.patch('pywikibot.Site'), \
+                mock.patch.object(make_KMB_info.KMBInfo, 'make_item_output',
+                                  autospec=True,
+                                  side_effect=make_item_output):
+            try:
+                pipeline.run(settings_file=settings_file)
+            finally:
+                make_KMB_info.KMBInfo.settings_file = None
+
+        with open(self.settings['pipeline']['output_file']) as f:
+            output = json.load(f)
+        self.assertEqual(len(output), 29)
+        self.assertNotIn(failing, output)
+        self.assertEqual(output[fake_server.make_id(0)],
+                         {'filename': fake_server.make_id(0)})
+        with open(self.settings['pipeline']['stream_file']) as f:
+            self.assertEqual(len(f.readlines()), 29)
+        with open(self.settings['processing']['problem_file']) as f:
+            self.assertEqual(
+                json.load(f),
+                {failing: {'ID': failing, 'error': 'ValueError: failed'}})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+#!/usr/bin/python
+# -*- coding: utf-8  -*-
+from collections import OrderedDict
+import cProfile
+import pstats
+import unittest
+
+from importer import profiling
+
+STAGES = OrderedDict([
+    ('loading', (('test_profiling.py', 'load'), )),
+    ('output', (('test_profiling.py', 'output'), )),
+])
+
+
+def helper():
+    return sum(range(100))
+
+
+def load():
+    return helper()
+
+
+def output():
+    return str(load())
+
+
+def run_all():
+    load()
+    output()
+
+
+class TestStageReport(unittest.TestCase):
+
+    def setUp(self):
+        profiler = cProfile.Profile()
+        profiler.runcall(run_all)
+        self.stats = pstats.Stats(profiler)
+
+    def get_stages(self):
+        assigned = profiling.assign_stages(self.stats.stats, STAGES)
+        return {func[2]: stage for func, stage in assigned.items()}
+
+    def test_assign_stages_entry_points(self):
+        stages = self.get_stages()
+        self.assertEqual(stages['load'], 'loading')
+        self.assertEqual(stages['output'], 'output')
+
+    def test_assign_stages_closest_caller(self):
+        # helper is called from load, both directly and within output
+        stages = self.get_stages()
+        self.assertEqual(stages['helper'], 'loading')
+
+    def test_assign_stages_outside_stages(self):
+        stages = self.get_stages()
+        self.assertEqual(stages['run_all'], profiling.OTHER_STAGE)
+
+    def test_stage_report(self):
+        report = profiling.stage_report(self.stats, STAGES, top=2)
+        self.assertIn('[loading]', report)
+        self.assertIn('[output]', report)
+        self.assertIn('(helper)', report)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,194 @@
+#!/usr/bin/python
+# -*- coding: utf-8  -*-
+import subprocess
+import sys
+import unittest
+from xml.dom import minidom
+
+import importer.record_parser as record_parser
+
+
+class TestProcessDepicted(unittest.TestCase):
+
+    def setUp(self):
+        self.entry = {'bbr': set(), 'fmis': set(), 'avbildar': []}
+
+    def test_process_depicted_fmis(self):
+        record_parser.process_depicted(
+            self.entry, 'http://kulturarvsdata.se/raa/fmi/10154300010001')
+        self.assertEqual(self.entry['fmis'], {'10154300010001'})
+        self.assertEqual(
+            self.entry['avbildar'], ['{{Fornminne|10154300010001}}'])
+
+    def test_process_depicted_bbr(self):
+        urls = ('http://kulturarvsdata.se/raa/bbrm/21300000012345',
+                'http://kulturarvsdata.se/raa/bbr/21400000422017',
+                'http://kulturarvsdata.se/raa/bbr/99900000012345')
+        for url in urls:
+            record_parser.process_depicted(self.entry, url)
+        self.assertEqual(
+            self.entry['bbr'],
+            {'21300000012345', '21400000422017', '99900000012345'})
+        self.assertEqual(
+            self.entry['avbildar'],
+            ['{{BBR|21300000012345|m}}', '{{BBR|21400000422017|b}}',
+             '{{BBR|99900000012345}}'])
+
+    def test_process_depicted_other(self):
+        url = 'http://kulturarvsdata.se/shm/object/html/123'
+        record_parser.process_depicted(self.entry, url)
+        self.assertEqual(self.entry['avbildar'], [url])
+        self.assertEqual(self.entry['bbr'], set())
+        self.assertEqual(self.entry['fmis'], set())
+
+    def test_process_depicted_malformed_id(self):
+        with self.assertRaises(ValueError):
+            record_parser.process_depicted(
+                self.entry, 'http://kulturarvsdata.se/raa/fmi/html/123')
+
+
+class TestResolveFields(unittest.TestCase):
+
+    def test_resolve_fields_all(self):
+        self.assertIsNone(record_parser.resolve_fields(None))
+
+    def test_resolve_fields_dependencies(self):
+        self.assertEqual(
+            record_parser.resolve_fields(['date', 'kommun']),
+            {'date', 'dateFrom', 'dateTo',
+             'kommun', 'kommunName', 'lan', 'landskap'})
+
+    def test_resolve_fields_projection(self):
+        self.assertEqual(
+            record_parser.resolve_fields('license'),
+            {'license_text', 'license', 'copyright', 'byline'})
+        self.assertEqual(record_parser.resolve_fields('ids'), frozenset())
+
+    def test_resolve_fields_comma_separated(self):
+        self.assertEqual(
+            record_parser.resolve_fields('namn,latitude'),
+            {'namn', 'latitude', 'longitude'})
+
+    def test_resolve_fields_unknown(self):
+        with self.assertRaises(ValueError):
+            record_parser.resolve_fields(['unknown_field'])
+
+
+class TestPostprocessColumns(unittest.TestCase):
+
+    def make_record(self, idno, **values):
+        record = {'ID': idno, 'problem': [], 'dateFrom': '1950-01-01',
+                  'dateTo': '1950-12-31', 'byline': 'Lundberg, Bengt A',
+                  'copyright': 'RAÄ',
+                  'license': 'http://kulturarvsdata.se/resurser/License#by',
+                  'kommun': '980', 'socken': '', 'land': 'se', 'lan': '',
+                  'landskap': 'Gotland', 'kommunName': ''}
+        record.update(values)
+        return record
+
+    def get_records(self):
+        return [
+            self.make_record('1'),
+            self.make_record('2', byline='Okänd', kommun=''),
+            self.make_record('3', license='', copyright='Someone'),
+            self.make_record('4')]
+
+    def test_postprocess_columns_same_as_per_record(self):
+        expected = self.get_records()
+        for record in expected:
+            record_parser.postprocess_record(record)
+        records = self.get_records()
+        record_parser.postprocess_columns(records)
+        self.assertEqual(records, expected)
+        self.assertEqual(len(records[2]['problem']), 1)
+
+    def test_postprocess_columns_projection(self):
+        fields = record_parser.resolve_fields('license')
+        records = [{'ID': '1', 'problem': [], 'byline': 'Okänd',
+                    'copyright': 'RAÄ', 'license': ''}]
+        record_parser.postprocess_columns(records, fields)
+        self.assertEqual(records[0]['byline'], '{{unknown}}')
+        self.assertIsNone(records[0]['license_text'])
+        self.assertNotIn('date', records[0])
+
+    def test_postprocess_columns_unparsed_record(self):
+        records = [{'ID': '1', 'problem': ['404 Client Error']}]
+        record_parser.postprocess_columns(records)
+        self.assertEqual(
+            records, [{'ID': '1', 'problem': ['404 Client Error']}])
+
+
+class TestMemoisation(unittest.TestCase):
+
+    def test_make_license_text_memoised(self):
+        before = record_parser.make_license_text.cache_info().hits
+        for i in range(3):
+            entry = {'license': 'http://kulturarvsdata.se/resurser/License#by',
+                     'copyright': 'RAÄ ', 'byline': 'Bengt A Lundberg',
+                     'problem': []}
+            record_parser.process_license(entry)
+            self.assertEqual(
+                entry['license_text'],
+                '{{CC-BY-2.5|Bengt A Lundberg / Riksantikvarieämbetet}}')
+            self.assertEqual(entry['copyright'], 'RAÄ')
+            self.assertEqual(entry['license'], 'by')
+        self.assertGreaterEqual(
+            record_parser.make_license_text.cache_info().hits, before + 2)
+
+    def test_process_license_not_free(self):
+        # the problem must be reported also when the outcome is memoised
+        for i in range(2):
+            entry = {'license': '', 'copyright': 'Someone', 'byline': '',
+                     'problem': []}
+            record_parser.process_license(entry)
+            self.assertIsNone(entry['license_text'])
+            self.assertEqual(len(entry['problem']), 1)
+
+    def test_cache_counters(self):
+        counters = record_parser.cache_counters()
+        self.assertIn('flip_name.hits', counters)
+        self.assertIn('make_license_text.misses', counters)
+
+
+class TestPrescreenLicense(unittest.TestCase):
+
+    def make_dom(self, license, copyright):
+        return minidom.parseString(
+            '<record xmlns:ns5="http://kulturarvsdata.se/ksamsok#" '
+            'xmlns:pres="http://kulturarvsdata.se/presentation#">'
+            '<ns5:mediaLicense>http://kulturarvsdata.se/resurser/License#{0}'
+            '</ns5:mediaLicense><pres:copyright>{1}</pres:copyright>'
+            '</record>'.format(license, copyright))
+
+    def test_prescreen_license_free(self):
+        self.assertIsNone(record_parser.prescreen_license(
+            self.make_dom('by', 'Riksantikvarieämbetet')))
+
+    def test_prescreen_license_not_free(self):
+        self.assertEqual(
+            record_parser.prescreen_license(self.make_dom('by-nc', 'RAÄ')),
+            ('by-nc', 'RAÄ'))
+
+
+class TestFlipName(unittest.TestCase):
+
+    def test_flip_name(self):
+        self.assertEqual(
+            record_parser.flip_name('Lundberg, Bengt A'), 'Bengt A Lundberg')
+
+    def test_flip_name_not_flippable(self):
+        self.assertEqual(record_parser.flip_name('Okänd'), 'Okänd')
+        self.assertEqual(record_parser.flip_name('A, B, C'), 'A, B, C')
+
+
+class TestImports(unittest.TestCase):
+
+    def test_harvest_does_not_import_pywikibot(self):
+        code = ('import sys, importer.harvester; '
+                'print("pywikibot" in sys.modules)')
+        output = subprocess.check_output([sys.executable, '-c', code])
+        self.assertEqual(output.strip(), b'False')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+#!/usr/bin/python
+# -*- coding: utf-8  -*-
+from types import SimpleNamespace
+import unittest
+
+from importer import scheduling
+
+
+def make_item(kommun, tag, namn='Kyrka'):
+    return SimpleNamespace(
+        land='SE', lan='Skåne', kommunName=kommun, item_classes=[tag],
+        item_keywords=[], namn=namn)
+
+
+class TestLRUCache(unittest.TestCase):
+
+    def test_eviction(self):
+        cache = scheduling.LRUCache(2)
+        cache['a'] = 1
+        cache['b'] = 2
+        cache['a']
+        cache['c'] = 3
+        self.assertEqual(list(cache), ['a', 'c'])
+        self.assertNotIn('b', cache)
+
+
+class TestSchedule(unittest.TestCase):
+
+    def setUp(self):
+        self.items = {}
+        for i in range(20):
+            self.items[str(i)] = make_item(
+                'Kommun {0}'.format(i % 5), 'Tag {0}'.format(i % 2))
+
+    def test_schedule_groups_kommun(self):
+        order = scheduling.schedule(self.items)
+        self.assertEqual(sorted(order), sorted(self.items))
+        kommuner = [self.items[key].kommunName for key in order]
+        self.assertEqual(kommuner, sorted(kommuner))
+
+    def test_schedule_stable(self):
+        order = scheduling.schedule(self.items)
+        self.assertEqual(order[:2], ['0', '10'])
+
+    def test_simulated_hit_rate_improves(self):
+        keys = list(self.items)
+        order = scheduling.schedule(self.items)
+        before = scheduling.simulate_hit_rate(self.items, keys, 3)
+        after = scheduling.simulate_hit_rate(self.items, order, 3)
+        self.assertGreater(after, before)
+
+    def test_unbounded_hit_rate_unchanged(self):
+        keys = list(self.items)
+        order = scheduling.schedule(self.items)
+        self.assertEqual(
+            scheduling.simulate_hit_rate(self.items, keys, None),
+            scheduling.simulate_hit_rate(self.items, order, None))
+
+    def test_simulated_hit_rate_no_items(self):
+        self.assertIsNone(scheduling.simulate_hit_rate({}, [], 3))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+#!/usr/bin/python
+# -*- coding: utf-8  -*-
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+
+from importer import fake_server, sha1_index
+
+
+class DummySite(object):
+
+    def __init__(self, existing):
+        self.existing = existing  # sha1: list of titles
+        self.checked = []
+
+    def allimages(self, sha1=None):
+        self.checked.append(sha1)
+        return [DummyPage(title) for title in self.existing.get(sha1, [])]
+
+
+class DummyPage(object):
+
+    def __init__(self, title):
+        self._title = title
+
+    def title(self):
+        return self._title
+
+
+class TestSha1Index(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.temp_dir, 'kmb_sha1.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_new_index(self):
+        index = sha1_index.Sha1Index(self.filename)
+        self.assertEqual(index.sources, {})
+        self.assertIsNone(index.get_commons_duplicates('abc'))
+        self.assertEqual(index.get_duplicates_for_id('1'), [])
+
+    def test_save_and_reload(self):
+        index = sha1_index.Sha1Index(self.filename)
+        index.sources['1'] = 'abc'
+        index.commons['abc'] = ['File:A.jpg']
+        index.save()
+        index = sha1_index.Sha1Index(self.filename)
+        self.assertEqual(index.get_duplicates_for_id('1'), ['File:A.jpg'])
+
+    def test_save_creates_directory(self):
+        filename = os.path.join(self.temp_dir, 'mappings', 'kmb_sha1.json')
+        sha1_index.Sha1Index(filename).save()
+        self.assertTrue(os.path.exists(filename))
+
+    def test_check_commons(self):
+        index = sha1_index.Sha1Index(self.filename)
+        index.sources = {'1': 'abc', '2': 'def', '3': 'ghi'}
+        index.commons['ghi'] = []  # already checked
+        site = DummySite({'abc': ['File:A.jpg']})
+        index.check_commons(site)
+        self.assertEqual(sorted(site.checked), ['abc', 'def'])
+        self.assertEqual(index.get_duplicates_for_id('1'), ['File:A.jpg'])
+        self.assertEqual(index.get_commons_duplicates('def'), [])
+
+    def test_add_commons_file(self):
+        index = sha1_index.Sha1Index(self.filename)
+        index.commons['abc'] = []
+        index.add_commons_file('abc', 'File:A.jpg')
+        index.add_commons_file('abc', 'File:A.jpg')
+        self.assertEqual(index.get_commons_duplicates('abc'), ['File:A.jpg'])
+
+
+class TestHashSources(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.server = fake_server.FakeServer(
+            fake_server.FakeServiceConfig(media_size=1024), port=0)
+        self.server.start()
+        self.index = sha1_index.Sha1Index(
+            os.path.join(self.temp_dir, 'kmb_sha1.json'))
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.temp_dir)
+
+    def test_hash_sources(self):
+        url = '{0}/media/a.jpg'.format(self.server.base_url)
+        self.index.sources['3'] = 'known'
+        data = {
+            '1': {'source': url},
+            '2': {'source': None},
+            '3': {'source': url},
+            '4': {'source': '{0}/missing'.format(self.server.base_url)},
+        }
+        sha1_index.hash_sources(data, self.index)
+        seed = b'a.jpg'
+        expected = hashlib.sha1(
+            (seed * (1024 // len(seed) + 1))[:1024]).hexdigest()
+        self.assertEqual(self.index.sources, {'1': expected, '3': 'known'})
+
+
+if __name__ == '__main__':
+    unittest.main()
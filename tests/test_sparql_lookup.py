@@ -0,0 +1,89 @@
+#!/usr/bin/python
+# -*- coding: utf-8  -*-
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from importer import fake_server, sparql_lookup
+
+QUERY = 'SELECT ?item ?value WHERE { ?item wdt:P1260 ?value }'
+
+
+class TestPageQuery(unittest.TestCase):
+
+    def test_page_query(self):
+        self.assertEqual(
+            sparql_lookup.page_query(QUERY, 10, 20),
+            QUERY + ' ORDER BY ?item ?value LIMIT 10 OFFSET 20')
+
+
+class TestCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = os.path.join(tempfile.mkdtemp(), 'cache')
+        self.key = sparql_lookup.cache_key('endpoint', QUERY)
+
+    def tearDown(self):
+        shutil.rmtree(os.path.dirname(self.cache_dir))
+
+    def test_cache_key_differs(self):
+        self.assertNotEqual(
+            self.key, sparql_lookup.cache_key('endpoint', QUERY + ' '))
+
+    def test_read_cache_missing(self):
+        self.assertIsNone(
+            sparql_lookup.read_cache(self.cache_dir, self.key))
+
+    def test_write_and_read_cache(self):
+        sparql_lookup.write_cache(self.cache_dir, self.key, {'a': 'Q1'})
+        self.assertEqual(
+            sparql_lookup.read_cache(self.cache_dir, self.key, ttl=60),
+            {'a': 'Q1'})
+
+    def test_read_cache_expired(self):
+        sparql_lookup.write_cache(self.cache_dir, self.key, {'a': 'Q1'})
+        filename = os.path.join(self.cache_dir, self.key + '.json')
+        past = time.time() - 120
+        os.utime(filename, (past, past))
+        self.assertIsNone(
+            sparql_lookup.read_cache(self.cache_dir, self.key, ttl=60))
+
+
+class TestChunkedSparql(unittest.TestCase):
+
+    def setUp(self):
+        self.server = fake_server.FakeServer(
+            fake_server.FakeServiceConfig(rows=25), port=0)
+        self.server.start()
+        self.endpoints = self.server.endpoints()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def make_sparql(self, chunk_size=None, workers=1):
+        return sparql_lookup.ChunkedSparql(
+            self.endpoints['sparql'], self.endpoints['sparql_entity'],
+            chunk_size, workers)
+
+    def test_select_unchunked(self):
+        rows = list(self.make_sparql().select(QUERY))
+        self.assertEqual(len(rows), 25)
+
+    def test_select_chunked(self):
+        wdqs = self.make_sparql(chunk_size=10, workers=2)
+        rows = list(wdqs.select(QUERY))
+        self.assertEqual(
+            [row['value']['value'] for row in rows],
+            [str(i) for i in range(1, 26)])
+        self.assertEqual(wdqs.get_id(rows[-1]['item']), 'Q25')
+
+    def test_select_chunked_full_last_page(self):
+        rows = list(self.make_sparql(chunk_size=5, workers=3).select(QUERY))
+        self.assertEqual(len(rows), 25)
+
+
+if __name__ == '__main__':
+    unittest.main()
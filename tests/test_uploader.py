@@ -0,0 +1,139 @@
+#!/usr/bin/python
+# -*- coding: utf-8  -*-
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from importer import config, fake_server, sha1_index, uploader
+
+
+class DummySite(object):
+
+    def __init__(self, existing=None):
+        self.existing = existing or {}  # sha1: list of titles
+
+    def allimages(self, sha1=None):
+        return [DummyPage(title) for title in self.existing.get(sha1, [])]
+
+
+class DummyPage(object):
+
+    def __init__(self, title):
+        self._title = title
+
+    def title(self):
+        return self._title
+
+
+class TestPipelinedUpload(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.server = fake_server.FakeServer(
+            fake_server.FakeServiceConfig(media_size=1024), port=0)
+        self.server.start()
+        self.settings = config.merge_settings({
+            'processing': {'mappings_dir': self.temp_dir},
+            'upload': {
+                'log_file': os.path.join(self.temp_dir, 'upload.log'),
+                'download_dir': self.temp_dir}})
+        self.info_path = os.path.join(self.temp_dir, 'info.json')
+        self.index_file = os.path.join(
+            self.temp_dir, sha1_index.INDEX_FILE)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.temp_dir)
+
+    def make_info(self, names):
+        """Write an info file with one entry per media file name."""
+        info = {}
+        for name in names:
+            url = '{0}/media/{1}.jpg'.format(self.server.base_url, name)
+            info[url] = {'filename': 'Test {0}'.format(name),
+                         'info': '', 'cats': [], 'meta_cats': []}
+        uploader.common.open_and_write_file(
+            self.info_path, info, as_json=True)
+        return info
+
+    def run_upload(self, upload, **kwargs):
+        with mock.patch.object(uploader.uploader, 'upload_single_file',
+                               side_effect=upload) as upload_mock, \
+                mock.patch.object(uploader.uploader, 'make_info_page',
+                                  return_value=''):
+            uploader.up_all_pipelined(
+                self.info_path, target_site=DummySite(),
+                settings=self.settings, **kwargs)
+        with open(self.settings['upload']['log_file']) as f:
+            log = f.read().splitlines()
+        return upload_mock, log
+
+    def test_upload_all(self):
+        self.make_info(['a', 'b', 'c'])
+        upload_mock, log = self.run_upload(
+            lambda *args, **kwargs: {'log': 'ok'})
+        self.assertEqual(upload_mock.call_count, 3)
+        self.assertEqual(len(log), 3)
+        # the uploaded files are known duplicates on a rerun
+        index = sha1_index.Sha1Index(self.index_file)
+        titles = sorted(sum(index.commons.values(), []))
+        self.assertEqual(
+            titles, ['File:Test a.jpg', 'File:Test b.jpg', 'File:Test c.jpg'])
+
+    def test_upload_error_isolated(self):
+        self.make_info(['a', 'b', 'c'])
+
+        def upload(filename, *args, **kwargs):
+            if filename == 'Test b.jpg':
+                raise RuntimeError('timeout')
+            return {'log': 'ok'}
+
+        upload_mock, log = self.run_upload(upload)
+        self.assertEqual(upload_mock.call_count, 3)
+        self.assertEqual(
+            [line for line in log if 'upload failed' in line],
+            ['{0}/media/b.jpg -- upload failed: RuntimeError: '
+             'timeout'.format(self.server.base_url)])
+        index = sha1_index.Sha1Index(self.index_file)
+        self.assertNotIn(
+            'File:Test b.jpg', sum(index.commons.values(), []))
+
+    def test_test_mode(self):
+        self.make_info(['a', 'b'])
+        upload_mock, log = self.run_upload(None, test=True)
+        self.assertFalse(upload_mock.called)
+        self.assertTrue(all('test mode' in line for line in log))
+        index = sha1_index.Sha1Index(self.index_file)
+        self.assertEqual(sum(index.commons.values(), []), [])
+
+
+class TestUploadPrefetched(unittest.TestCase):
+
+    def setUp(self):
+        self.prefetched = uploader.PrefetchedFile(
+            'http://example.org/a.jpg', {'filename': 'Test a'})
+        self.prefetched.sha1 = 'abc'
+
+    def test_duplicate(self):
+        self.prefetched.duplicates = ['File:Other.jpg']
+        self.assertEqual(
+            uploader.upload_prefetched(self.prefetched, None)[0],
+            'duplicate')
+
+    def test_download_error(self):
+        self.prefetched.error = 'HTTPError: 404'
+        self.assertEqual(
+            uploader.upload_prefetched(self.prefetched, None),
+            ('error', 'download failed: HTTPError: 404'))
+
+    def test_tested(self):
+        self.assertEqual(
+            uploader.upload_prefetched(self.prefetched, None, test=True),
+            ('tested', 'test mode, would upload as Test a.jpg'))
+
+
+if __name__ == '__main__':
+    unittest.main()
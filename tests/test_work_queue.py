@@ -0,0 +1,133 @@
+#!/usr/bin/python
+# -*- coding: utf-8  -*-
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from importer import work_queue
+
+
+def make_data():
+    data = {}
+    for i, kommun in enumerate(('0180', '0180', '0980', '0180', '', '0980')):
+        data[str(i)] = {'ID': str(i), 'kommun': kommun, 'lan': 'Gotland'}
+    return data
+
+
+class TestMakeUnits(unittest.TestCase):
+
+    def test_kommun_kept_together(self):
+        units = work_queue.make_units(make_data(), shard_size=3)
+        self.assertEqual(
+            [sorted(unit) for unit in units],
+            [['0', '1', '3'], ['2', '4', '5']])
+
+    def test_large_kommun_split(self):
+        units = work_queue.make_units(make_data(), shard_size=2)
+        self.assertEqual(sum(len(unit) for unit in units), 6)
+        self.assertTrue(all(len(unit) <= 2 for unit in units))
+
+
+class TestWorkQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.queue_dir = tempfile.mkdtemp()
+        self.count = work_queue.split(make_data(), self.queue_dir, 3)
+
+    def tearDown(self):
+        shutil.rmtree(self.queue_dir)
+
+    def process(self, name, claimed):
+        unit = work_queue.common.open_and_read_file(claimed, as_json=True)
+        output = {key: {'filename': key} for key in unit}
+        work_queue.complete(self.queue_dir, name, claimed, output)
+
+    def test_split_not_empty(self):
+        with self.assertRaises(ValueError):
+            work_queue.split(make_data(), self.queue_dir)
+
+    def test_claim_each_unit_once(self):
+        first = work_queue.claim(self.queue_dir, 'a')
+        second = work_queue.claim(self.queue_dir, 'b')
+        self.assertNotEqual(first[0], second[0])
+        self.assertIsNone(work_queue.claim(self.queue_dir, 'c'))
+        self.assertEqual(
+            work_queue.list_units(self.queue_dir, 'claimed'),
+            ['a--unit-00000.json', 'b--unit-00001.json'])
+
+    def test_merge(self):
+        while True:
+            claimed = work_queue.claim(self.queue_dir, 'a')
+            if not claimed:
+                break
+            self.process(*claimed)
+        merged = work_queue.merge(self.queue_dir)
+        # in input order, not that of the units
+        self.assertEqual(list(merged), list(make_data()))
+
+    def test_merge_pending(self):
+        self.process(*work_queue.claim(self.queue_dir, 'a'))
+        with self.assertRaises(ValueError):
+            work_queue.merge(self.queue_dir)
+        self.assertEqual(
+            len(work_queue.merge(self.queue_dir, force=True)), 3)
+
+    def test_release(self):
+        name, claimed = work_queue.claim(self.queue_dir, 'a')
+        self.assertEqual(work_queue.release(self.queue_dir, timeout=60), [])
+        past = time.time() - 120
+        os.utime(claimed, (past, past))
+        self.assertEqual(
+            work_queue.release(self.queue_dir, timeout=60), [name])
+        self.assertEqual(
+            len(work_queue.list_units(self.queue_dir, 'todo')), self.count)
+
+
+class TestMain(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.queue_dir = os.path.join(self.temp_dir, 'queue')
+        self.in_file = os.path.join(self.temp_dir, 'data.json')
+        with open(self.in_file, 'w') as f:
+            json.dump(make_data(), f)
+        self.settings_file = os.path.join(self.temp_dir, 'settings.json')
+        with open(self.settings_file, 'w') as f:
+            json.dump({'processing': {
+                'queue_dir': self.queue_dir, 'shard_size': 3,
+                'claim_timeout': 60}}, f)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def main(self, *args):
+        work_queue.main(
+            '-settings:{0}'.format(self.settings_file), *args)
+
+    def test_split_from_settings(self):
+        self.main('-split', '-in_file:{0}'.format(self.in_file))
+        self.assertEqual(
+            len(work_queue.list_units(self.queue_dir, 'todo')), 2)
+
+    def test_split_options_override_settings(self):
+        queue_dir = os.path.join(self.temp_dir, 'other')
+        self.main('-split', '-in_file:{0}'.format(self.in_file),
+                  '-queue:{0}'.format(queue_dir), '-shard_size:2')
+        self.assertEqual(
+            len(work_queue.list_units(queue_dir, 'todo')), 4)
+        self.assertFalse(os.path.exists(self.queue_dir))
+
+    def test_release_from_settings(self):
+        self.main('-split', '-in_file:{0}'.format(self.in_file))
+        name, claimed = work_queue.claim(self.queue_dir, 'a')
+        past = time.time() - 120
+        os.utime(claimed, (past, past))
+        self.main('-release')
+        self.assertEqual(work_queue.list_units(self.queue_dir, 'claimed'), [])
+
+
+if __name__ == '__main__':
+    unittest.main()